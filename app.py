@@ -1,14 +1,22 @@
+import json
 import os
+import time
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, g, jsonify, request, send_from_directory
 
-from trpg_app import db, dice, gm_agent, services
+from trpg_app import bootstrap, dice, events, gm_agent, idempotency, metrics, savefile, scenario, services, speculation, tracing
 
 
 app = Flask(__name__, static_folder="static", static_url_path="")
-db.init_db()
+
+# SSE 接続を維持するためのハートビート間隔（秒）
+SSE_HEARTBEAT_SECONDS = 15
+# GM ターンの重複実行を防ぐ（Idempotency-Key ごとの結果保存と、同一リクエストの相乗り）
+_turns = idempotency.Coalescer()
+# 提示した選択肢のターンの先読み（GM_SPECULATE=1 のときだけ）
+_speculator = speculation.from_env()
 
 
 def _json_error(message: str, status: int = 400):
@@ -16,6 +24,26 @@ def _json_error(message: str, status: int = 400):
     return jsonify({"error": message}), status
 
 
+if metrics.ENABLED:
+
+    @app.before_request
+    def _start_metrics():
+        # リクエスト単位の計測を開始
+        g.request_started = time.perf_counter()
+        metrics.start_request()
+
+    @app.after_request
+    def _finish_metrics(response):
+        # ルート別レイテンシを記録し、内訳を Server-Timing ヘッダで返す
+        elapsed = time.perf_counter() - g.get("request_started", time.perf_counter())
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        metrics.observe("http", elapsed, route=route, method=request.method, status=str(response.status_code))
+        header = metrics.server_timing(elapsed)
+        if header:
+            response.headers["Server-Timing"] = header
+        return response
+
+
 @app.route("/")
 def index():
     # フロントのシングルページを返却
@@ -31,10 +59,25 @@ def health():
     return jsonify({"status": "ok"})
 
 
+@app.route("/api/metrics")
+def metrics_endpoint():
+    # Prometheus 形式のメトリクス
+    if not metrics.ENABLED:
+        return _json_error("metrics disabled; set TRPG_METRICS=1", 404)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/api/session", methods=["POST"])
 def create_session():
     # セッション作成 API
     payload = request.get_json(force=True, silent=True) or {}
+    scenario_id = (payload.get("settings") or {}).get("scenario")
+    if scenario_id:
+        # 存在しない・壊れたシナリオは作成時に弾く
+        try:
+            scenario.load(scenario_id)
+        except scenario.ScenarioError as exc:
+            return _json_error(str(exc))
     session = services.create_session(
         name=payload.get("name"),
         settings=payload.get("settings"),
@@ -43,13 +86,116 @@ def create_session():
     return jsonify(session), 201
 
 
+def _conditional(session_id: str, build):
+    # セッションのバージョンを ETag にした条件付き GET。未変更なら子テーブルに触れず 304 を返す
+    version = services.get_session_version(session_id)
+    if version is None:
+        return _json_error("session not found", 404)
+    if request.if_none_match.contains(str(version)):
+        response = Response(status=304)
+    else:
+        payload = build(version)
+        if payload is None:
+            return _json_error("session not found", 404)
+        response = jsonify(payload)
+        version = payload.get("version", version)
+    response.set_etag(str(version))
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
 @app.route("/api/session/<session_id>", methods=["GET"])
 def get_session(session_id: str):
     # セッション取得 API
-    session = services.get_session(session_id)
-    if not session:
+    return _conditional(session_id, lambda version: services.get_session(session_id, version=version))
+
+
+@app.route("/api/session/<session_id>/dice_logs", methods=["GET"])
+def get_dice_logs(session_id: str):
+    # ダイスログだけを返す軽量 API（ダイス欄の再描画用）
+    return _conditional(
+        session_id,
+        lambda version: {"version": version, "dice_logs": services.list_dice_logs(session_id)},
+    )
+
+
+@app.route("/api/session/<session_id>/search", methods=["GET"])
+def search_history(session_id: str):
+    # ターン履歴の全文検索 API（?q=...&limit=...）
+    query = (request.args.get("q") or "").strip()
+    if not query:
+        return _json_error("q is required")
+    limit = request.args.get("limit", 10, type=int)
+    return _conditional(
+        session_id,
+        lambda version: {"version": version, "query": query, "results": services.search_history(session_id, query, limit)},
+    )
+
+
+def _sse(event: Dict[str, Any]) -> str:
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+@app.route("/api/session/<session_id>/events", methods=["GET"])
+def session_events(session_id: str):
+    # セッションの変更イベントを Server-Sent Events で配信
+    subscription = events.subscribe(session_id)  # 取りこぼさないよう、バージョンを読む前に購読する
+    version = services.get_session_version(session_id)
+    if version is None:
+        subscription.close()
         return _json_error("session not found", 404)
-    return jsonify(session)
+
+    def stream():
+        try:
+            # クライアントは hello のバージョンが手元と違えば全体を取り直す
+            yield "retry: 3000\n" + _sse({"type": "hello", "version": version})
+            while True:
+                message = subscription.get(timeout=SSE_HEARTBEAT_SECONDS)
+                if message is None:
+                    yield ": ping\n\n"
+                elif message == events.RESYNC:
+                    yield _sse({"type": "resync"})
+                else:
+                    yield f"data: {message}\n\n"
+        finally:
+            subscription.close()
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/session/<session_id>/export", methods=["GET"])
+def export_session(session_id: str):
+    # セッションのセーブファイル（gzip 圧縮 NDJSON / msgpack）をストリーミングで返す
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in savefile.FORMATS:
+        return _json_error(f"format must be one of: {', '.join(savefile.FORMATS)}")
+    try:
+        stream = savefile.export_session(session_id, fmt)
+    except savefile.SaveFileError as exc:
+        return _json_error(str(exc))
+    if stream is None:
+        return _json_error("session not found", 404)
+    return Response(
+        stream,
+        mimetype="application/gzip",
+        headers={
+            "Content-Disposition": f'attachment; filename="{savefile.filename(session_id, fmt)}"',
+        },
+    )
+
+
+@app.route("/api/session/import", methods=["POST"])
+def import_session():
+    # セーブファイルを新しいセッションとして取り込む（リクエストボディにファイルをそのまま送る）
+    try:
+        result = savefile.import_session(request.stream)
+    except savefile.SaveFileError as exc:
+        return _json_error(str(exc))
+    return jsonify(result), 201
 
 
 @app.route("/api/character", methods=["POST"])
@@ -60,7 +206,7 @@ def create_character():
     missing = [f for f in required_fields if f not in payload]
     if missing:
         return _json_error(f"missing fields: {', '.join(missing)}")
-    if not services.get_session(payload["session_id"]):
+    if services.get_session_version(payload["session_id"]) is None:
         return _json_error("session not found", 404)
     character = services.create_character(
         session_id=payload["session_id"],
@@ -97,52 +243,128 @@ def roll_dice():
         result = dice.roll(expr)
     except Exception as exc:
         return _json_error(str(exc))
-    services.log_dice(session_id, expr, result)
+    # ログの書き込みに失敗したら成功扱いにしない（write-behind でもコミットまで待つ）
+    if not _logs_saved([services.submit_dice_log(session_id, expr, result)]):
+        return _json_error("failed to save dice log", 500)
     return jsonify(result)
 
 
-def _update_messages(session, player_input: str, gm_text: str):
+def _logs_saved(pendings) -> bool:
+    # 依頼したログ行がすべてコミットされるまで待ち、どれかが失敗していれば False
+    try:
+        for pending in pendings:
+            pending.result()
+    except Exception:
+        app.logger.exception("log write failed")
+        return False
+    return True
+
+
+def _update_messages(session_id: str, player_input: str, gm_text: str):
     # セーブ用メッセージ履歴を更新
-    save_blob = dict(session.get("save_blob") or {})
-    messages = list(save_blob.get("messages") or [])
-    messages.append({"role": "user", "content": player_input})
-    messages.append({"role": "assistant", "content": gm_text})
-    save_blob["messages"] = messages[-50:]  # keep it short for PoC
-    services.update_session_save(session["id"], save_blob)
+    services.append_session_messages(
+        session_id,
+        [{"role": "user", "content": player_input}, {"role": "assistant", "content": gm_text}],
+        keep=50,  # keep it short for PoC
+    )
+
+
+def _as_version(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _turn_state(session_id: str, client_version: Optional[int], base_version: int, toolset, own_writes: int) -> Dict:
+    # クライアントがターン開始時点の状態を持っていれば差分だけ、そうでなければ全体スナップショットを返す
+    version = services.get_session_version(session_id)
+    # 他のリクエストの書き込みが挟まっていないことをバージョンの進み方で確認
+    if client_version == base_version and version == base_version + own_writes:
+        return {"state_patch": {"base_version": base_version, "version": version, **toolset.state_delta()}}
+    return {"state": services.summarize_state(services.get_session(session_id))}
 
 
 @app.route("/api/gm/turn", methods=["POST"])
 def gm_turn():
-    # GM ターン API
+    # GM ターン API（1 ターン = 1 トレース）
     payload: Dict[str, Any] = request.get_json(force=True, silent=True) or {}
+    session_id = payload.get("session_id") or ""
+    key = request.headers.get("Idempotency-Key")
+    request_fingerprint = idempotency.fingerprint(payload)
+    # キーがあれば TTL のあいだ結果を保存して再送に返す。なければ処理中の同一リクエストにだけ相乗りする
+    coalesce_key = (session_id, "key", key) if key else (session_id, "body", request_fingerprint)
+    with tracing.span("gm.turn", session_id=session_id):
+        try:
+            (body, status), outcome = _turns.run(
+                coalesce_key, request_fingerprint, lambda: _gm_turn(payload), store=bool(key), keep=_is_success
+            )
+        except idempotency.KeyReuseError as exc:
+            return _json_error(str(exc), 422)
+    response = jsonify(body)
+    response.status_code = status
+    if outcome != idempotency.COMPUTED:
+        response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def _is_success(result) -> bool:
+    # 再送に返すのは成功した応答だけ（エラーは次の再送で処理し直す）
+    return 200 <= result[1] < 300
+
+
+def _gm_turn(payload: Dict[str, Any]):
+    # 1 ターン分を処理して (レスポンス本文, ステータス) を返す（再送時にそのまま返せる形）
     session_id = payload.get("session_id")
     if not session_id:
-        return _json_error("session_id is required")
+        return {"error": "session_id is required"}, 400
     session = services.get_session(session_id)
     if not session:
-        return _json_error("session not found", 404)
+        return {"error": "session not found"}, 404
     player_input = payload.get("player_input", "")
     selected_choice_id = payload.get("selected_choice_id")
+    client_version = _as_version(payload.get("state_version"))
     agent = gm_agent.GMAgent(session)
-    response = agent.take_turn(player_input, selected_choice_id)
-    turn_no = len(session.get("turn_logs", [])) + 1
-    services.log_turn(
+    # 選ばれた選択肢を先読み済みならその書き込みを適用して結果を使う
+    result = _speculator.claim(session, player_input, selected_choice_id, agent.toolset) if _speculator is not None else None
+    speculated = result is not None
+    if result is None:
+        result = agent.take_turn(player_input, selected_choice_id)
+    gm_output = {
+        "narration": result.narration,
+        "choices": result.choices,
+        "log": result.log,
+        "mode": result.mode,
+    }
+    if result.route:
+        gm_output["route"] = result.route
+    if speculated:
+        gm_output["speculated"] = True
+    trace_id = tracing.current_trace_id()
+    if trace_id:
+        # 遅いターンをトレースの内訳と突き合わせられるよう ID を残す
+        gm_output["trace_id"] = trace_id
+    turn_log = services.submit_turn_log(
         session_id=session_id,
-        turn_no=turn_no,
         player_input=player_input,
-        gm_output={
-            "narration": response.get("narration"),
-            "choices": response.get("choices"),
-            "log": response.get("log"),
-            "mode": response.get("mode"),
-        },
-        dice_results=response.get("dice_results", []),
-        world_diff=response.get("world_diff", {}),
+        gm_output=gm_output,
+        dice_results=result.dice_results,
+        world_diff=result.world_diff,
     )
-    _update_messages(session, player_input, response.get("narration", ""))
-    return jsonify(response)
+    _update_messages(session_id, player_input, result.narration)
+    if not _logs_saved([turn_log] + [pending for pending, _ in agent.toolset.changes["dice"]]):
+        return {"error": "failed to save turn log"}, 500
+    # ターンログとメッセージ履歴の 2 回分の書き込みを足してバージョンの整合を確かめる
+    response = result.to_dict()
+    if speculated:
+        response["speculated"] = True
+    response.update(_turn_state(session_id, client_version, session["version"], agent.toolset, agent.toolset.changes["writes"] + 2))
+    if _speculator is not None:
+        _speculator.schedule(session_id, result.choices)
+    return response, 200
 
 
 if __name__ == "__main__":
+    bootstrap.bootstrap()
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=True)
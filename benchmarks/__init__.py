@@ -0,0 +1 @@
+"""Benchmark suites for the TRPG server (run with ``python -m benchmarks.run``)."""
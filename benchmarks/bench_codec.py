@@ -0,0 +1,98 @@
+"""JSON column codec benchmarks: encode/decode cost per codec and stored size per compression mode."""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+import tempfile
+
+from trpg_app import db
+
+CODECS = ("json", "orjson", "msgspec")
+COMPRESSIONS = ("none", "zlib", "zstd")
+SIZE_ROWS = 1_000
+
+CHARACTER = {
+    "base_stats": {"STR": 16, "DEX": 14, "CON": 12, "INT": 10, "WIS": 13, "CHA": 8},
+    "skills": {"perception": 2, "stealth": 3, "athletics": 1},
+    "resources": {"hp": 12, "max_hp": 12, "proficiency": 2, "conditions": []},
+    "derived_stats": {"ac": 14, "max_hp": 12, "initiative": 2},
+}
+GM_OUTPUT = {
+    "narration": "松明の明かりが揺れ、崩れた祭壇の影に古いレバーが見える。" * 8
+    + " The goblin snarls and raises its rusty blade, eyes darting toward the exit." * 4,
+    "choices": [{"id": f"choice_{i}", "text": f"選択肢 {i}: 慎重に近づく / approach carefully"} for i in range(4)],
+    "log": ["perception check vs DC 12: success", "attack roll 17 vs AC 13: hit", "damage 5"],
+    "mode": "simple",
+    "trace_id": "4bf92f3577b34da6a3ce929d0e0e4736",
+}
+SAVE_BLOB = {
+    "messages": [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"ターン {i}: 扉を調べる。The door creaks open slowly."}
+        for i in range(50)
+    ],
+    "world_facts": {f"fact_{i}": i % 3 == 0 for i in range(20)},
+}
+PAYLOADS = {"character": CHARACTER, "gm_output": GM_OUTPUT, "save_blob": SAVE_BLOB}
+
+
+def _available(setter, name: str) -> bool:
+    try:
+        setter(name)
+        return True
+    except ImportError:
+        return False
+
+
+def _stored_size(compression: str) -> dict:
+    # 圧縮設定ごとに gm_output / save_blob 相当の行を SQLite に書き、ファイルサイズを比べる
+    path = os.path.join(tempfile.mkdtemp(prefix="trpg-codec-"), "size.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE t (gm_output TEXT, save_blob TEXT)")
+    conn.executemany(
+        "INSERT INTO t VALUES (?, ?)",
+        [(db.dumps(GM_OUTPUT, compress=True), db.dumps(SAVE_BLOB, compress=True)) for _ in range(SIZE_ROWS)],
+    )
+    conn.commit()
+    conn.close()
+    size = os.path.getsize(path)
+    return {"bytes": size, "rows": SIZE_ROWS, "bytes_per_row": size / SIZE_ROWS}
+
+
+def run(bench) -> None:
+    original_codec = db.codec.name
+    original_compression = db.COLUMN_COMPRESSION
+    try:
+        for codec in CODECS:
+            if not _available(db.set_codec, codec):
+                continue
+            for payload_name, payload in PAYLOADS.items():
+                encoded = db.dumps(payload)
+                bench.measure("encode", lambda: db.dumps(payload), number=200, codec=codec, payload=payload_name)
+                bench.measure("decode", lambda: db.loads(encoded), number=200, codec=codec, payload=payload_name)
+
+        db.set_codec(original_codec)
+        for compression in COMPRESSIONS:
+            if not _available(db.set_compression, compression):
+                continue
+            for payload_name in ("gm_output", "save_blob"):
+                payload = PAYLOADS[payload_name]
+                stored = db.dumps(payload, compress=True)
+                bench.measure(
+                    "encode_compressed",
+                    lambda: db.dumps(payload, compress=True),
+                    number=100,
+                    compression=compression,
+                    payload=payload_name,
+                )
+                bench.measure(
+                    "decode_compressed",
+                    lambda: db.loads(stored),
+                    number=100,
+                    compression=compression,
+                    payload=payload_name,
+                )
+            bench.record("stored_size", _stored_size(compression), unit="bytes", compression=compression)
+    finally:
+        db.set_codec(original_codec)
+        db.set_compression(original_compression)
@@ -0,0 +1,124 @@
+"""Micro-benchmarks for the pure rule layer: dice.roll, rules.*, compute_derived_stats, intent matching and scenarios."""
+
+from __future__ import annotations
+
+import json
+import random
+
+from trpg_app import dice, domain, intents, rules, scenario
+from trpg_app.speculation import SpeculativeToolset
+
+DICE_EXPRESSIONS = [
+    "1d20",
+    "2d6+3",
+    "4d6kh3",
+    "adv(1d20+5)",
+    "(2d8+1d6)*2-3",
+    "10d10kl5+3d4+7",
+]
+
+HERO_STATS = {"STR": 16, "DEX": 14, "CON": 12, "INT": 10, "WIS": 13, "CHA": 8}
+HERO_RESOURCES = {"hp": 12, "max_hp": 12, "proficiency": 2, "ac_bonus": 2}
+
+
+def _character(name: str, base_stats: dict, resources: dict, skills: dict = None) -> domain.Character:
+    # services が行から組み立てるのと同じ型付きキャラクター
+    res = domain.Resources.from_dict(resources)
+    return domain.Character(
+        id=name,
+        session_id="bench",
+        name=name,
+        base_stats=base_stats,
+        skills=skills or {},
+        resources=res,
+        derived_stats=rules.derive_stats(base_stats, res),
+    )
+
+
+# 意図表に足す合成パターン数（語彙が増えても 1 回の照合時間が変わらないことを見る）
+INTENT_VOCABULARY_SIZES = (0, 1_000, 5_000)
+INTENT_INPUTS = ("I carefully search the old shelves for hidden levers", "ゴブリンに斬りかかる", "tell me about the innkeeper's past")
+
+
+def _intent_table(extra: int) -> dict:
+    # 既定の意図表に、入力には現れない合成パターンを extra 件足す
+    table = intents.load_table()
+    filler = {"priority": 0, "en": [f"verb{i:05d}" for i in range(extra)]}
+    return {**table, "intents": {**table["intents"], "filler": filler}}
+
+
+HERO = _character("hero", HERO_STATS, HERO_RESOURCES, {"perception": 2, "stealth": 3})
+GOBLIN = _character("goblin", {"STR": 8, "DEX": 14}, {"hp": 7, "max_hp": 7})
+
+# (シーン, 選択肢 ID, 自由入力): 判定なしの遷移、技能判定、攻撃、意図からの引き当て
+SCENARIO_TURNS = (
+    ("entrance", "explore", ""),
+    ("entrance", "search", ""),
+    ("guardroom", "attack", ""),
+    ("corridor", None, "I search the walls"),
+)
+
+
+def _scenario_snapshot(scene: str) -> dict:
+    # DB を通さないセッションのスナップショット（SpeculativeToolset が読み書きを手元で済ませる）
+    return {
+        "id": "bench",
+        "version": 1,
+        "settings": {"scenario": "ruins"},
+        "characters": [HERO.to_dict(), GOBLIN.to_dict()],
+        "save_blob": {"world_facts": {scenario.SCENE_FACT: scene}},
+    }
+
+
+def run(bench) -> None:
+    rng = random.Random(1234)
+    for expr in DICE_EXPRESSIONS:
+        bench.measure("dice.roll", lambda expr=expr: dice.roll(expr, rng=rng), number=200, expression=expr)
+
+    bench.measure(
+        "rules.compute_derived_stats",
+        lambda: rules.compute_derived_stats(HERO_STATS, HERO_RESOURCES),
+        number=1000,
+    )
+    bench.measure("rules.request_skill_check", lambda: rules.request_skill_check(HERO, "perception", 12, rng=rng), number=500)
+    bench.measure(
+        "rules.attack_roll",
+        lambda: rules.attack_roll(HERO, GOBLIN, weapon={"damage": "1d8", "finesse": True}, rng=rng),
+        number=500,
+    )
+    bench.measure("rules.saving_throw", lambda: rules.saving_throw(HERO, 13, "DEX", rng=rng), number=500)
+    bench.measure(
+        "rules.evaluate_rule_template",
+        lambda: rules.evaluate_rule_template({"type": "attack", "weapon": {"damage": "2d6"}}, HERO, GOBLIN, rng=rng),
+        number=500,
+    )
+
+    for extra in INTENT_VOCABULARY_SIZES:
+        table = _intent_table(extra)
+        matcher = intents.IntentMatcher(table)
+        patterns = [intents.normalize(p) for spec in table["intents"].values() for p in spec.get("en", []) + spec.get("ja", [])]
+        texts = [intents.normalize(text) for text in INTENT_INPUTS]
+        bench.measure("intents.compile", lambda: intents.IntentMatcher(table), repeat=5, patterns=matcher.size)
+        for mode in ("automaton", "substring"):
+            if mode == "automaton":
+                func = lambda: [matcher.match(text) for text in INTENT_INPUTS]
+            else:
+                # 比較用: パターンごとに部分文字列検索する素朴な実装（語彙数に比例）
+                func = lambda: [[p for p in patterns if p in text] for text in texts]
+            bench.measure("intents.match", func, number=50, patterns=matcher.size, mode=mode)
+
+    with (scenario.DEFAULT_DIR / "ruins.json").open(encoding="utf-8") as fh:
+        spec = json.load(fh)
+    story = scenario.Scenario(spec)
+    bench.measure("scenario.compile", lambda: scenario.Scenario(spec), number=50, scenes=len(story.scenes))
+    for scene, choice_id, text in SCENARIO_TURNS:
+        snapshot = _scenario_snapshot(scene)
+        bench.measure(
+            "scenario.resolve",
+            lambda snapshot=snapshot, choice_id=choice_id, text=text: story.resolve(
+                SpeculativeToolset(snapshot), snapshot, text, choice_id
+            ),
+            number=200,
+            scene=scene,
+            choice=choice_id or "intent",
+        )
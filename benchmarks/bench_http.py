@@ -0,0 +1,152 @@
+"""HTTP load scenarios: concurrent clients driving /api/gm/turn with the SimpleNarrator, on an
+in-process threaded server and on the pre-fork server (``trpg_app.server``) per worker count.
+
+Pre-fork throughput only scales while the workers are the bottleneck: the router, every
+worker and the load-generating client threads each need a core, and every turn commits to
+one SQLite file (single writer). Each ``gm_turn_prefork`` record carries ``cpus`` and
+``oversubscribed`` (fewer cores than workers + router + client process); oversubscribed
+runs measure time-slicing on the same cores, not scaling. On a 1-core box 1 and 2 workers
+land within noise of each other (about 35-44 req/s for the SimpleNarrator turn).
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from .harness import summarize
+
+PLAYER_INPUTS = ["search the room", "attack the goblin", "wait and listen"]
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _post(base_url: str, path: str, body: Dict) -> Dict:
+    req = urllib.request.Request(
+        base_url + path,
+        data=json.dumps(body).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(req, timeout=30) as resp:
+        return json.loads(resp.read())
+
+
+class _QuietHandler(WSGIRequestHandler):
+    # リクエストごとのアクセスログで計測結果が埋もれないようにする
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def start_server(app):
+    """ローカルのスレッド型 WSGI サーバーを空きポートで起動し (server, base_url) を返す。"""
+    server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=_QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def start_prefork(workers: int):
+    """pre-fork サーバーを別プロセスで空きポートに起動し (process, base_url) を返す。DB は一時ファイル。"""
+    workdir = tempfile.mkdtemp(prefix="trpg-prefork-")
+    env = dict(os.environ, TRPG_DB_PATH=os.path.join(workdir, "prefork.db"))
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "trpg_app.server", "--workers", str(workers), "--port", "0"],
+        cwd=ROOT,
+        env=env,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    for line in proc.stderr:
+        match = re.search(r"listening on (http://\S+)", line)
+        if match:
+            # 以降のログでパイプが詰まらないよう読み捨て続ける
+            threading.Thread(target=proc.stderr.read, daemon=True).start()
+            return proc, match.group(1)
+    raise RuntimeError(f"pre-fork server exited with {proc.wait()}")
+
+
+def stop_prefork(proc) -> None:
+    proc.terminate()
+    proc.wait(timeout=60)
+
+
+def setup_session(base_url: str) -> str:
+    # PC と敵を 1 体ずつ持つセッションを API 経由で作る
+    session = _post(base_url, "/api/session", {"name": "load"})
+    for name, hp in (("Hero", 12), ("Goblin", 400)):
+        _post(
+            base_url,
+            "/api/character",
+            {"session_id": session["id"], "name": name, "base_stats": {"STR": 14, "DEX": 12, "WIS": 12}, "resources": {"hp": hp, "max_hp": hp}},
+        )
+    return session["id"]
+
+
+def drive_turns(base_url: str, session_ids: List[str], turns_per_client: int) -> Dict:
+    """クライアント 1 つ = 1 セッションで並行にターンを送り、レイテンシとスループットを返す。"""
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def client(session_id: str) -> None:
+        local = []
+        for i in range(turns_per_client):
+            start = time.perf_counter()
+            _post(base_url, "/api/gm/turn", {"session_id": session_id, "player_input": PLAYER_INPUTS[i % len(PLAYER_INPUTS)]})
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(session_ids)) as pool:
+        list(pool.map(client, session_ids))
+    elapsed = time.perf_counter() - start
+    stats = summarize(latencies)
+    stats["throughput_rps"] = len(latencies) / elapsed
+    return stats
+
+
+def run(bench) -> None:
+    os.environ.pop("USE_DEEPAGENTS", None)  # SimpleNarrator 固定
+    import app as app_module
+
+    server, base_url = start_server(app_module.app)
+    try:
+        turns = 10 if bench.quick else 40
+        for clients in (1, 4):
+            session_ids = [setup_session(base_url) for _ in range(clients)]
+            stats = drive_turns(base_url, session_ids, turns)
+            bench.record("gm_turn", stats, clients=clients, turns_per_client=turns)
+    finally:
+        server.shutdown()
+
+    # ワーカー数ごとのスループット（セッション単位で振り分けるので、クライアント数はワーカー数より多めに）
+    clients = 8
+    cpus = os.cpu_count() or 1
+    for workers in (1, 2) if bench.quick else (1, 2, 4):
+        proc, base_url = start_prefork(workers)
+        try:
+            session_ids = [setup_session(base_url) for _ in range(clients)]
+            stats = drive_turns(base_url, session_ids, turns)
+            # ワーカー・ルーター・負荷をかける側で 1 コアずつ要る。足りなければスケールの測定にならない
+            bench.record(
+                "gm_turn_prefork",
+                stats,
+                workers=workers,
+                clients=clients,
+                turns_per_client=turns,
+                cpus=cpus,
+                oversubscribed=cpus < workers + 2,
+            )
+        finally:
+            stop_prefork(proc)
@@ -0,0 +1,95 @@
+"""Semantic memory benchmarks: embedding, incremental append and top-k recall at 10k/100k memories."""
+
+from __future__ import annotations
+
+import math
+import os
+import random
+import tempfile
+
+from trpg_app import memory
+
+SIZES = (10_000, 100_000)
+# 純 Python のスキャン（比較用）はこの件数まで
+SCAN_MAX = 10_000
+BATCH = 1_000
+QUERIES = {
+    "en": "what did the innkeeper say about the silver amulet",
+    "ja": "洞窟で見つけた古い地図",
+}
+
+_PEOPLE = ["innkeeper", "goblin chief", "old priest", "smuggler", "knight", "witch", "ferryman", "archivist"]
+_PLACES = ["tavern", "ruined chapel", "harbor", "catacombs", "watchtower", "market", "swamp", "洞窟", "神殿", "城門"]
+_THINGS = ["silver amulet", "rusted key", "map", "lantern", "poisoned dagger", "sealed letter", "古い地図", "呪われた剣"]
+_VERBS = ["ask about", "search for", "hide", "trade", "steal", "examine", "調べる", "探す"]
+
+
+def _texts(count: int, seed: int = 7):
+    # 人物・場所・物を組み合わせた合成のターン（英語と日本語の混在）
+    rng = random.Random(seed)
+    for i in range(count):
+        person, place, thing, verb = rng.choice(_PEOPLE), rng.choice(_PLACES), rng.choice(_THINGS), rng.choice(_VERBS)
+        yield (
+            i + 1,
+            i + 1,
+            f"I {verb} the {thing} with the {person}",
+            f"In the {place}, the {person} eyes the {thing} warily. Turn {i} passes as rain drums on the roof.",
+        )
+
+
+def _build(directory: str, count: int) -> memory.SessionIndex:
+    index = memory.SessionIndex(os.path.join(directory, f"s{count}"), memory.make_embedder("hashing"))
+    batch = []
+    for row in _texts(count):
+        batch.append(row)
+        if len(batch) >= BATCH:
+            index.add(batch)
+            batch = []
+    index.add(batch)
+    return index
+
+
+def _scan_baseline(index: memory.SessionIndex):
+    # numpy を使わない素朴な実装: 疎ベクトル（dict）を全件なめて内積を取る
+    vectors, _ = index._maps()
+    rows = [{int(j): float(v[j]) for j in v.nonzero()[0]} for v in vectors]
+    idf = [math.log((index.count + 1) / (int(df) + 1)) + 1.0 for df in index.df]
+
+    def search(query: str, k: int = memory.TOP_K):
+        q = {j: float(v) * idf[j] for j, v in enumerate(index.embedder.embed([query])[0]) if v}
+        scored = sorted(((sum(w * row.get(j, 0.0) for j, w in q.items()), i) for i, row in enumerate(rows)), reverse=True)
+        return scored[:k]
+
+    return search
+
+
+def _disk_bytes(index: memory.SessionIndex) -> dict:
+    names = ("vectors.f32", "meta.i64", "texts.bin", "index.json")
+    total = sum(os.path.getsize(os.path.join(index.path, name)) for name in names)
+    return {"bytes": total, "memories": index.count, "bytes_per_memory": total / index.count}
+
+
+def run(bench) -> None:
+    try:
+        memory._numpy()
+    except ImportError:
+        return
+    directory = tempfile.mkdtemp(prefix="trpg-memory-")
+    embedder = memory.make_embedder("hashing")
+    texts = [f"{player_input}\n{narration}" for _, _, player_input, narration in _texts(100)]
+    bench.measure("embed", lambda: embedder.embed(texts), number=5, batch=len(texts))
+    for count in SIZES[:1] if bench.quick else SIZES:
+        index = _build(directory, count)
+        next_id = [count]
+
+        def add_one():
+            next_id[0] += 1
+            index.add([(next_id[0], next_id[0], "I search for the rusted key", "The ferryman shrugs.")])
+
+        bench.measure("add", add_one, number=20, memories=count)
+        for kind, query in QUERIES.items():
+            bench.measure("search", lambda: index.search(query, memory.TOP_K), number=20, memories=count, query=kind, mode="numpy")
+            if count <= SCAN_MAX:
+                scan = _scan_baseline(index)
+                bench.measure("search", lambda: scan(query), number=1, repeat=3, memories=count, query=kind, mode="python")
+        bench.record("disk_size", _disk_bytes(index), unit="bytes", memories=count)
@@ -0,0 +1,232 @@
+"""Service-level benchmarks against a throwaway SQLite database (see run.py for DB setup)."""
+
+from __future__ import annotations
+
+import itertools
+import os
+import time
+from typing import Iterator, Tuple
+
+from trpg_app import gm_agent, logwriter, model_backends, resilience, services, speculation, tool_executor, tools
+
+from .harness import summarize
+
+SESSION_SIZES = (10, 1_000, 10_000)
+
+
+def _seed_records(turns: int) -> Iterator[Tuple[str, dict]]:
+    # import_session_records 形式で大量のターンを 1 トランザクションで流し込む
+    yield "session", {"name": f"bench-{turns}"}
+    yield "character", {"id": "hero", "name": "Hero", "base_stats": {"STR": 16, "DEX": 12}, "resources": {"hp": 12, "max_hp": 12}}
+    yield "character", {"id": "goblin", "name": "Goblin", "resources": {"hp": 7, "max_hp": 7}}
+    for turn_no in range(1, turns + 1):
+        yield "dice_log", {"expression": "skill:perception", "result": {"rolls": [{"type": "dice", "rolls": [11]}], "total": 13}}
+        yield "turn_log", {
+            "turn_no": turn_no,
+            "player_input": f"search the room #{turn_no}",
+            "gm_output": {
+                "narration": "You scour the area and spot a hidden lever beneath some debris.",
+                "choices": [{"id": "pull_lever", "text": "Pull the lever"}, {"id": "ignore", "text": "Ignore it for now"}],
+                "log": ["perception check vs DC 12: success"],
+                "mode": "simple",
+            },
+            "dice_results": [{"type": "dice", "notation": "1d20", "rolls": [11], "total": 11}],
+            "world_diff": {"found_lever": True},
+        }
+
+
+def seed_session(turns: int) -> str:
+    return services.import_session_records(_seed_records(turns))["session_id"]
+
+
+# 履歴検索: 長いキャンペーンのターン数と、(検索語, 種類) の組
+HISTORY_SIZES = (1_000, 100_000)
+HISTORY_QUERIES = (("goblin", "common"), ("emerald key", "rare"), ("洞窟", "short"))
+HISTORY_WORDS = ("goblin", "lever", "corridor", "torch", "shadow", "blade", "door", "stone", "water", "stairs", "guard", "ruin")
+HISTORY_WORDS_JA = ("洞窟", "ゴブリン", "宝箱", "扉", "松明", "階段", "水", "影")
+
+
+def _history_records(turns: int) -> Iterator[Tuple[str, dict]]:
+    # 語の組み合わせをターンごとに変えた履歴（決定的）。珍しい語は 1 ターンにだけ入れる
+    yield "session", {"name": f"history-{turns}"}
+    for turn_no in range(1, turns + 1):
+        words = [HISTORY_WORDS[(turn_no * k) % len(HISTORY_WORDS)] for k in (1, 3, 7, 11)]
+        narration = f"The {words[0]} by the {words[1]} catches the light of your {words[2]}; a {words[3]} waits. "
+        narration += HISTORY_WORDS_JA[turn_no % len(HISTORY_WORDS_JA)] + "の先で" + HISTORY_WORDS_JA[(turn_no * 3) % len(HISTORY_WORDS_JA)] + "が揺れる。"
+        if turn_no == turns // 2:
+            narration += " Under the altar lies an emerald key."
+        yield "turn_log", {"turn_no": turn_no, "player_input": f"look at the {words[3]}", "gm_output": {"narration": narration}}
+
+
+def run(bench) -> None:
+    sizes = SESSION_SIZES[:2] if bench.quick else SESSION_SIZES
+    for turns in sizes:
+        session_id = seed_session(turns)
+        repeat = 20 if turns < 10_000 else 5
+        bench.measure("get_session", lambda: services.get_session(session_id), repeat=repeat, turns=turns)
+        # キャッシュを通さず SQLite から組み立て直す場合
+        bench.measure("get_session_uncached", lambda: services._load_session(session_id), repeat=repeat, turns=turns)
+
+    # ターン履歴の検索（FTS5）。比較用に、全ターンを読み出して Python で部分一致を探す場合も測る
+    for turns in HISTORY_SIZES[:1] + ((10_000,) if bench.quick else HISTORY_SIZES[1:]):
+        session_id = services.import_session_records(_history_records(turns))["session_id"]
+        for query, kind in HISTORY_QUERIES:
+            bench.measure("search_history", lambda: services.search_history(session_id, query, 5), repeat=10, turns=turns, query=kind, mode="fts5")
+            if turns <= 10_000:
+                bench.measure(
+                    "search_history",
+                    lambda: [
+                        row["id"]
+                        for row in services.list_turn_logs(session_id)
+                        if query in (row["player_input"] or "") or query in (row["gm_output"].get("narration") or "")
+                    ][:5],
+                    repeat=3,
+                    turns=turns,
+                    query=kind,
+                    mode="scan",
+                )
+
+    session_id = seed_session(10)
+    bench.measure(
+        "create_character",
+        lambda: services.create_character(
+            session_id,
+            name="Bench",
+            base_stats={"STR": 12, "DEX": 14, "CON": 10, "INT": 10, "WIS": 12, "CHA": 10},
+            resources={"hp": 10, "max_hp": 10},
+        ),
+        number=10,
+    )
+    bench.measure(
+        "log_turn",
+        lambda: services.log_turn(
+            session_id=session_id,
+            player_input="search",
+            gm_output={"narration": "The story advances.", "choices": [], "log": [], "mode": "simple"},
+            dice_results=[],
+            world_diff={},
+        ),
+        number=10,
+    )
+    bench.measure(
+        "log_dice",
+        lambda: services.log_dice(session_id, "1d20", {"total": 11, "rolls": [{"rolls": [11]}]}),
+        number=10,
+    )
+
+    # グループコミット: 1 ターン分（ダイス 4 回）を積んでからまとめてコミットする
+    writer = logwriter.LogWriter(services._write_log_batch, durable=False)
+
+    def dice_turn_batched():
+        for _ in range(4):
+            writer.submit(("dice_log", {"session_id": session_id, "expression": "1d20", "result": '{"total": 11}', "created_at": services._now()}))
+        writer.flush()
+
+    bench.measure(
+        "log_dice_turn",
+        lambda: [services.log_dice(session_id, "1d20", {"total": 11}) for _ in range(4)],
+        writer="sync",
+    )
+    bench.measure("log_dice_turn", dice_turn_batched, writer="batch")
+    writer.close()
+
+    # GM ターンのオーケストレーション（ツール呼び出し・DB 書き込み・ツール結果の JSON 往復）。偽モデルは遅延 0
+    session_id = seed_session(10)
+    original_routing = gm_agent.ROUTING
+    original_deep_agents = os.environ.get("USE_DEEPAGENTS")
+    os.environ["USE_DEEPAGENTS"] = "1"
+    try:
+        for backend in ("simple", "fake"):
+            for player_input in ("attack the goblin", "search the room"):
+
+                def gm_turn():
+                    agent = gm_agent.GMAgent(services.get_session(session_id))
+                    if backend == "fake":
+                        agent.deep_agent = model_backends.FakeModel(agent.draft, latency=0, token_latency=0)
+                    agent.take_turn(player_input, None)
+
+                gm_agent.ROUTING = "off" if backend == "fake" else "tiered"
+                bench.measure("gm_agent_turn", gm_turn, number=5, backend=backend, player_input=player_input)
+
+        # 振り分けあり/なしの 1 ターン平均（偽モデルは 1 ステップ 20ms。ルールで解ける入力と自由記述を混ぜる）
+        inputs = itertools.cycle(["search the room", "roll perception", "I ask the innkeeper about the old ruins", "attack the goblin"])
+
+        def mixed_turn():
+            agent = gm_agent.GMAgent(services.get_session(session_id))
+            agent.deep_agent = model_backends.FakeModel(agent.draft, latency=0.02, token_latency=0)
+            agent.take_turn(next(inputs), None)
+
+        for routing in ("off", "tiered"):
+            gm_agent.ROUTING = routing
+            bench.measure("gm_turn_routing", mixed_turn, number=8, routing=routing)
+
+        # プロバイダ障害時（偽モデルが締め切り 50ms を超えて応答しない）の 1 ターン。ブレーカーなし/あり
+        gm_agent.ROUTING = "off"
+        original_deadline = resilience.TURN_DEADLINE_SECONDS
+        breaker = resilience.breaker(gm_agent._model_name())
+        original_failures = breaker.failures
+        resilience.TURN_DEADLINE_SECONDS = 0.05
+
+        def outage_turn():
+            agent = gm_agent.GMAgent(services.get_session(session_id))
+            agent.deep_agent = model_backends.FakeModel(agent.draft, latency=0.2, token_latency=0)
+            agent.take_turn("I ask the innkeeper about the old ruins", None)
+
+        try:
+            for failures in (10**9, 3):
+                breaker.failures = failures
+                breaker.record(0.0)  # 閉じた状態から測る
+                bench.measure("gm_turn_outage", outage_turn, number=5, breaker="off" if failures == 10**9 else "on")
+        finally:
+            resilience.TURN_DEADLINE_SECONDS = original_deadline
+            breaker.failures = original_failures
+            breaker.record(0.0)
+
+        # 選択肢を選んだターンの応答時間。先読みなし/あり（偽モデル 1 ステップ 20ms。選ぶまでの読み時間は計測外）
+        gm_agent.ROUTING = "tiered"
+        original_model = os.environ.get("GM_MODEL")
+        os.environ["GM_MODEL"] = "bench-fake"
+        model_backends.register("bench-fake", lambda toolset, model_name: model_backends.FakeModel(toolset, latency=0.02, token_latency=0))
+        choices = [{"id": "explore", "text": "Explore the corridor"}, {"id": "rest", "text": "Take a short rest"}]
+        try:
+            for speculate in (False, True):
+                speculator = speculation.Speculator(top_k=2, workers=2) if speculate else None
+                samples = []
+                for _ in range(5 if bench.quick else 20):
+                    if speculator is not None:
+                        speculator.schedule(session_id, choices)
+                        time.sleep(0.2)
+                    session = services.get_session(session_id)
+                    start = time.perf_counter()
+                    agent = gm_agent.GMAgent(session)
+                    if speculator is None or speculator.claim(session, "", "explore", agent.toolset) is None:
+                        agent.take_turn("", "explore")
+                    samples.append(time.perf_counter() - start)
+                if speculator is not None:
+                    speculator.close()
+                bench.record("gm_choice_turn", summarize(samples), speculation="on" if speculate else "off")
+        finally:
+            model_backends.BACKENDS.pop("bench-fake", None)
+            if original_model is None:
+                os.environ.pop("GM_MODEL", None)
+            else:
+                os.environ["GM_MODEL"] = original_model
+    finally:
+        gm_agent.ROUTING = original_routing
+        if original_deep_agents is None:
+            os.environ.pop("USE_DEEPAGENTS", None)
+        else:
+            os.environ["USE_DEEPAGENTS"] = original_deep_agents
+
+    # 1 ステップに独立したツール呼び出しが 3 つ（状態参照 + 別キャラの技能判定 2 回）。逐次と並行の比較
+    session_id = seed_session(10)
+    hero, goblin = (c["id"] for c in services.get_session(session_id)["characters"])
+    step = [
+        ("query_game_state", {}),
+        ("request_skill_check", {"actor_id": hero, "skill": "perception", "dc": 12}),
+        ("request_skill_check", {"actor_id": goblin, "skill": "stealth", "dc": 12}),
+    ]
+    for workers in (1, 4):
+        toolset = tools.Toolset(session_id)
+        executor = tool_executor.ToolExecutor(toolset, max_workers=workers)
+        bench.measure("tool_step", lambda: executor.run(step), number=10, workers=workers)
@@ -0,0 +1,66 @@
+"""Cold-start benchmarks: ``python -X importtime`` of the worker entry points, with a budget check."""
+
+from __future__ import annotations
+
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Tuple
+
+from .harness import summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# ワーカー起動（import app）に許す時間。超えた計測があれば run.py が終了コード 1 を返す
+IMPORT_BUDGET_SECONDS = float(os.getenv("TRPG_IMPORT_BUDGET_MS", "1500")) / 1000
+MODULES = ("app", "trpg_app.services", "trpg_app.gm_agent")
+_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def _import_once(module: str) -> Tuple[float, float, Dict[str, float], bool]:
+    # 新しいインタプリタで module を import し、(壁時計秒, importtime の累計秒, 自パッケージの内訳, DB を作ったか) を返す
+    workdir = tempfile.mkdtemp(prefix="trpg-startup-")
+    env = dict(os.environ, TRPG_DB_PATH=os.path.join(workdir, "startup.db"))
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    wall = time.perf_counter() - start
+    cumulative = 0.0
+    own: Dict[str, float] = {}
+    for match in _LINE.finditer(proc.stderr):
+        name = match.group(4)
+        if name == module:
+            cumulative = int(match.group(2)) / 1e6
+        if name == "app" or name.startswith("trpg_app"):
+            own[name] = int(match.group(1)) / 1e6
+    return wall, cumulative, own, bool(os.listdir(workdir))
+
+
+def run(bench) -> None:
+    repeat = 3 if bench.quick else 10
+    for module in MODULES:
+        runs = [_import_once(module) for _ in range(repeat)]
+        imports = summarize([cumulative for _, cumulative, _, _ in runs])
+        bench.record(
+            "import_time",
+            {
+                **imports,
+                "budget": IMPORT_BUDGET_SECONDS,
+                "within_budget": imports["median"] <= IMPORT_BUDGET_SECONDS,
+                # import だけで DB ファイルを作っていないこと（起動時の副作用なし）
+                "side_effect_free": not any(created for _, _, _, created in runs),
+            },
+            module=module,
+        )
+        bench.record("process_start", summarize([wall for wall, _, _, _ in runs]), module=module)
+        # 自パッケージ分の self 時間（どのモジュールが重くなったかを追えるように）
+        own = runs[-1][2]
+        bench.record("own_modules", {"self_seconds": round(sum(own.values()), 6), **own}, unit="breakdown", module=module)
@@ -0,0 +1,134 @@
+"""Shared timing harness and machine-readable result handling for the benchmark suites."""
+
+from __future__ import annotations
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    # 最近傍法のパーセンタイル（サンプル数が少なくても安定する）
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    # 1 回あたりの所要時間（秒）のサンプルから統計値を作る
+    ordered = sorted(samples)
+    mean = statistics.fmean(ordered)
+    return {
+        "n": len(ordered),
+        "min": ordered[0],
+        "median": statistics.median(ordered),
+        "mean": mean,
+        "p95": _percentile(ordered, 95),
+        "p99": _percentile(ordered, 99),
+        "max": ordered[-1],
+        "ops_per_sec": 1.0 / mean if mean else 0.0,
+    }
+
+
+class Harness:
+    """計測結果を集めて JSON に書き出すランナー。"""
+
+    def __init__(self, quick: bool = False, verbose: bool = True):
+        self.quick = quick
+        self.verbose = verbose
+        self.results: List[Dict[str, Any]] = []
+        self.suite = ""
+
+    def measure(
+        self,
+        name: str,
+        func: Callable[[], Any],
+        number: int = 1,
+        repeat: int = 20,
+        warmup: int = 1,
+        **params,
+    ) -> Dict[str, Any]:
+        """func を number 回まとめて呼ぶ計測を repeat 回行い、1 回あたりの秒数で記録する。"""
+        if self.quick:
+            repeat = max(3, repeat // 4)
+        for _ in range(warmup):
+            func()
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            samples.append((time.perf_counter() - start) / number)
+        return self.record(name, summarize(samples), unit="s", **params)
+
+    def record(self, name: str, stats: Dict[str, Any], unit: str = "s", **params) -> Dict[str, Any]:
+        # 任意の計測結果（スループットなど）をそのまま記録する
+        entry = {"suite": self.suite, "name": name, "params": params, "unit": unit, **stats}
+        self.results.append(entry)
+        if self.verbose:
+            if unit == "s":
+                detail = f"median {stats['median'] * 1e6:10.1f} us  p95 {stats['p95'] * 1e6:10.1f} us"
+                if "throughput_rps" in stats:
+                    detail += f"  {stats['throughput_rps']:.1f} req/s"
+            else:
+                detail = "  ".join(f"{k} {v:.3f}" if isinstance(v, float) else f"{k} {v}" for k, v in stats.items())
+            label = f"{self.suite}.{name}" + (f" {params}" if params else "")
+            print(f"{label:<60} {detail}", file=sys.stderr)
+        return entry
+
+    def write(self, path: Optional[str]) -> Dict[str, Any]:
+        # 実行環境のメタ情報付きで結果を保存（path が None なら stdout）
+        payload = {"meta": _meta(self.quick), "results": self.results}
+        text = json.dumps(payload, ensure_ascii=False, indent=2)
+        if path:
+            with open(path, "w", encoding="utf-8") as fh:
+                fh.write(text + "\n")
+        else:
+            print(text)
+        return payload
+
+
+def _meta(quick: bool) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5
+        ).stdout.strip()
+    except Exception:
+        commit = ""
+    return {
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "commit": commit,
+        "quick": quick,
+    }
+
+
+def result_key(entry: Dict[str, Any]) -> str:
+    # 実行間で同じ計測を突き合わせるキー
+    params = ",".join(f"{k}={entry['params'][k]}" for k in sorted(entry.get("params") or {}))
+    return f"{entry['suite']}.{entry['name']}[{params}]"
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float = 0.10) -> List[Dict[str, Any]]:
+    """2 回分の結果を比較し、中央値が threshold 以上悪化した計測を返す。"""
+    base = {result_key(e): e for e in baseline.get("results", [])}
+    regressions = []
+    for entry in current.get("results", []):
+        old = base.get(result_key(entry))
+        if not old or "median" not in entry or "median" not in old or not old["median"]:
+            continue
+        ratio = entry["median"] / old["median"]
+        # 時間系は大きいほど悪化、スループット系（unit != "s"）は小さいほど悪化
+        worse = ratio - 1 if entry.get("unit") == "s" else (1 / ratio - 1 if ratio else float("inf"))
+        if worse > threshold:
+            regressions.append({"key": result_key(entry), "baseline": old["median"], "current": entry["median"], "change": worse})
+    return regressions
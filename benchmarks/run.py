@@ -0,0 +1,68 @@
+"""Benchmark entry point.
+
+    python -m benchmarks.run                       # 全スイートを実行して JSON を stdout へ
+    python -m benchmarks.run --suite core --out bench.json
+    python -m benchmarks.run --out new.json --compare old.json   # 中央値が 10% 以上悪化したら終了コード 1
+"""
+
+from __future__ import annotations
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import tempfile
+
+from .harness import Harness, compare
+
+# スイート名 -> モジュール（各モジュールは run(bench) を持つ）
+SUITES = {
+    "core": "benchmarks.bench_core",
+    "services": "benchmarks.bench_services",
+    "http": "benchmarks.bench_http",
+    "codec": "benchmarks.bench_codec",
+    "memory": "benchmarks.bench_memory",
+    "startup": "benchmarks.bench_startup",
+}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Run TRPG benchmarks and emit machine-readable results.")
+    parser.add_argument("--suite", action="append", choices=sorted(SUITES), help="suite to run (repeatable; default: all)")
+    parser.add_argument("--out", help="write JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed median slowdown ratio (default 0.10)")
+    parser.add_argument("--quick", action="store_true", help="fewer repetitions and smaller datasets")
+    args = parser.parse_args(argv)
+
+    # 本番 DB を汚さないよう、trpg_app を import する前に一時 DB を指定する
+    workdir = tempfile.mkdtemp(prefix="trpg-bench-")
+    os.environ["TRPG_DB_PATH"] = os.path.join(workdir, "bench.db")
+    from trpg_app import db
+
+    db.init_db()
+
+    bench = Harness(quick=args.quick)
+    for name in args.suite or list(SUITES):
+        bench.suite = name
+        importlib.import_module(SUITES[name]).run(bench)
+    payload = bench.write(args.out)
+
+    # 起動時間の予算超過や import 時の副作用は比較対象がなくても失敗扱い
+    failed = [e for e in payload["results"] if e.get("within_budget") is False or e.get("side_effect_free") is False]
+    for entry in failed:
+        print(f"BUDGET {entry['suite']}.{entry['name']} {entry['params']}: median {entry['median']:.3f}s"
+              f" (budget {entry['budget']:.3f}s, side_effect_free={entry['side_effect_free']})", file=sys.stderr)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fh:
+            baseline = json.load(fh)
+        regressions = compare(baseline, payload, args.threshold)
+        for reg in regressions:
+            print(f"REGRESSION {reg['key']}: {reg['baseline']:.6g} -> {reg['current']:.6g} (+{reg['change']:.0%})", file=sys.stderr)
+        return 1 if regressions or failed else 0
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
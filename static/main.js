@@ -10,6 +10,13 @@
 
   let currentSessionId = localStorage.getItem("trpg_session_id") || "";
   let currentCharacterId = "";
+  // ダイスログの ETag（セッションのバージョン）。変化がなければサーバーは 304 を返す
+  let diceLogEtag = "";
+  // SSE で受け取った変更を反映するための手元の状態
+  let currentState = null;
+  let diceEntries = [];
+  let stateVersion = 0;
+  let eventSource = null;
 
   if (currentSessionId) {
     sessionIdInput.value = currentSessionId;
@@ -83,16 +90,11 @@
     const text = document.getElementById("playerInput").value;
     appendLog("player", text);
     document.getElementById("playerInput").value = "";
-    const resp = await fetch("/api/gm/turn", {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ session_id: currentSessionId, player_input: text }),
-    });
-    const data = await resp.json();
+    const data = await postTurn({ session_id: currentSessionId, player_input: text, state_version: stateVersion });
+    if (!data) return;
     if (data.narration) appendLog("gm", data.narration, data.log);
     renderChoices(data.choices || []);
-    if (data.state) renderState(data.state);
-    loadDiceLog();
+    applyTurnState(data);
   };
 
   document.getElementById("rollBtn").onclick = async () => {
@@ -108,7 +110,7 @@
     } else if (data.error) {
       appendLog("system", `Error rolling dice: ${data.error}`);
     }
-    loadDiceLog();
+    refreshDiceLog();
   };
 
   function renderChoices(choices) {
@@ -122,16 +124,69 @@
   }
 
   async function sendChoice(choiceId) {
-    const resp = await fetch("/api/gm/turn", {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ session_id: currentSessionId, selected_choice_id: choiceId }),
-    });
-    const data = await resp.json();
+    const data = await postTurn({ session_id: currentSessionId, selected_choice_id: choiceId, state_version: stateVersion });
+    if (!data) return;
     if (data.narration) appendLog("gm", data.narration, data.log);
     renderChoices(data.choices || []);
-    if (data.state) renderState(data.state);
-    loadDiceLog();
+    applyTurnState(data);
+  }
+
+  // 応答待ちの GM ターン（本文 -> Idempotency-Key）。同じ内容の再クリックは送らず、通信エラー時は同じキーで 1 回だけ再送する
+  const pendingTurns = new Map();
+
+  function newIdempotencyKey() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+  }
+
+  async function postTurn(body) {
+    const payload = JSON.stringify(body);
+    if (pendingTurns.has(payload)) return null;
+    const key = newIdempotencyKey();
+    pendingTurns.set(payload, key);
+    try {
+      for (let attempt = 0; ; attempt++) {
+        try {
+          const resp = await fetch("/api/gm/turn", {
+            method: "POST",
+            headers: { "Content-Type": "application/json", "Idempotency-Key": key },
+            body: payload,
+          });
+          return await resp.json();
+        } catch (err) {
+          if (attempt >= 1) throw err;
+        }
+      }
+    } finally {
+      pendingTurns.delete(payload);
+    }
+  }
+
+  function applyTurnState(data) {
+    // GM ターン応答の状態を反映。通常は差分（state_patch）、手元の版が古いときだけ全体（state）が届く
+    if (data.state) {
+      renderState(data.state);
+      refreshDiceLog();
+      return;
+    }
+    const patch = data.state_patch;
+    if (!patch) return;
+    if (stateVersion >= patch.version) return; // SSE で反映済み
+    if (stateVersion < patch.base_version || !currentState) {
+      loadSession(currentSessionId, true);
+      return;
+    }
+    const chars = (currentState.characters || []).map(
+      (c) => (patch.characters || []).find((u) => u.id === c.id) || c
+    );
+    renderState({
+      ...currentState,
+      characters: chars,
+      world_facts: { ...(currentState.world_facts || {}), ...(patch.world_facts || {}) },
+    });
+    const fresh = (patch.dice || []).filter((d) => !diceEntries.some((e) => e.id === d.id));
+    if (fresh.length) renderDiceLog([...fresh, ...diceEntries].slice(0, 50));
+    stateVersion = patch.version;
   }
 
   function appendLog(role, text, extra) {
@@ -153,12 +208,54 @@
   }
 
   function setSession(session) {
+    const changed = session.id !== currentSessionId || !eventSource;
+    if (session.id !== currentSessionId) diceLogEtag = "";
     currentSessionId = session.id;
     sessionIdInput.value = session.id;
     localStorage.setItem("trpg_session_id", session.id);
     sessionInfo.innerHTML = `Session ID: <span class="tag">${session.id}</span>`;
+    stateVersion = session.version || 0;
     renderState(servicesStateFromSession(session));
     renderDiceLog(session.dice_logs || []);
+    if (changed) subscribeEvents(session.id);
+  }
+
+  function subscribeEvents(id) {
+    // セッションの変更をサーバーから push で受け取る（再接続は EventSource が自動で行う）
+    if (eventSource) eventSource.close();
+    if (!window.EventSource) return;
+    eventSource = new EventSource(`/api/session/${id}/events`);
+    eventSource.onmessage = (msg) => applyEvent(JSON.parse(msg.data));
+  }
+
+  function applyEvent(ev) {
+    if (ev.type === "hello") {
+      if (ev.version !== stateVersion) loadSession(currentSessionId, true);
+      return;
+    }
+    if (ev.type === "resync") {
+      loadSession(currentSessionId, true);
+      return;
+    }
+    if (ev.version) stateVersion = Math.max(stateVersion, ev.version);
+    if (ev.type === "dice" && ev.entry) {
+      if (!diceEntries.some((e) => e.id === ev.entry.id)) {
+        renderDiceLog([ev.entry, ...diceEntries].slice(0, 50));
+      }
+    } else if (ev.type === "character" && ev.character && currentState) {
+      const chars = (currentState.characters || []).filter((c) => c.id !== ev.character.id);
+      const index = (currentState.characters || []).findIndex((c) => c.id === ev.character.id);
+      chars.splice(index < 0 ? chars.length : index, 0, ev.character);
+      renderState({ ...currentState, characters: chars });
+    } else if (ev.type === "world_facts" && currentState) {
+      renderState({ ...currentState, world_facts: ev.world_facts || {} });
+    }
+  }
+
+  function refreshDiceLog() {
+    // push が届いていればダイス欄は更新済みなので取り直さない
+    if (eventSource && eventSource.readyState === EventSource.OPEN) return;
+    loadDiceLog();
   }
 
   function servicesStateFromSession(session) {
@@ -177,12 +274,12 @@
     };
   }
 
-  async function loadSession(id) {
+  async function loadSession(id, quiet) {
     const resp = await fetch(`/api/session/${id}`);
     const data = await resp.json();
     if (data.id) {
       setSession(data);
-      appendLog("system", `Loaded session ${data.id}`);
+      if (!quiet) appendLog("system", `Loaded session ${data.id}`);
     } else if (data.error) {
       appendLog("system", data.error);
     }
@@ -190,6 +287,8 @@
 
   function renderState(state) {
     if (!state) return;
+    currentState = state;
+    if (state.version) stateVersion = Math.max(stateVersion, state.version);
     let html = `<div><strong>${state.name || "Session"}</strong> (${state.session_id})</div>`;
     (state.characters || []).forEach((c) => {
       html += `<div>${c.name || "PC"} — HP ${c.hp}/${c.max_hp || c.hp} | AC ${c.ac || "-"}</div>`;
@@ -206,6 +305,7 @@
   }
 
   function renderDiceLog(entries) {
+    diceEntries = entries || [];
     diceLogEl.innerHTML = "";
     (entries || []).forEach((e) => {
       const div = document.createElement("div");
@@ -216,8 +316,11 @@
 
   async function loadDiceLog() {
     if (!currentSessionId) return;
-    const resp = await fetch(`/api/session/${currentSessionId}`);
+    const headers = diceLogEtag ? { "If-None-Match": diceLogEtag } : {};
+    const resp = await fetch(`/api/session/${currentSessionId}/dice_logs`, { headers, cache: "no-store" });
+    if (resp.status === 304) return;
     const data = await resp.json();
+    diceLogEtag = resp.headers.get("ETag") || "";
     if (data.dice_logs) renderDiceLog(data.dice_logs);
   }
 })();
@@ -0,0 +1,10 @@
+"""テスト共通の設定。trpg_app を読み込む前に DB を一時ディレクトリへ向ける（作業ディレクトリの trpg.db を汚さない）。"""
+
+import os
+import sys
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="trpg-test-")
+os.environ.setdefault("TRPG_DB_PATH", os.path.join(_tmp, "trpg.db"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
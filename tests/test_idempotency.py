@@ -0,0 +1,113 @@
+import threading
+
+import pytest
+
+from trpg_app import idempotency
+from trpg_app.idempotency import COALESCED, COMPUTED, REPLAYED, Coalescer, KeyReuseError, fingerprint
+
+
+class _WatchedEvent(threading.Event):
+    # 完了待ちに入ったことを知らせる（重複リクエストが実行中の計算に相乗りしたのを確かめてから計算を終わらせる）
+    waiting = None
+
+    def wait(self, timeout=None):
+        if self.waiting is not None and not self.is_set():
+            self.waiting.set()
+        return super().wait(timeout)
+
+
+@pytest.fixture
+def waiting(monkeypatch):
+    event = threading.Event()
+
+    class WatchedCall(idempotency._Call):
+        __slots__ = ()
+
+        def __init__(self, request_fingerprint):
+            super().__init__(request_fingerprint)
+            self.done = _WatchedEvent()
+            self.done.waiting = event
+
+    monkeypatch.setattr(idempotency, "_Call", WatchedCall)
+    return event
+
+
+def _run_in_thread(coalescer, key, fp, compute):
+    out = {}
+
+    def target():
+        out["value"] = coalescer.run(key, fp, compute)
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    return thread, out
+
+
+def test_duplicate_while_in_flight_waits_for_first_computation(waiting):
+    coalescer = Coalescer(ttl=60)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "turn"
+
+    fp = fingerprint({"input": "look"})
+    first, first_out = _run_in_thread(coalescer, "k", fp, compute)
+    assert started.wait(5)
+    second, second_out = _run_in_thread(coalescer, "k", fp, compute)
+    assert waiting.wait(5)
+    release.set()
+    first.join(5)
+    second.join(5)
+
+    assert calls == [1]
+    assert first_out["value"] == ("turn", COMPUTED)
+    assert second_out["value"] == ("turn", COALESCED)
+    # 完了後の再送は保存済みの結果を返す
+    assert coalescer.run("k", fp, compute) == ("turn", REPLAYED)
+    assert calls == [1]
+
+
+def test_key_reused_with_different_body_is_rejected():
+    coalescer = Coalescer(ttl=60)
+    coalescer.run("k", fingerprint({"input": "look"}), lambda: "turn")
+    with pytest.raises(KeyReuseError):
+        coalescer.run("k", fingerprint({"input": "attack"}), lambda: "other")
+
+
+def test_results_rejected_by_keep_are_computed_again():
+    coalescer = Coalescer(ttl=60)
+    fp = fingerprint({})
+    results = iter([("error", 500), ("ok", 200)])
+
+    def keep(result):
+        return result[1] == 200
+
+    assert coalescer.run("k", fp, lambda: next(results), keep=keep) == (("error", 500), COMPUTED)
+    assert coalescer.run("k", fp, lambda: next(results), keep=keep) == (("ok", 200), COMPUTED)
+    assert coalescer.run("k", fp, lambda: pytest.fail("replay expected"), keep=keep) == (("ok", 200), REPLAYED)
+
+
+def test_eviction_keeps_in_flight_entries(waiting):
+    coalescer = Coalescer(ttl=60, max_entries=1)
+    started, release = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "slow"
+
+    fp = fingerprint({})
+    running, _ = _run_in_thread(coalescer, "running", fp, slow)
+    assert started.wait(5)
+    # 上限を超えても実行中の計算は捨てず、相乗りできるままにする
+    coalescer.run("done", fp, lambda: "fast")
+    duplicate, out = _run_in_thread(coalescer, "running", fp, lambda: pytest.fail("should coalesce"))
+    assert waiting.wait(5)
+    release.set()
+    running.join(5)
+    duplicate.join(5)
+    assert out["value"] == ("slow", COALESCED)
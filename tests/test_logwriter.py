@@ -0,0 +1,80 @@
+import threading
+
+import pytest
+
+from trpg_app import logwriter, services
+
+
+class FakeTable:
+    """行をまとめて書く偽の書き込み先。BAD を含むまとめ書きは何も書かずに失敗する（トランザクションの巻き戻し）。"""
+
+    BAD = "bad"
+
+    def __init__(self):
+        self.rows = []
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def write_batch(self, records):
+        with self._lock:
+            self.calls.append(list(records))
+            if self.BAD in records:
+                raise ValueError("bad row")
+            start = len(self.rows)
+            self.rows.extend(records)
+            return list(range(start + 1, start + 1 + len(records)))
+
+
+def test_failed_batch_is_retried_row_by_row():
+    table = FakeTable()
+    # 十分長い待ち時間で 3 件を 1 つのまとめ書きに入れる
+    writer = logwriter.LogWriter(table.write_batch, flush_ms=200, batch_size=3)
+    try:
+        pendings = [writer.submit(record) for record in ("a", FakeTable.BAD, "b")]
+        writer.flush(timeout=5)
+    finally:
+        writer.close()
+
+    assert table.calls[0] == ["a", FakeTable.BAD, "b"]
+    assert table.calls[1:] == [["a"], [FakeTable.BAD], ["b"]]
+    # 壊れた行の失敗はその呼び出し元だけに返り、ほかの行は 1 回ずつ書かれる
+    assert table.rows == ["a", "b"]
+    assert pendings[0].result(timeout=1) == 1
+    assert pendings[2].result(timeout=1) == 2
+    with pytest.raises(ValueError):
+        pendings[1].result(timeout=1)
+
+
+def test_successful_batch_commits_once():
+    table = FakeTable()
+    writer = logwriter.LogWriter(table.write_batch, flush_ms=200, batch_size=2)
+    try:
+        first, second = writer.submit("a"), writer.submit("b")
+        assert (first.result(timeout=5), second.result(timeout=5)) == (1, 2)
+    finally:
+        writer.close()
+    assert table.calls == [["a", "b"]]
+
+
+def test_post_commit_error_does_not_duplicate_rows():
+    session = services.create_session("logwriter")
+
+    def broken_listener(session_id, version):
+        raise RuntimeError("listener failed")
+
+    services.version_listeners.append(broken_listener)
+    writer = logwriter.LogWriter(services._write_log_batch, flush_ms=200, batch_size=2)
+    try:
+        records = [
+            ("dice_log", {"session_id": session["id"], "expression": f"1d{n}", "result": "{}", "created_at": "now"})
+            for n in (6, 20)
+        ]
+        ids = [pending.result(timeout=5) for pending in [writer.submit(record) for record in records]]
+    finally:
+        writer.close()
+        services.version_listeners.remove(broken_listener)
+
+    # コミット後の通知が失敗してもまとめ書きは成功扱い（1 行ずつの書き直しで同じ行を二重に書かない）
+    logs = services.list_dice_logs(session["id"])
+    assert sorted(log["id"] for log in logs) == sorted(ids)
+    assert services.get_session_version(session["id"]) == session["version"] + 2
@@ -0,0 +1,52 @@
+import time
+
+from trpg_app.resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+COOLDOWN = 0.2
+
+
+def _opened():
+    # 連続 2 回の失敗で開き、クールダウンが明けた状態のブレーカー
+    breaker = CircuitBreaker("test", failures=2, slow_seconds=1.0, cooldown=COOLDOWN)
+    breaker.record(0.1, ok=False)
+    assert breaker.state == CLOSED
+    breaker.record(0.1, ok=False)
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    time.sleep(COOLDOWN)
+    return breaker
+
+
+def test_half_open_allows_a_single_probe():
+    breaker = _opened()
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # 試行の結果が出るまでほかの呼び出しは通さない
+    assert not breaker.allow()
+    assert not breaker.allow()
+
+
+def test_successful_probe_closes_the_breaker():
+    breaker = _opened()
+    assert breaker.allow()
+    breaker.record(0.1, ok=True)
+    assert breaker.state == CLOSED
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_probe_reopens_for_another_cooldown():
+    breaker = _opened()
+    assert breaker.allow()
+    breaker.record(0.1, ok=False)
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    time.sleep(COOLDOWN)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+
+
+def test_slow_probe_counts_as_failure():
+    breaker = _opened()
+    assert breaker.allow()
+    breaker.record(2.0, ok=True)
+    assert breaker.state == OPEN
@@ -0,0 +1,78 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from trpg_app import services, speculation
+from trpg_app.domain import TurnResult
+from trpg_app.tools import Toolset
+
+CHOICES = [{"id": "open_door", "text": "扉を開ける"}, {"id": "wait", "text": "待つ"}]
+
+
+@pytest.fixture
+def during():
+    # 先読みの途中で呼ぶ関数（snapshot を受け取る）を入れておく
+    return []
+
+
+@pytest.fixture
+def speculator(monkeypatch, during):
+    # モデルを呼ばずに、選んだ選択肢を世界フラグに書くだけの先読み
+    def fake_speculate(snapshot, choice_id):
+        for hook in during:
+            hook(snapshot)
+        draft = SimpleNamespace(writes=[("world_fact", ("picked", choice_id))])
+        return TurnResult(narration=f"speculated {choice_id}"), draft, 0.01
+
+    monkeypatch.setattr(speculation, "_speculate", fake_speculate)
+    instance = speculation.Speculator(top_k=2, workers=1)
+    yield instance
+    instance.close()
+
+
+def _claim(speculator, session, choice_id):
+    return speculator.claim(session, "", choice_id, Toolset(session["id"]))
+
+
+def test_speculation_at_current_version_is_used(speculator):
+    session = services.create_session("speculation")
+    speculator.schedule(session["id"], CHOICES)
+
+    result = _claim(speculator, services.get_session(session["id"]), "open_door")
+
+    assert result.narration == "speculated open_door"
+    assert services.get_world_facts(session["id"]) == {"picked": "open_door"}
+
+
+def test_speculation_for_an_older_version_is_rejected(speculator):
+    session = services.create_session("speculation")
+    # このリクエストがセッションを読んだ後に別のターンがコミットし、その状態で先読みされた
+    loaded = services.get_session(session["id"])
+    services.set_world_fact(session["id"], "torch", "lit")
+    speculator.schedule(session["id"], CHOICES)
+
+    assert _claim(speculator, loaded, "open_door") is None
+    assert services.get_world_facts(session["id"]) == {"torch": "lit"}
+    # 古い版で照会された先読みは捨てられ、もう使われない
+    assert _claim(speculator, services.get_session(session["id"]), "open_door") is None
+
+
+def test_commit_while_speculating_rejects_the_result(speculator, during):
+    session = services.create_session("speculation")
+    committed = threading.Event()
+
+    def concurrent_turn(snapshot):
+        # 先読みの最中に別のターンがコミットしてバージョンが進む
+        if not committed.is_set():
+            committed.set()
+            services.set_world_fact(snapshot["id"], "torch", "lit")
+
+    during.append(concurrent_turn)
+    loaded = services.get_session(session["id"])
+    speculator.schedule(session["id"], CHOICES)
+
+    assert _claim(speculator, loaded, "open_door") is None
+    assert committed.is_set()
+    assert services.get_world_facts(session["id"]) == {"torch": "lit"}
+    assert services.get_session_version(session["id"]) == loaded["version"] + 1
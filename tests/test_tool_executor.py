@@ -0,0 +1,76 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from trpg_app.tool_executor import FootprintLocks, ToolExecutor, dependencies, serialized
+
+
+class FakeToolset:
+    """呼び出しの開始・終了時刻だけを記録する Toolset の代わり。"""
+
+    def __init__(self, seconds=0.05):
+        self.rng = random.Random(0)
+        self.seconds = seconds
+        self.spans = {}
+
+    @contextmanager
+    def isolated_rng(self, seed):
+        yield
+
+    def _record(self, key):
+        start = time.perf_counter()
+        time.sleep(self.seconds)
+        self.spans[key] = (start, time.perf_counter())
+        return key
+
+    def attack_roll(self, attacker_id, target_id):
+        return self._record(f"{attacker_id}->{target_id}")
+
+    def request_skill_check(self, actor_id, skill):
+        return self._record(f"{actor_id}:{skill}")
+
+
+def _overlap(left, right):
+    return left[0] < right[1] and right[0] < left[1]
+
+
+def test_conflicting_footprints_depend_on_each_other():
+    calls = [
+        ("attack_roll", {"attacker_id": "a", "target_id": "orc"}),
+        ("attack_roll", {"attacker_id": "b", "target_id": "orc"}),
+        ("request_skill_check", {"actor_id": "c", "skill": "stealth"}),
+        ("query_game_state", {}),
+    ]
+    # 同じ相手の HP を書く 2 件は順に、別キャラクターの判定は待たない。全員を読む照会は書き込みの後
+    assert dependencies(calls) == [[], [0], [], [0, 1]]
+
+
+def test_executor_runs_conflicting_calls_one_after_another():
+    toolset = FakeToolset()
+    report = ToolExecutor(toolset, max_workers=4).run(
+        [
+            ("attack_roll", {"attacker_id": "a", "target_id": "orc"}),
+            ("attack_roll", {"attacker_id": "b", "target_id": "orc"}),
+        ]
+    )
+    assert report.results == ["a->orc", "b->orc"]
+    assert [call.waited_for for call in report.calls] == [[], [0]]
+    assert not _overlap(toolset.spans["a->orc"], toolset.spans["b->orc"])
+
+
+def test_footprint_locks_serialize_only_conflicting_calls():
+    toolset = FakeToolset(seconds=0.1)
+    locks = FootprintLocks()
+    attack = serialized(toolset.attack_roll, locks)
+    calls = [("a", "orc"), ("b", "orc"), ("c", "goblin")]
+    # フレームワークが 1 件ずつ別スレッドで呼ぶ場合
+    threads = [threading.Thread(target=attack, args=args) for args in calls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    spans = toolset.spans
+    assert not _overlap(spans["a->orc"], spans["b->orc"])
+    assert _overlap(spans["c->goblin"], spans["a->orc"]) or _overlap(spans["c->goblin"], spans["b->orc"])
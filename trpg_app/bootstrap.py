@@ -0,0 +1,20 @@
+"""Explicit application start-up.
+
+Importing ``trpg_app`` modules has no side effects: engines are created lazily and the
+schema is verified once per process on first use (a single ``PRAGMA user_version`` read
+when it is already current). Call ``bootstrap()`` at worker start to pay that cost, and
+the optional model warm-up, before the first request instead of during it.
+"""
+
+from __future__ import annotations
+
+from . import db, dice, gm_agent, intents
+
+
+def bootstrap(warm_model: bool = True) -> None:
+    # DB エンジン作成とスキーマ確認（必要ならマイグレーション）、ダイス式と意図表の事前コンパイル、GM モデルの事前読み込み
+    db.init_db()
+    dice.warm_up()
+    intents.default_matcher()
+    if warm_model:
+        gm_agent.warm_up()
@@ -0,0 +1,243 @@
+"""In-process LRU/TTL cache for decoded session state, validated by the session version.
+
+Every ``services`` write bumps ``sessions.version``, so an entry stored together with the
+version it was built from is valid exactly while that version is current. ``services``
+decides how the current version is obtained (``TRPG_SESSION_CACHE``):
+
+- ``verify`` (default): one primary-key lookup of the version per read. Safe with several
+  worker processes, because writes from any process are seen through the database.
+- ``process``: trust the versions this process published after its own commits. Fastest,
+  but only correct when a single process writes to the database.
+- ``off``: no caching.
+
+Cached values are shared between callers and must be treated as read-only.
+
+An optional shared tier (``TRPG_SHARED_CACHE=redis|memory``) sits behind the in-process
+one: encoded session snapshots and world facts, stored with their version, so another app
+node can reuse a snapshot instead of rebuilding it from SQL. Writes always go to SQL first
+and are written through to the shared tier after commit.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from . import db, metrics
+
+MODE = os.getenv("TRPG_SESSION_CACHE", "verify").lower()
+MAX_BYTES = int(os.getenv("TRPG_SESSION_CACHE_BYTES", str(32 * 1024 * 1024)))
+TTL_SECONDS = float(os.getenv("TRPG_SESSION_CACHE_TTL", "300"))
+SHARED = os.getenv("TRPG_SHARED_CACHE", "off").lower()
+# 共有層のエントリ寿命。アクセスのたびに延長する（放置セッションは自然に消える）
+SHARED_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "86400"))
+
+metrics.COUNTERS.update(
+    {
+        "trpg_session_cache_hits_total": "Session cache lookups served from memory.",
+        "trpg_session_cache_misses_total": "Session cache lookups that went to the database.",
+        "trpg_session_cache_evictions_total": "Session cache entries evicted by the byte limit.",
+        "trpg_shared_cache_errors_total": "Shared cache tier operations that failed (treated as misses).",
+    }
+)
+metrics.GAUGES["trpg_session_cache_bytes"] = "Estimated size of the session cache."
+
+
+class _Entry:
+    __slots__ = ("version", "value", "size", "expires")
+
+    def __init__(self, version: int, value: Any, size: int, expires: float):
+        self.version = version
+        self.value = value
+        self.size = size
+        self.expires = expires
+
+
+class VersionedLRU:
+    """バージョン付きの LRU キャッシュ。容量はおおよそのバイト数で制限し、TTL で古い値も捨てる。"""
+
+    def __init__(self, max_bytes: int = MAX_BYTES, ttl: float = TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Tuple[str, Hashable], version: Optional[int]) -> Any:
+        # version と一致し期限内の値だけを返す（それ以外は None = ミス）
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry.expires <= now or entry.version != version):
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        metrics.inc(
+            "trpg_session_cache_misses_total" if entry is None else "trpg_session_cache_hits_total",
+            kind=key[0],
+            tier="local",
+        )
+        return None if entry is None else entry.value
+
+    def put(self, key: Tuple[str, Hashable], version: Optional[int], value: Any, size: int) -> None:
+        if version is None or size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = _Entry(version, value, size, time.monotonic() + self.ttl)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+                metrics.inc("trpg_session_cache_evictions_total")
+            total = self.bytes
+        metrics.set_gauge("trpg_session_cache_bytes", total)
+
+    def invalidate(self, key: Tuple[str, Hashable]) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _drop(self, key) -> None:
+        entry = self._entries.pop(key)
+        self.bytes -= entry.size
+
+
+class MemoryTier:
+    """プロセス内で完結する共有層（単一ノード構成やテストでの Redis の代わり）。"""
+
+    def __init__(self, ttl: int = SHARED_TTL_SECONDS):
+        self.ttl = ttl
+        self._data: Dict[str, Tuple[bytes, float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[1] <= now:
+                del self._data[key]
+                return None
+            self._data[key] = (item[0], now + self.ttl)
+            return item[0]
+
+    def set(self, key: str, value: bytes) -> None:
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class RedisTier:
+    """Redis に置く共有層。旧 SessionBundle.redis_save/redis_load と同じく TTL 付きで保存し、読むたびに延長する。"""
+
+    def __init__(self, client, namespace: str = "trpg", ttl: int = SHARED_TTL_SECONDS):
+        self.client = client
+        self.prefix = f"{namespace}:cache:"
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[bytes]:
+        pipe = self.client.pipeline()
+        pipe.get(self.prefix + key)
+        pipe.expire(self.prefix + key, self.ttl)
+        return pipe.execute()[0]
+
+    def set(self, key: str, value: bytes) -> None:
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def delete(self, key: str) -> None:
+        self.client.delete(self.prefix + key)
+
+
+class SharedCache:
+    """共有層（MemoryTier / RedisTier など get/set/delete を持つもの）にバージョン付きの値を出し入れする。
+
+    共有層の障害はミス扱いにして SQL へフォールバックする。
+    """
+
+    def __init__(self, tier):
+        self.tier = tier
+
+    def get(self, key: Tuple[str, Hashable], version: Optional[int]) -> Any:
+        value = None
+        try:
+            raw = self.tier.get(_shared_key(key))
+        except Exception:
+            metrics.inc("trpg_shared_cache_errors_total")
+            raw = None
+        if raw is not None:
+            data = db.codec.decode(raw)
+            if data.get("version") == version:
+                value = data.get("value")
+        metrics.inc(
+            "trpg_session_cache_misses_total" if value is None else "trpg_session_cache_hits_total",
+            kind=key[0],
+            tier="shared",
+        )
+        return value
+
+    def put(self, key: Tuple[str, Hashable], version: Optional[int], value: Any) -> None:
+        if version is None:
+            return
+        try:
+            self.tier.set(_shared_key(key), db.codec.encode({"version": version, "value": value}))
+        except Exception:
+            metrics.inc("trpg_shared_cache_errors_total")
+
+
+def _shared_key(key: Tuple[str, Hashable]) -> str:
+    return ":".join(str(part) for part in key)
+
+
+def shared_from_env() -> Optional[SharedCache]:
+    # TRPG_SHARED_CACHE=redis|memory のときだけ共有層を作る（接続先は REDIS_HOST / REDIS_PORT / REDIS_DB）
+    if SHARED == "memory":
+        return SharedCache(MemoryTier())
+    if SHARED == "redis":
+        import redis
+
+        client = redis.Redis(
+            host=os.getenv("REDIS_HOST", "localhost"),
+            port=int(os.getenv("REDIS_PORT", "6379")),
+            db=int(os.getenv("REDIS_DB", "0")),
+        )
+        return SharedCache(RedisTier(client, namespace=os.getenv("GAME_REDIS_NS", "trpg")))
+    return None
+
+
+def from_env() -> Optional[VersionedLRU]:
+    # TRPG_SESSION_CACHE=off なら None（キャッシュなし）
+    if MODE not in ("verify", "process"):
+        return None
+    return VersionedLRU()
@@ -0,0 +1,232 @@
+"""Cold storage tiering: move old turn/dice logs into compressed segments in the archive DB."""
+
+from __future__ import annotations
+
+import argparse
+import json
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy import delete, func, select, update
+
+from . import db
+from .models import DiceLog, LogSegment, Session, TurnLog
+
+# 1 セグメントに詰める最大行数（読み出し時のメモリ上限もこれで決まる）
+SEGMENT_ROWS = 500
+
+# 種別ごとの、sessions 行に持つ退避済みの最大 ID の列
+_BOUNDARY_COLUMNS = {"turn_log": Session.archived_turn_upto, "dice_log": Session.archived_dice_upto}
+
+_COLUMNS = {
+    "turn_log": (TurnLog, ("id", "session_id", "turn_no", "player_input", "gm_output", "dice_results", "world_diff", "created_at")),
+    "dice_log": (DiceLog, ("id", "session_id", "expression", "result", "created_at")),
+}
+
+
+def _pack(rows: List[Dict]) -> bytes:
+    # 行の配列を JSON 化して zlib 圧縮（カラムの JSON 文字列はそのまま保持、圧縮カラムは文字列に戻す）
+    rows = [{key: db.as_text(value) if isinstance(value, bytes) else value for key, value in row.items()} for row in rows]
+    return zlib.compress(db.codec.encode(rows), 6)
+
+
+def _unpack(payload: bytes) -> List[Dict]:
+    return db.codec.decode(zlib.decompress(payload))
+
+
+def _turn_boundary(session_id: str, keep_turns: int):
+    # 直近 keep_turns ターンより古いターンのうち最新のもの（id, created_at）を返す
+    with db.session_scope() as orm:
+        return orm.execute(
+            select(TurnLog.id, TurnLog.created_at)
+            .where(TurnLog.session_id == session_id)
+            .order_by(TurnLog.id.desc())
+            .offset(keep_turns)
+            .limit(1)
+        ).first()
+
+
+def _boundary_id(model, session_id: str, boundary, cutoff: Optional[str]) -> Optional[int]:
+    # 退避対象となる最大 ID を求める（ID の前方一致で退避するので読み出し側は id > 境界 だけ見ればよい）
+    with db.session_scope() as orm:
+        stmt = select(func.max(model.id)).where(model.session_id == session_id)
+        if boundary is not None:
+            if model is TurnLog:
+                stmt = stmt.where(model.id <= boundary.id)
+            else:
+                # ダイスログはターンより先に書かれるので、境界ターン以前の時刻のものを退避
+                stmt = stmt.where(model.created_at <= boundary.created_at)
+        if cutoff is not None:
+            stmt = stmt.where(model.created_at < cutoff)
+        return orm.execute(stmt).scalar()
+
+
+def _move(kind: str, session_id: str, boundary_id: int) -> int:
+    # 境界 ID 以下の行をセグメント単位でアーカイブ DB へ移し、ホット DB から削除
+    model, columns = _COLUMNS[kind]
+    moved = 0
+    while True:
+        with db.session_scope() as orm:
+            rows = orm.execute(
+                select(*[getattr(model, c) for c in columns])
+                .where(model.session_id == session_id, model.id <= boundary_id)
+                .order_by(model.id.asc())
+                .limit(SEGMENT_ROWS)
+            ).all()
+        if not rows:
+            return moved
+        records = [dict(zip(columns, row)) for row in rows]
+        turns = [r["turn_no"] for r in records if r.get("turn_no") is not None]
+        # 先にアーカイブ側をコミットしてからホット側を消す（途中で落ちても重複で済み、欠損しない）
+        with db.archive_scope() as archive:
+            archive.add(
+                LogSegment(
+                    session_id=session_id,
+                    kind=kind,
+                    turn_from=min(turns) if turns else None,
+                    turn_to=max(turns) if turns else None,
+                    id_from=records[0]["id"],
+                    id_to=records[-1]["id"],
+                    created_from=records[0]["created_at"],
+                    created_to=records[-1]["created_at"],
+                    row_count=len(records),
+                    payload=_pack(records),
+                )
+            )
+        with db.session_scope() as orm:
+            orm.execute(
+                delete(model).where(
+                    model.session_id == session_id,
+                    model.id >= records[0]["id"],
+                    model.id <= records[-1]["id"],
+                )
+            )
+            # 読み取り側がアーカイブ DB を開かずに境界を知れるよう、削除と同じトランザクションで進める
+            column = _BOUNDARY_COLUMNS[kind]
+            orm.execute(
+                update(Session)
+                .where(Session.id == session_id)
+                .values({column: func.max(func.coalesce(column, 0), records[-1]["id"])})
+                .execution_options(synchronize_session=False)
+            )
+        moved += len(records)
+
+
+def archive_session(
+    session_id: str,
+    keep_turns: Optional[int] = None,
+    older_than_days: Optional[float] = None,
+    now: Optional[datetime] = None,
+) -> Dict[str, int]:
+    """直近 keep_turns ターンより古い / older_than_days 日より古いログをアーカイブへ移す。
+
+    両方指定した場合は両方の条件を満たすログだけを移す。
+    """
+    if keep_turns is None and older_than_days is None:
+        raise ValueError("keep_turns or older_than_days is required")
+    cutoff = None
+    if older_than_days is not None:
+        cutoff = ((now or datetime.utcnow()) - timedelta(days=older_than_days)).isoformat() + "Z"
+    boundary = None
+    if keep_turns is not None:
+        boundary = _turn_boundary(session_id, keep_turns)
+        if boundary is None:
+            return {"turn_log": 0, "dice_log": 0}
+    moved = {}
+    for kind, (model, _) in _COLUMNS.items():
+        boundary_id = _boundary_id(model, session_id, boundary, cutoff)
+        moved[kind] = _move(kind, session_id, boundary_id) if boundary_id is not None else 0
+    return moved
+
+
+def archive_all(keep_turns: Optional[int] = None, older_than_days: Optional[float] = None) -> Dict[str, Dict[str, int]]:
+    # 全セッションに対してアーカイブジョブを実行
+    with db.session_scope() as orm:
+        session_ids = list(orm.execute(select(Session.id)).scalars())
+    results = {}
+    for session_id in session_ids:
+        moved = archive_session(session_id, keep_turns=keep_turns, older_than_days=older_than_days)
+        if any(moved.values()):
+            results[session_id] = moved
+    return results
+
+
+def archived_upto(session_id: str, kind: str) -> int:
+    # アーカイブ済みの最大 ID（未退避なら 0）。ホット側はこれより大きい ID だけ読めばよい
+    with db.archive_scope() as archive:
+        value = archive.execute(
+            select(func.max(LogSegment.id_to)).where(LogSegment.session_id == session_id, LogSegment.kind == kind)
+        ).scalar()
+        return value or 0
+
+
+def hot_boundary(orm, session_id: str, kind: str) -> int:
+    """ホット DB のトランザクション内で退避済みの最大 ID を返す（sessions 行の値。未記録ならアーカイブから埋める）。"""
+    column = _BOUNDARY_COLUMNS[kind]
+    value = orm.execute(select(column).where(Session.id == session_id)).scalar()
+    if value is None:
+        value = archived_upto(session_id, kind)
+        orm.execute(
+            update(Session).where(Session.id == session_id).values({column: value}).execution_options(synchronize_session=False)
+        )
+    return value
+
+
+def last_archived_turn(session_id: str) -> int:
+    # アーカイブ済みのターンの最大ターン番号（未退避なら 0）
+    with db.archive_scope() as archive:
+        value = archive.execute(
+            select(func.max(LogSegment.turn_to)).where(LogSegment.session_id == session_id, LogSegment.kind == "turn_log")
+        ).scalar()
+        return value or 0
+
+
+def iter_rows(session_id: str, kind: str, newest_first: bool = False) -> Iterator:
+    """アーカイブ済みの行を ORM モデルの一時インスタンスとして ID 順に返す。"""
+    model, _ = _COLUMNS[kind]
+    order = LogSegment.id_from.desc() if newest_first else LogSegment.id_from.asc()
+    with db.archive_scope() as archive:
+        segment_ids = list(
+            archive.execute(
+                select(LogSegment.id).where(LogSegment.session_id == session_id, LogSegment.kind == kind).order_by(order)
+            ).scalars()
+        )
+    last_id = None
+    for segment_id in segment_ids:
+        # セグメントは 1 つずつ読み込む（巨大なセッションでもメモリを食わない）
+        with db.archive_scope() as archive:
+            records = _unpack(archive.get(LogSegment, segment_id).payload)
+        if newest_first:
+            records.reverse()
+        for record in records:
+            # 途中で落ちた退避の再実行で同じ行が重複していても 1 度だけ返す
+            if last_id is not None and (record["id"] >= last_id if newest_first else record["id"] <= last_id):
+                continue
+            last_id = record["id"]
+            yield model(**record)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    # cron などから呼ぶ CLI: python -m trpg_app.coldstore --keep-turns 200
+    parser = argparse.ArgumentParser(description="Move old turn/dice logs into the archive DB.")
+    parser.add_argument("--keep-turns", type=int, help="keep this many recent turns in the hot DB")
+    parser.add_argument("--older-than-days", type=float, help="archive logs older than this many days")
+    parser.add_argument("--session", help="only archive this session id")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM the hot DB afterwards to shrink the file")
+    args = parser.parse_args(argv)
+    if args.keep_turns is None and args.older_than_days is None:
+        parser.error("--keep-turns or --older-than-days is required")
+    db.init_db()
+    if args.session:
+        results = {args.session: archive_session(args.session, args.keep_turns, args.older_than_days)}
+    else:
+        results = archive_all(args.keep_turns, args.older_than_days)
+    if args.vacuum:
+        with db.get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql("VACUUM")
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
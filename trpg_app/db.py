@@ -1,49 +1,295 @@
 import json
 import os
+import sqlite3
+import threading
+import zlib
 from contextlib import contextmanager
-from typing import Any, Optional
+from typing import Any, Callable, Dict, NamedTuple, Optional, Union
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session, sessionmaker
 
-from .models import Base
+from . import metrics, tracing
+from .models import ArchiveBase, Base
 
 DB_PATH = os.getenv("TRPG_DB_PATH", "trpg.db")
 DATABASE_URL = f"sqlite:///{DB_PATH}"
+# 古いログを退避するアーカイブ DB（未指定ならホット DB の隣に置く）
+ARCHIVE_PATH = os.getenv("TRPG_ARCHIVE_PATH", os.path.splitext(DB_PATH)[0] + "_archive.db")
+ARCHIVE_URL = f"sqlite:///{ARCHIVE_PATH}"
 
-# SQLAlchemy エンジンとセッションファクトリを初期化
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    future=True,
-)
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
+# セッションファクトリは import 時にはエンジンへ繋がず、最初に使うときに bind する
+SessionLocal = sessionmaker(autoflush=False, autocommit=False, future=True)
+ArchiveSessionLocal = sessionmaker(autoflush=False, autocommit=False, future=True)
+
+_engines: Dict[str, Engine] = {}
+_engine_lock = threading.Lock()
+
+
+def _engine(name: str, url: str, metadata, factory: sessionmaker) -> Engine:
+    # エンジンを初回だけ作り、スキーマの確認（必要ならマイグレーション）も 1 回だけ行う
+    engine = _engines.get(name)
+    if engine is not None:
+        return engine
+    with _engine_lock:
+        engine = _engines.get(name)
+        if engine is None:
+            engine = create_engine(url, connect_args={"check_same_thread": False}, future=True)
+            metrics.install_db_hooks(engine)
+            _ensure_schema(engine, metadata)
+            factory.configure(bind=engine)
+            _engines[name] = engine
+    return engine
+
+
+def get_engine() -> Engine:
+    return _engine("main", DATABASE_URL, Base.metadata, SessionLocal)
+
+
+def get_archive_engine() -> Engine:
+    return _engine("archive", ARCHIVE_URL, ArchiveBase.metadata, ArchiveSessionLocal)
 
 
 def init_db() -> None:
-    # テーブルを作成（存在しない場合のみ）
-    Base.metadata.create_all(bind=engine)
+    # 起動時に明示的に呼ぶ（呼ばなくても最初の DB アクセスで同じことが行われる）
+    get_engine()
+    get_archive_engine()
 
 
-@contextmanager
-def session_scope() -> Session:
-    # トランザクション境界を提供するユーティリティ
-    session: Session = SessionLocal()
+def dispose_engines() -> None:
+    # 接続プールを捨てる（pre-fork サーバーが fork 前に呼び、親の SQLite 接続を子へ持ち込まない）。スキーマ確認済みの状態は残る
+    for engine in list(_engines.values()):
+        engine.dispose()
+
+
+def schema_fingerprint(metadata) -> int:
+    # モデル定義（テーブル・カラム・型・テーブルオプション）から作る 31bit の指紋。PRAGMA user_version に保存して比較する
+    parts = sorted(
+        f"{table.name}.{column.name}:{column.type}:{column.nullable}"
+        for table in metadata.sorted_tables
+        for column in table.columns
+    )
+    parts.extend(
+        sorted(f"{table.name}:{key}={value}" for table in metadata.sorted_tables for key, value in table.dialect_kwargs.items())
+    )
+    parts.extend(metadata.info.get("ddl", ()))
+    return zlib.crc32("\n".join(parts).encode("utf-8")) & 0x7FFFFFFF
+
+
+def _ensure_schema(engine: Engine, metadata) -> None:
+    # 指紋が一致すれば PRAGMA 1 回で終わり。違えばテーブル作成とカラム追加を行って指紋を更新
+    fingerprint = schema_fingerprint(metadata)
+    with engine.connect() as conn:
+        if conn.exec_driver_sql("PRAGMA user_version").scalar() == fingerprint:
+            return
+    metadata.create_all(bind=engine)
+    _add_missing_columns(engine, metadata)
+    _add_missing_autoincrement(engine, metadata)
+    with engine.begin() as conn:
+        for ddl in metadata.info.get("ddl", ()):
+            # FTS5 / trigram のない SQLite（3.34 未満など）では作らず、その機能を無効のまま動かす
+            try:
+                conn.exec_driver_sql(ddl)
+            except OperationalError:
+                pass
+        conn.exec_driver_sql(f"PRAGMA user_version = {fingerprint}")
+
+
+def _add_missing_columns(bind, metadata) -> None:
+    # 既存 DB に後から追加したカラムを ALTER TABLE で足す（追加のみの簡易マイグレーション）
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in metadata.sorted_tables:
+            existing = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(bind.dialect)}"
+                if column.server_default is not None:
+                    ddl += f" NOT NULL DEFAULT {column.server_default.arg}" if not column.nullable else f" DEFAULT {column.server_default.arg}"
+                conn.exec_driver_sql(ddl)
+
+
+def _add_missing_autoincrement(bind, metadata) -> None:
+    # sqlite_autoincrement を後から付けたテーブルを作り直す（既存 DB の CREATE TABLE は変わらないため）
+    with bind.begin() as conn:
+        for table in metadata.sorted_tables:
+            if not table.dialect_kwargs.get("sqlite_autoincrement"):
+                continue
+            sql = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table.name,)).scalar()
+            if sql is None or "AUTOINCREMENT" in sql.upper():
+                continue
+            old = f"{table.name}__old"
+            conn.exec_driver_sql(f"ALTER TABLE {table.name} RENAME TO {old}")
+            # 旧テーブルの索引は名前が衝突するので先に消す（新しいテーブルの分は create で作り直す）
+            for (index,) in conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (old,)
+            ).all():
+                conn.exec_driver_sql(f"DROP INDEX {index}")
+            table.create(conn)
+            columns = ", ".join(column.name for column in table.columns)
+            conn.exec_driver_sql(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old}")
+            conn.exec_driver_sql(f"DROP TABLE {old}")
+            # 次の ID はホットに残る最大値とアーカイブ済みの最大値の両方より後から振る
+            floor = max(conn.exec_driver_sql(f"SELECT COALESCE(MAX(id), 0) FROM {table.name}").scalar(), _archived_id_floor(table))
+            conn.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = ?", (table.name,))
+            conn.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table.name, floor))
+
+
+def _archived_id_floor(table) -> int:
+    # アーカイブ DB に退避済みの、このテーブルの最大 ID（アーカイブがなければ 0）
+    kind = table.info.get("segment_kind")
+    if kind is None or not os.path.exists(ARCHIVE_PATH):
+        return 0
+    conn = sqlite3.connect(ARCHIVE_PATH)
     try:
-        yield session
-        session.commit()
-    except Exception:
-        session.rollback()
-        raise
+        return conn.execute("SELECT COALESCE(MAX(id_to), 0) FROM log_segments WHERE kind = ?", (kind,)).fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
     finally:
-        session.close()
+        conn.close()
+
+
+@contextmanager
+def session_scope(factory: Optional[sessionmaker] = None) -> Session:
+    # トランザクション境界を提供するユーティリティ
+    archive = factory is ArchiveSessionLocal
+    if (factory or SessionLocal).kw.get("bind") is None:
+        get_archive_engine() if archive else get_engine()
+    session: Session = (factory or SessionLocal)()
+    with tracing.span("db.transaction", db=ARCHIVE_PATH if archive else DB_PATH):
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+def archive_scope():
+    # アーカイブ DB 用のトランザクション境界
+    return session_scope(ArchiveSessionLocal)
+
+
+class Codec(NamedTuple):
+    name: str
+    encode: Callable[[Any], bytes]  # UTF-8 の JSON バイト列へ
+    decode: Callable[[Union[str, bytes]], Any]
+
+
+def _stdlib_codec() -> Codec:
+    return Codec(
+        "json",
+        lambda data: json.dumps(data, ensure_ascii=False).encode("utf-8"),
+        json.loads,
+    )
+
+
+def _load_codec(name: str) -> Codec:
+    # JSON カラム用のコーデックを選ぶ。auto は orjson → msgspec → 標準 json の順で使えるものを使う
+    if name in ("auto", "orjson"):
+        try:
+            import orjson
+
+            return Codec(
+                "orjson",
+                lambda data: orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS),
+                orjson.loads,
+            )
+        except ImportError:
+            if name == "orjson":
+                raise
+    if name in ("auto", "msgspec"):
+        try:
+            import msgspec
+
+            return Codec("msgspec", msgspec.json.encode, msgspec.json.decode)
+        except ImportError:
+            if name == "msgspec":
+                raise
+    if name not in ("auto", "json"):
+        raise ValueError(f"unknown JSON codec: {name}")
+    return _stdlib_codec()
+
+
+# 圧縮して保存した値の先頭 1 バイト（平文の JSON は従来どおり TEXT で保存されるので区別できる）
+_ZLIB = 0x01
+_ZSTD = 0x02
+
+
+def _zstd():
+    import zstandard
+
+    return zstandard
+
+
+def _compressor(name: str) -> Optional[Callable[[bytes], bytes]]:
+    # 大きな JSON カラム用の圧縮方式。none なら圧縮しない
+    if name == "none":
+        return None
+    if name == "zlib":
+        return lambda raw: bytes([_ZLIB]) + zlib.compress(raw, 6)
+    if name == "zstd":
+        compressor = _zstd().ZstdCompressor(level=3)
+        return lambda raw: bytes([_ZSTD]) + compressor.compress(raw)
+    raise ValueError(f"unknown column compression: {name}")
+
+
+codec = _load_codec(os.getenv("TRPG_JSON_CODEC", "auto").lower())
+COLUMN_COMPRESSION = os.getenv("TRPG_COLUMN_COMPRESSION", "none").lower()
+# これより短い JSON は圧縮しても得にならないので平文のまま保存
+COMPRESS_MIN_BYTES = int(os.getenv("TRPG_COMPRESS_MIN_BYTES", "512"))
+_compress = _compressor(COLUMN_COMPRESSION)
+
+
+def set_codec(name: str) -> None:
+    # コーデックの差し替え（ベンチマーク・テスト用）
+    global codec
+    codec = _load_codec(name)
+
+
+def set_compression(name: str, min_bytes: Optional[int] = None) -> None:
+    # 圧縮方式の差し替え（既存の行は方式に関係なく読める）
+    global COLUMN_COMPRESSION, COMPRESS_MIN_BYTES, _compress
+    _compress = _compressor(name)
+    COLUMN_COMPRESSION = name
+    if min_bytes is not None:
+        COMPRESS_MIN_BYTES = min_bytes
+
+
+def dumps(data: Any, compress: bool = False) -> Union[str, bytes]:
+    # JSON 文字列へ変換（日本語もそのまま保持）。compress=True のカラムは大きければ圧縮バイト列にする
+    raw = codec.encode(data)
+    if compress and _compress is not None and len(raw) >= COMPRESS_MIN_BYTES:
+        return _compress(raw)
+    return raw.decode("utf-8")
+
+
+def _decompress(raw: bytes) -> bytes:
+    # 先頭バイトで圧縮方式を判別して展開（それ以外は JSON のバイト列とみなす）
+    header = raw[0]
+    if header == _ZLIB:
+        return zlib.decompress(raw[1:])
+    if header == _ZSTD:
+        return _zstd().ZstdDecompressor().decompress(raw[1:])
+    return raw
 
 
-def dumps(data: Any) -> str:
-    # JSON 文字列へ変換（日本語もそのまま保持）
-    return json.dumps(data, ensure_ascii=False)
+def loads(raw: Optional[Union[str, bytes]]) -> Any:
+    # JSON 文字列（または圧縮バイト列）を辞書へ戻す
+    if not raw:
+        return None
+    if isinstance(raw, bytes):
+        raw = _decompress(raw)
+    return codec.decode(raw)
 
 
-def loads(raw: Optional[str]) -> Any:
-    # JSON 文字列を辞書へ戻す
-    return json.loads(raw) if raw else None
+def as_text(raw: Optional[Union[str, bytes]]) -> Optional[str]:
+    # 保存形式に関係なく JSON 文字列として返す（アーカイブ等で行をそのまま JSON に埋め込む用）
+    if isinstance(raw, bytes):
+        return _decompress(raw).decode("utf-8")
+    return raw
@@ -1,8 +1,11 @@
+import functools
 import random
 import re
 from dataclasses import dataclass
 from typing import List, Optional, Tuple
 
+from . import metrics
+
 
 class DiceError(ValueError):
     # ダイス式のパースや評価で問題があった場合に送出
@@ -172,12 +175,27 @@ def _eval_dice(token: str, rng: random.Random) -> EvalResult:
     return EvalResult(total=total, breakdown=breakdown, rolls=[detail])
 
 
+# ルールが毎回使う式。ワーカーを fork する前に構文解析を済ませておく
+COMMON_EXPRESSIONS = ("1d20", "1d4", "1d6", "1d8", "1d10", "1d12", "2d6", "adv(1d20)", "dis(1d20)")
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_expression(expression: str):
+    """ダイス式を構文木（タプルのみの不変値）に変換する。同じ式は 2 回目以降キャッシュから返す。"""
+    return _Parser(_tokens(expression)).parse()
+
+
+def warm_up() -> None:
+    # よく使う式を事前にコンパイル（pre-fork サーバーでは親で済ませて子と共有する）
+    for expression in COMMON_EXPRESSIONS:
+        compile_expression(expression)
+
+
+@metrics.timed("dice")
 def roll(expression: str, rng: Optional[random.Random] = None) -> dict:
     """ダイス式を評価して合計と出目詳細を返す。"""
     rng = rng or random.Random()
-    tokens = _tokens(expression)
-    parser = _Parser(tokens)
-    ast = parser.parse()
+    ast = compile_expression(expression)
     result = _eval(ast, rng)
     return {
         "expression": expression,
@@ -0,0 +1,165 @@
+"""Typed, slotted domain objects shared by services, rules, tools and the GM agent.
+
+Rows are converted once when loaded (numbers coerced to ``int`` here, not on every rule
+call); ``to_dict`` is only used at the API / tool-result boundary.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+# Resources のうち専用フィールドを持つキー（それ以外は extra にそのまま残す）
+_RESOURCE_KEYS = ("hp", "max_hp", "proficiency", "ac_bonus", "conditions")
+
+
+def _int(value: Any, default: int = 0) -> int:
+    # 保存値を整数に寄せる（数値でなければ既定値）
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def int_map(values: Optional[Dict]) -> Dict[str, int]:
+    # {キー: 数値} の辞書を int に揃える（能力値・技能値・修正値）
+    return {key: _int(value) for key, value in (values or {}).items()}
+
+
+@dataclass(slots=True)
+class Resources:
+    hp: int = 0
+    max_hp: int = 0
+    proficiency: int = 2
+    ac_bonus: int = 0
+    conditions: List[str] = field(default_factory=list)
+    extra: Dict[str, Any] = field(default_factory=dict)
+    # 読み込んだ辞書のキー（順序どおり）。to_dict は保存されていたキーだけを返す（None ならすべて）
+    keys: Optional[Tuple[str, ...]] = None
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict]) -> "Resources":
+        data = data or {}
+        hp = _int(data.get("hp"))
+        return cls(
+            hp=hp,
+            max_hp=_int(data.get("max_hp", hp), hp),
+            proficiency=_int(data.get("proficiency", 2), 2),
+            ac_bonus=_int(data.get("ac_bonus")),
+            conditions=list(data.get("conditions") or []),
+            extra={k: v for k, v in data.items() if k not in _RESOURCE_KEYS},
+            keys=tuple(data),
+        )
+
+    def to_dict(self) -> Dict:
+        # 既定値で補った項目（max_hp など）は書き戻さない。保存値・API の形を読み込んだときのまま保つ
+        fields = {
+            "hp": self.hp,
+            "max_hp": self.max_hp,
+            "proficiency": self.proficiency,
+            "ac_bonus": self.ac_bonus,
+            "conditions": list(self.conditions),
+        }
+        if self.keys is None:
+            return {**self.extra, **fields}
+        return {key: fields[key] if key in fields else self.extra[key] for key in self.keys}
+
+
+@dataclass(slots=True)
+class DerivedStats:
+    mods: Dict[str, int]
+    ac: int
+    hp: int
+    max_hp: int
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "DerivedStats":
+        return cls(
+            mods=int_map(data.get("mods")),
+            ac=_int(data.get("ac", 10), 10),
+            hp=_int(data.get("hp")),
+            max_hp=_int(data.get("max_hp")),
+        )
+
+    def to_dict(self) -> Dict:
+        return {"mods": dict(self.mods), "ac": self.ac, "hp": self.hp, "max_hp": self.max_hp}
+
+
+@dataclass(slots=True)
+class Character:
+    id: str
+    session_id: str
+    name: str
+    base_stats: Dict[str, int]
+    skills: Dict[str, int]
+    resources: Resources
+    derived_stats: DerivedStats
+    race: Optional[str] = ""
+    clazz: Optional[str] = ""
+    level: Optional[int] = 1
+    created_at: Optional[str] = None
+    weapon: Optional[Dict] = None
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Character":
+        # API 形式の辞書から（セッションのスナップショット上でルールを評価するときに使う）
+        return cls(
+            id=data["id"],
+            session_id=data.get("session_id", ""),
+            name=data.get("name", ""),
+            base_stats=int_map(data.get("base_stats")),
+            skills=int_map(data.get("skills")),
+            resources=Resources.from_dict(data.get("resources")),
+            derived_stats=DerivedStats.from_dict(data.get("derived_stats") or {}),
+            race=data.get("race"),
+            clazz=data.get("clazz"),
+            level=data.get("level"),
+            created_at=data.get("created_at"),
+        )
+
+    def stat(self, ability: str, default: int = 10) -> int:
+        return self.base_stats.get(ability, default)
+
+    def skill_bonus(self, skill: str) -> int:
+        skills = self.skills
+        return skills.get(skill, skills.get(skill.lower(), 0))
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "session_id": self.session_id,
+            "name": self.name,
+            "race": self.race,
+            "clazz": self.clazz,
+            "level": self.level,
+            "base_stats": dict(self.base_stats),
+            "skills": dict(self.skills),
+            "resources": self.resources.to_dict(),
+            "derived_stats": self.derived_stats.to_dict(),
+            "created_at": self.created_at,
+        }
+
+
+@dataclass(slots=True)
+class TurnResult:
+    narration: str
+    choices: List[Dict] = field(default_factory=list)
+    log: List[str] = field(default_factory=list)
+    dice_results: List[Dict] = field(default_factory=list)
+    world_diff: Dict = field(default_factory=dict)
+    mode: str = "simple"
+    # GM のモデル振り分けの結果（{"tier": ..., "reason": ...}。振り分けなしなら空）
+    route: Dict = field(default_factory=dict)
+
+    def to_dict(self) -> Dict:
+        data = {
+            "narration": self.narration,
+            "choices": self.choices,
+            "log": self.log,
+            "dice_results": self.dice_results,
+            "world_diff": self.world_diff,
+            "mode": self.mode,
+        }
+        if self.route:
+            data["route"] = self.route
+        return data
@@ -0,0 +1,161 @@
+"""Per-session change events: in-process pub/sub with a pluggable cross-process backend.
+
+``services`` publishes small events after each committed write; the SSE endpoint in
+``app.py`` subscribes per session. The default ``LocalBackend`` only reaches subscribers in
+the same process. Set ``TRPG_EVENTS_BACKEND=redis`` to fan events out between processes via
+Redis pub/sub (connection from ``REDIS_HOST`` / ``REDIS_PORT`` / ``REDIS_DB``).
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import queue
+import threading
+from typing import Dict, Optional, Set
+
+# 購読者ごとのキュー上限。溢れたら差分を諦めてクライアントに再同期させる
+QUEUE_SIZE = 256
+RESYNC = "__resync__"
+
+
+class Subscription:
+    """1 クライアント分の購読。get() でイベント（JSON 文字列）を取り出す。"""
+
+    def __init__(self, backend: "LocalBackend", channel: str):
+        self.backend = backend
+        self.channel = channel
+        self.queue: "queue.Queue[str]" = queue.Queue(maxsize=QUEUE_SIZE)
+
+    def deliver(self, message: str) -> None:
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            # 取りこぼしが出たので溜まった分を捨てて再同期を促す
+            with self.queue.mutex:
+                self.queue.queue.clear()
+            self.queue.put_nowait(RESYNC)
+
+    def get(self, timeout: Optional[float] = None) -> Optional[str]:
+        # timeout 秒イベントが無ければ None（ハートビート送信の合図）
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self) -> None:
+        self.backend.unsubscribe(self)
+
+
+class LocalBackend:
+    """同一プロセス内だけで配信するバックエンド（Redis などの代替としても使える）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+
+    def wants(self, channel: str) -> bool:
+        # 購読者がいないチャンネルはシリアライズ自体を省く
+        return channel in self._subscribers
+
+    def publish(self, channel: str, message: str) -> None:
+        subs = self._subscribers.get(channel)
+        if not subs:
+            return
+        with self._lock:
+            targets = list(subs)
+        for sub in targets:
+            sub.deliver(message)
+
+    def subscribe(self, channel: str) -> Subscription:
+        sub = Subscription(self, channel)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            subs = self._subscribers.get(sub.channel)
+            if subs:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.channel]
+
+
+class RedisBackend:
+    """Redis pub/sub で複数プロセスへ配信するバックエンド。受信側はローカル配信に委ねる。"""
+
+    def __init__(self, client, namespace: str = "trpg"):
+        self.client = client
+        self.prefix = f"{namespace}:events:"
+        self.local = LocalBackend()
+        self._listener: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def wants(self, channel: str) -> bool:
+        # 他プロセスの購読者は見えないので常に配信する
+        return True
+
+    def publish(self, channel: str, message: str) -> None:
+        self.client.publish(self.prefix + channel, message)
+
+    def subscribe(self, channel: str) -> Subscription:
+        self._ensure_listener()
+        return self.local.subscribe(channel)
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        self.local.unsubscribe(sub)
+
+    def _ensure_listener(self) -> None:
+        # プロセスごとに 1 本だけパターン購読スレッドを起動
+        with self._lock:
+            if self._listener is not None:
+                return
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            pubsub.psubscribe(self.prefix + "*")
+            self._listener = threading.Thread(target=self._listen, args=(pubsub,), daemon=True)
+            self._listener.start()
+
+    def _listen(self, pubsub) -> None:
+        for msg in pubsub.listen():
+            if msg.get("type") != "pmessage":
+                continue
+            channel = _text(msg["channel"])[len(self.prefix):]
+            self.local.publish(channel, _text(msg["data"]))
+
+
+def _text(value) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def _default_backend():
+    # 環境変数からバックエンドを選ぶ（既定はプロセス内配信）
+    if os.getenv("TRPG_EVENTS_BACKEND", "local").lower() == "redis":
+        import redis
+
+        client = redis.Redis(
+            host=os.getenv("REDIS_HOST", "localhost"),
+            port=int(os.getenv("REDIS_PORT", "6379")),
+            db=int(os.getenv("REDIS_DB", "0")),
+        )
+        return RedisBackend(client, namespace=os.getenv("GAME_REDIS_NS", "trpg"))
+    return LocalBackend()
+
+
+backend = _default_backend()
+
+
+def set_backend(new_backend) -> None:
+    # テストや別実装への差し替え用
+    global backend
+    backend = new_backend
+
+
+def publish(session_id: Optional[str], event: Dict) -> None:
+    """セッションの変更イベントを配信する（購読者がいなければほぼ何もしない）。"""
+    if session_id and backend.wants(session_id):
+        backend.publish(session_id, json.dumps(event, ensure_ascii=False, default=str))
+
+
+def subscribe(session_id: str) -> Subscription:
+    return backend.subscribe(session_id)
@@ -1,18 +1,64 @@
 from __future__ import annotations
 
+import contextvars
+import functools
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from dataclasses import dataclass
 from typing import Dict, List, Optional
 
-from . import services
-from .tools import Toolset
+from . import intents, memory, metrics, model_backends, resilience, scenario, services, tool_executor, tracing
+from .domain import TurnResult
+from .tools import SpeculativeToolset, Toolset
 
 
 GM_SYSTEM_PROMPT = """You are a tabletop RPG Game Master running a solo adventure.
 You must keep narration concise and respect the player's safety settings and world tone.
 All dice rolls or state changes MUST be done through provided tools; never fabricate numbers.
+Use search_history to recall earlier events instead of guessing what happened before.
+Use recall_memories to find past turns about the same people, places or things, even when worded differently.
 Respond with vivid narration plus clear next choices when appropriate."""
 
 
+# SimpleNarrator が出す選択肢のうち、ルールだけで解決できるもの -> 行動（SimpleNarrator への入力）
+RULE_CHOICES = {"search": "search", "search_again": "search", "attack_again": "attack"}
+# SimpleNarrator がルールだけで解決できる意図（intents の意図表の名前）と、技能判定の難易度
+RULE_INTENTS = ("skill_check", "search", "attack")
+SKILL_ACTION_DC = 12
+# 小モデル（未設定なら小モデル層は使わない）と、小モデルに回す入力の最大語数
+# tiered（既定）: 安い層から振り分ける / off: DeepAgents 有効時は全ターンを大モデルへ
+ROUTING = os.getenv("GM_ROUTING", "tiered").lower()
+SMALL_MODEL = os.getenv("GM_SMALL_MODEL", "")
+SMALL_MAX_WORDS = int(os.getenv("GM_SMALL_MAX_WORDS", "6"))
+
+
+def _tier_costs(spec: str) -> Dict[str, float]:
+    # "large=1,small=0.1,rules=0" 形式の相対コスト
+    costs = {"large": 1.0, "small": 0.1, "rules": 0.0}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        tier, _, value = item.partition("=")
+        costs[tier.strip()] = float(value)
+    return costs
+
+
+TIER_COSTS = _tier_costs(os.getenv("GM_TIER_COST", ""))
+# モデル呼び出しを締め切り付きで待つためのスレッド数（締め切り後も戻らない呼び出しが一時的に占有する）
+MODEL_THREADS = int(os.getenv("GM_MODEL_THREADS", "16"))
+# モデル層を使わず SimpleNarrator で答えた理由（大モデルの所要時間を節約したとは数えない）
+FALLBACK_REASONS = ("model_unavailable", "context_error", "breaker_open", "model_timeout", "model_error", "state_changed")
+
+metrics.COUNTERS.update(
+    {
+        "trpg_gm_route_total": "GM turns by routing tier and reason.",
+        "trpg_gm_route_saved_seconds_total": "Estimated large-model latency avoided by cheaper tiers.",
+        "trpg_gm_route_saved_cost_total": "Relative model cost avoided by cheaper tiers (GM_TIER_COST units).",
+    }
+)
+
+
 class SimpleNarrator:
     """Fallback GM behavior when DeepAgents or model access is unavailable."""
 
@@ -20,15 +66,24 @@ class SimpleNarrator:
         self.toolset = toolset
         self.session = session
 
-    def take_turn(self, player_input: str, selected_choice_id: Optional[str]) -> Dict:
+    def take_turn(self, player_input: str, selected_choice_id: Optional[str]) -> TurnResult:
         # 簡易 GM ロジックで 1 ターン分の結果を返す
         log: List[str] = []
         dice_results: List[Dict] = []
         world_diff: Dict = {}
         narration_parts: List[str] = []
 
-        player_input_lower = (player_input or "").lower()
-        primary_char = (self.session.get("characters") or [None])[0]
+        # シナリオが設定されていて、このシーンで扱える入力ならそちらで解決する
+        story = scenario.for_session(self.session)
+        if story is not None:
+            result = story.resolve(self.toolset, self.session, player_input, selected_choice_id)
+            if result is not None:
+                return result
+
+        characters = self.session.get("characters") or []
+        primary_char = characters[0] if characters else None
+        intent = intents.match(player_input, characters)
+        action = intent.intent if intent else None
 
         if not primary_char:
             narration_parts.append("No player character exists yet. Create one to begin the adventure.")
@@ -37,7 +92,19 @@ class SimpleNarrator:
                 {"id": "wait", "text": "Wait"},
             ]
         else:
-            if "search" in player_input_lower or "look" in player_input_lower:
+            if action == "skill_check":
+                skill = intent.args["skill"]
+                outcome = self.toolset.request_skill_check(primary_char["id"], skill, SKILL_ACTION_DC)
+                log.append(outcome.get("detail", f"Performed a {skill} check."))
+                dice_results.extend(outcome.get("rolls", []))
+                narration_parts.append(
+                    f"Your {skill} carries the moment." if outcome.get("success") else f"Your {skill} falls short this time."
+                )
+                choices = [
+                    {"id": "search", "text": "Search the surroundings"},
+                    {"id": "move_on", "text": "Move on cautiously"},
+                ]
+            elif action == "search":
                 outcome = self.toolset.request_skill_check(primary_char["id"], "perception", 12)
                 log.append(outcome.get("detail", "Performed a perception check."))
                 dice_results.extend(outcome.get("rolls", []))
@@ -55,9 +122,10 @@ class SimpleNarrator:
                         {"id": "search_again", "text": "Search again"},
                         {"id": "move_on", "text": "Move on cautiously"},
                     ]
-            elif "attack" in player_input_lower or "strike" in player_input_lower:
-                targets = self.session.get("characters") or []
-                target = targets[1] if len(targets) > 1 else None
+            elif action == "attack":
+                # 名前で指された相手（自分以外）を優先し、なければ 2 人目
+                named = [c for c in characters[1:] if c["id"] in intent.args.get("targets", ())]
+                target = named[0] if named else (characters[1] if len(characters) > 1 else None)
                 if target:
                     outcome = self.toolset.attack_roll(
                         primary_char["id"],
@@ -66,7 +134,6 @@ class SimpleNarrator:
                     )
                     log.append(outcome.get("detail", "Attack resolved."))
                     dice_results.extend(outcome.get("rolls", []))
-                    self.session = services.get_session(self.session["id"]) or self.session
                     narration_parts.append("Steel clashes as you press the attack.")
                 else:
                     narration_parts.append("You practice your swings against a worn training dummy.")
@@ -85,75 +152,245 @@ class SimpleNarrator:
                 ]
 
         narration = " ".join(narration_parts) or "The story advances."
-        state = services.summarize_state(services.get_session(self.session["id"]))
-        return {
-            "narration": narration,
-            "choices": choices,
-            "log": log,
-            "dice_results": dice_results,
-            "world_diff": world_diff,
-            "state": state,
-            "mode": "simple",
-        }
-
-
-def _build_deep_agent(toolset: Toolset):
-    # DeepAgents が有効ならエージェントを生成
-    if os.getenv("USE_DEEPAGENTS") not in ("1", "true", "True"):
+        # 状態は呼び出し側が Toolset の変更記録から差分として組み立てる
+        return TurnResult(
+            narration=narration,
+            choices=choices,
+            log=log,
+            dice_results=dice_results,
+            world_diff=world_diff,
+            mode="simple",
+        )
+
+
+def _deep_agents_enabled() -> bool:
+    return os.getenv("USE_DEEPAGENTS") in ("1", "true", "True")
+
+
+def _model_name() -> str:
+    return os.getenv("GM_MODEL", "gpt-4o-mini")
+
+
+@functools.lru_cache(maxsize=4)
+def _chat_model(model_name: str):
+    # モデルクライアントはモデル名ごとにプロセスで 1 つだけ作る（重い import と初期化をターンごとに繰り返さない）
+    try:
+        from langchain.chat_models import init_chat_model
+    except Exception:
+        return None
+    return init_chat_model(model=model_name, timeout=resilience.TURN_DEADLINE_SECONDS)
+
+
+def warm_up() -> None:
+    # 起動時に DeepAgents 周りを読み込んでおき、最初のターンの遅延をなくす（fake などのローカル実装は不要）
+    if not _deep_agents_enabled():
+        return
+    for model_name in filter(None, (_model_name(), SMALL_MODEL)):
+        if model_backends.factory_for(model_name) is None:
+            _chat_model(model_name)
+
+
+def _build_deep_agent(toolset: Toolset, model_name: Optional[str] = None):
+    # DeepAgents が有効ならエージェントを生成（モデル名が登録済みのバックエンドならそちらを使う）
+    if not _deep_agents_enabled():
         return None
+    model_name = model_name or _model_name()
+    factory = model_backends.factory_for(model_name)
+    if factory is not None:
+        return factory(toolset, model_name)
     try:
         from deepagents import create_deep_agent
-        from langchain.chat_models import init_chat_model
     except Exception:
         return None
-    model_name = os.getenv("GM_MODEL", "gpt-4o-mini")
-    model = init_chat_model(model=model_name)
+    model = _chat_model(model_name)
+    if model is None:
+        return None
+    # DeepAgents は 1 ステップのツール呼び出しを別々のスレッドで呼ぶので、足跡が競合するものは直列にする
+    locks = tool_executor.FootprintLocks()
     tools = [
-        toolset.request_skill_check,
-        toolset.attack_roll,
-        toolset.query_game_state,
-        toolset.update_world_fact,
-        toolset.evaluate_rule,
+        tool_executor.serialized(tool, locks)
+        for tool in (
+            toolset.request_skill_check,
+            toolset.attack_roll,
+            toolset.query_game_state,
+            toolset.search_history,
+            toolset.recall_memories,
+            toolset.update_world_fact,
+            toolset.evaluate_rule,
+        )
     ]
     return create_deep_agent(model=model, tools=tools, system_prompt=GM_SYSTEM_PROMPT)
 
 
+def build_messages(session_id: str, player_input: str) -> List[Dict]:
+    """モデルに渡すメッセージ。意味記憶が有効なら、入力に近い過去のターンを system メッセージで添える。"""
+    messages = [{"role": "system", "content": GM_SYSTEM_PROMPT}]
+    recalled = services.recall_memories(session_id, player_input, memory.TOP_K)
+    if recalled:
+        lines = [f"- (turn {item['turn_no']}) {item['player_input']} -> {item['narration']}" for item in recalled]
+        messages.append({"role": "system", "content": "Relevant past events:\n" + "\n".join(lines)})
+    messages.append({"role": "user", "content": player_input or ""})
+    return messages
+
+
+@dataclass(slots=True)
+class Route:
+    tier: str  # rules / small / large
+    reason: str
+    action: str  # その層に渡す入力（rules なら SimpleNarrator 向けに正規化したもの）
+
+
+def classify_turn(player_input: str, selected_choice_id: Optional[str], session: Optional[Dict] = None) -> Route:
+    """ターンを安い順に振り分ける: シナリオ・既知の選択肢・技能判定・キーワード意図はルールで、短い入力は小モデル、残りは大モデル。"""
+    if ROUTING == "off":
+        return Route("large", "routing_off", player_input or "")
+    story = scenario.for_session(session) if session else None
+    if story is not None and story.handles(session, player_input, selected_choice_id):
+        return Route("rules", "scenario", player_input or "")
+    if selected_choice_id in RULE_CHOICES:
+        return Route("rules", "choice", RULE_CHOICES[selected_choice_id])
+    intent = intents.match(player_input)
+    if intent is not None and intent.intent in RULE_INTENTS:
+        return Route("rules", "rules_action" if intent.intent == "skill_check" else "intent", player_input or "")
+    if SMALL_MODEL and len((player_input or "").split()) <= SMALL_MAX_WORDS:
+        return Route("small", "short_input", player_input or "")
+    return Route("large", "open_ended", player_input or "")
+
+
+class _RouteStats:
+    """大モデル 1 ターンの所要時間の移動平均（安い層で節約できた時間の見積もりに使う）。"""
+
+    def __init__(self, estimate: float):
+        self.large_seconds = estimate
+        self._observed = False
+        self._lock = threading.Lock()
+
+    def observe_large(self, seconds: float) -> None:
+        with self._lock:
+            self.large_seconds = seconds if not self._observed else 0.8 * self.large_seconds + 0.2 * seconds
+            self._observed = True
+
+
+# 実測が入るまでの大モデルの所要時間の見積もり
+route_stats = _RouteStats(float(os.getenv("GM_LARGE_LATENCY_MS", "2000")) / 1000)
+
+
+def _record_route(route: Route, seconds: float) -> None:
+    metrics.inc("trpg_gm_route_total", tier=route.tier, reason=route.reason)
+    if route.tier == "large":
+        route_stats.observe_large(seconds)
+        return
+    if route.reason in FALLBACK_REASONS:
+        return
+    metrics.inc("trpg_gm_route_saved_seconds_total", max(0.0, route_stats.large_seconds - seconds), tier=route.tier)
+    metrics.inc("trpg_gm_route_saved_cost_total", TIER_COSTS["large"] - TIER_COSTS.get(route.tier, 0.0), tier=route.tier)
+
+
+_model_pool: Optional[ThreadPoolExecutor] = None
+_model_pool_lock = threading.Lock()
+
+
+def _shared_model_pool() -> ThreadPoolExecutor:
+    # プロセスで 1 つ、最初に使うときに作る（pre-fork の親では作らない）
+    global _model_pool
+    if _model_pool is None:
+        with _model_pool_lock:
+            if _model_pool is None:
+                _model_pool = ThreadPoolExecutor(max_workers=MODEL_THREADS, thread_name_prefix="trpg-model")
+    return _model_pool
+
+
 class GMAgent:
     # DeepAgents またはフォールバックで GM 振る舞いを提供
-    def __init__(self, session: Dict):
+    def __init__(self, session: Dict, toolset: Optional[Toolset] = None):
         self.session = session
-        self.toolset = Toolset(session["id"])
-        self.deep_agent = _build_deep_agent(self.toolset)
+        self.toolset = toolset or Toolset(session["id"])
         self.fallback = SimpleNarrator(self.toolset, session)
+        # モデルのツールはターン開始時点のスナップショット上の下書きに書き、呼び出しが成功したときだけ toolset に反映する。
+        # 失敗・締め切り超過なら下書きごと捨てるので、フォールバックの書き込みと重ならない（GMAgent は 1 ターンに 1 つ）
+        self.draft = SpeculativeToolset(session)
 
-    def take_turn(self, player_input: str, selected_choice_id: Optional[str]) -> Dict:
-        # Deep agent integration would go here; fallback keeps flow working offline.
-        if self.deep_agent:
-            try:
-                payload = {
-                    "messages": [
-                        {"role": "system", "content": GM_SYSTEM_PROMPT},
-                        {"role": "user", "content": player_input or ""},
-                    ]
-                }
-                response = self.deep_agent.invoke(payload)
-                return {
-                    "narration": response.get("content", ""),
-                    "choices": response.get("choices", []),
-                    "log": response.get("log", []),
-                    "dice_results": response.get("dice_results", []),
-                    "world_diff": response.get("world_diff", {}),
-                    "state": services.summarize_state(services.get_session(self.session["id"])),
-                    "mode": "deep_agent",
-                }
-            except Exception as exc:  # fall back on errors
-                return {
-                    "narration": f"(DeepAgent failed: {exc}) Falling back to simple GM.",
-                    "choices": [],
-                    "log": [],
-                    "dice_results": [],
-                    "world_diff": {},
-                    "state": services.summarize_state(services.get_session(self.session["id"])),
-                    "mode": "deep_agent_error",
-                }
-        return self.fallback.take_turn(player_input, selected_choice_id)
+    @functools.cached_property
+    def deep_agent(self):
+        # 大モデルのエージェントは実際に使うターンでだけ組み立てる
+        return _build_deep_agent(self.draft)
+
+    @functools.cached_property
+    def small_agent(self):
+        return _build_deep_agent(self.draft, SMALL_MODEL) if SMALL_MODEL else None
+
+    @tracing.traced()
+    def take_turn(self, player_input: str, selected_choice_id: Optional[str]) -> TurnResult:
+        # DeepAgents 有効時は安い層から順に振り分け、大モデルは自由記述のターンだけに使う
+        if not _deep_agents_enabled():
+            with metrics.timer("model", mode="simple"):
+                return self.fallback.take_turn(player_input, selected_choice_id)
+        route = classify_turn(player_input, selected_choice_id, self.session)
+        start = time.perf_counter()
+        with tracing.span("gm_agent.route", tier=route.tier, reason=route.reason):
+            result = self._run_tier(route, player_input, selected_choice_id)
+        _record_route(route, time.perf_counter() - start)
+        result.route = {"tier": route.tier, "reason": route.reason}
+        return result
+
+    def _run_tier(self, route: Route, player_input: str, selected_choice_id: Optional[str]) -> TurnResult:
+        if route.tier == "small" and self.small_agent is not None:
+            result = self._invoke(self.small_agent, SMALL_MODEL, player_input, "small_model", route)
+        elif route.tier != "rules" and self.deep_agent is not None:
+            if route.tier == "small":
+                # 小モデルが無いので大モデルで答える（計測と応答の route を実際に使った層に合わせる）
+                route.tier, route.reason = "large", "small_model_unavailable"
+            result = self._invoke(self.deep_agent, _model_name(), player_input, "deep_agent", route)
+        else:
+            result = None
+            if route.tier != "rules":
+                # モデルを組み立てられなかった（deepagents 未導入など）
+                route.tier, route.reason = "rules", "model_unavailable"
+        if result is not None:
+            return result
+        with metrics.timer("model", mode="simple"):
+            return self.fallback.take_turn(route.action, selected_choice_id)
+
+    def _invoke(self, agent, model_name: str, player_input: str, mode: str, route: Route) -> Optional[TurnResult]:
+        """締め切り付きでモデルを呼ぶ。ブレーカーが開いている・締め切り超過・失敗のときは route を書き換えて None を返す。"""
+        # 文脈（記憶・履歴検索・DB 読み取り）は先に組み立てる。ここで落ちてもブレーカーの試行枠を消費しない
+        try:
+            payload = {"messages": build_messages(self.session["id"], player_input)}
+        except Exception:
+            route.tier, route.reason = "rules", "context_error"
+            return None
+        breaker = resilience.breaker(model_name)
+        if not breaker.allow():
+            route.tier, route.reason = "rules", "breaker_open"
+            return None
+        start = time.perf_counter()
+        try:
+            with metrics.timer("model", mode=mode), tracing.span(f"gm_agent.{mode}.invoke"):
+                # 締め切りはモデル呼び出しのスレッドとそこから呼ばれるツールに引き継がれる
+                with resilience.deadline(resilience.TURN_DEADLINE_SECONDS):
+                    future = _shared_model_pool().submit(contextvars.copy_context().run, agent.invoke, payload)
+                    response = future.result(timeout=max(0.0, resilience.remaining()))
+        except (FutureTimeout, resilience.DeadlineExceeded):
+            # 戻らない呼び出しは放置する（その後のツール呼び出しも捨てた下書きに書くだけ）
+            metrics.inc("trpg_deadline_exceeded_total", call=mode)
+            breaker.record(time.perf_counter() - start, ok=False)
+            route.tier, route.reason = "rules", "model_timeout"
+            return None
+        except Exception:
+            breaker.record(time.perf_counter() - start, ok=False)
+            route.tier, route.reason = "rules", "model_error"
+            return None
+        breaker.record(time.perf_counter() - start)
+        # 下書きの書き込みを 1 トランザクションで反映する。衝突とみなすのは下書きが読んだキャラクター・世界フラグが
+        # 変わっていたときだけ（モデルが考えている間の無関係なダイスロールやキャラクター更新では捨てない）
+        if not self.toolset.commit_writes(self.draft.writes, expected_state=self.draft.expected_state()):
+            route.tier, route.reason = "rules", "state_changed"
+            return None
+        return TurnResult(
+            narration=response.get("content", ""),
+            choices=response.get("choices", []),
+            log=response.get("log", []),
+            dice_results=response.get("dice_results", []),
+            world_diff=response.get("world_diff", {}),
+            mode=mode,
+        )
@@ -0,0 +1,265 @@
+"""Full-text search over turn history (SQLite FTS5 with the trigram tokenizer).
+
+Each turn's player input and narration go into the ``turn_search`` FTS5 table in the same
+transaction that writes the turn log (``services._write_log_batch`` and session import), so
+the index never lags behind the log. Index rows are keyed by the turn log id and stay when
+``coldstore`` moves the turn into the archive DB, so archived turns remain searchable
+(on databases whose ``turn_logs`` table predates AUTOINCREMENT, a reused id replaces the
+archived turn's entry).
+
+The trigram tokenizer needs no word segmentation, so Japanese works as well as English.
+Terms of 3+ characters are looked up in the index. Shorter terms (``洞窟``, ``hp``) cannot use
+it and are checked as substrings on the candidate rows instead.
+
+Latency is bounded by ``TRPG_SEARCH_WINDOW`` (default 1000), not by the campaign length:
+
+- every row carries a 3-character session key (one trigram, hashed from the session id), so
+  the query ``session_key:"<key>" AND (terms)`` intersects posting lists instead of reading
+  other sessions' hits. The exact session id is checked on the rows that come back.
+- only the newest ``TRPG_SEARCH_WINDOW`` matching turns are read, and BM25 is computed over
+  that window here. FTS5's own ``bm25()`` would count hits across the whole table.
+
+Databases created before this index existed are filled with ``python -m trpg_app.history --rebuild``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import functools
+import hashlib
+import json
+import math
+import os
+import re
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select, text
+
+from . import coldstore, db
+from .models import Session, TurnLog
+
+# 順位付けの候補にする、セッション内で新しい順にヒットしたターンの上限
+SEARCH_WINDOW = int(os.getenv("TRPG_SEARCH_WINDOW", "1000"))
+MAX_LIMIT = 50
+# スニペットの長さ（文字数）
+SNIPPET_CHARS = 80
+MARK_OPEN, MARK_CLOSE, ELLIPSIS = "[", "]", "…"
+# trigram で索引を引ける最短の語
+MIN_TERM = 3
+# BM25 のパラメータ（FTS5 の bm25() と同じ値）
+BM25_K1, BM25_B = 1.2, 0.75
+
+# AUTOINCREMENT のない古い DB では、アーカイブ済みの最新ターンの ID が再利用されることがある。その場合は新しいターンで置き換える
+_INSERT = text(
+    "INSERT OR REPLACE INTO turn_search(rowid, player_input, narration, session_key, session_id, turn_no) "
+    "VALUES (:id, :player_input, :narration, :session_key, :session_id, :turn_no)"
+)
+_CANDIDATES = text(
+    "SELECT rowid AS id, turn_no, player_input, narration FROM turn_search "
+    "WHERE turn_search MATCH :match AND +session_id = :session_id ORDER BY rowid DESC LIMIT :window"
+)
+
+
+def _normalize(value: Optional[str]) -> str:
+    # 全角英数・半角カナを揃える（索引と検索語の両方に適用）
+    return unicodedata.normalize("NFKC", value or "")
+
+
+def _phrase(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+@functools.lru_cache(maxsize=4096)
+def session_key(session_id: str) -> str:
+    # セッション ID のハッシュを私用領域の 3 文字にする（trigram 1 個 = 転置リスト 1 本で絞れる）。衝突は session_id で除く
+    value = int.from_bytes(hashlib.blake2b(session_id.encode("utf-8"), digest_size=8).digest(), "big")
+    chars = []
+    for _ in range(3):
+        value, rest = divmod(value, 0x1900)
+        chars.append(chr(0xE000 + rest))
+    return "".join(chars)
+
+
+@functools.lru_cache(maxsize=1)
+def available() -> bool:
+    # FTS5 / trigram のない SQLite では索引テーブルが作られない（db._ensure_schema）
+    with db.session_scope() as orm:
+        return orm.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'turn_search'")
+        ).first() is not None
+
+
+def index_turns(orm, rows: Iterable[Tuple[int, Dict]]) -> int:
+    """(ターンログ ID, 行の値) を呼び出し側のトランザクションで索引に足す。gm_output は db.dumps 済みの値。"""
+    if not available():
+        return 0
+    params = [
+        {
+            "id": row_id,
+            "player_input": _normalize(values.get("player_input")),
+            "narration": _normalize((db.loads(values.get("gm_output")) or {}).get("narration")),
+            "session_key": session_key(values["session_id"]),
+            "session_id": values["session_id"],
+            "turn_no": values.get("turn_no"),
+        }
+        for row_id, values in rows
+    ]
+    if params:
+        orm.execute(_INSERT, params)
+    return len(params)
+
+
+def _terms(query: str) -> Tuple[List[str], List[str]]:
+    # 空白区切りの語を、索引で引ける語（3 文字以上）と部分文字列で確かめる語に分ける（小文字で比較）
+    long_terms: List[str] = []
+    short_terms: List[str] = []
+    for term in _normalize(query).lower().split():
+        bucket = long_terms if len(term) >= MIN_TERM else short_terms
+        if term not in bucket:
+            bucket.append(term)
+    return long_terms, short_terms
+
+
+def _snippet(value: str, pattern: "re.Pattern") -> str:
+    # 最初のヒットの前後を切り出し、範囲内のヒットに印を付ける
+    hit = pattern.search(value)
+    start = max(0, hit.start() - SNIPPET_CHARS // 3) if hit else 0
+    end = min(len(value), start + SNIPPET_CHARS)
+    body = pattern.sub(lambda m: MARK_OPEN + m.group(0) + MARK_CLOSE, value[start:end])
+    return (ELLIPSIS if start else "") + body + (ELLIPSIS if end < len(value) else "")
+
+
+def _rank(rows, terms: List[str]) -> List[Tuple[float, object]]:
+    # 候補ウィンドウの中で BM25 を計算する（文書頻度・平均長もウィンドウ内の値）
+    docs = [((row.player_input or "") + "\n" + (row.narration or "")).lower() for row in rows]
+    if not docs:
+        return []
+    average = sum(len(doc) for doc in docs) / len(docs) or 1.0
+    counts = [[doc.count(term) for term in terms] for doc in docs]
+    idf = []
+    for i in range(len(terms)):
+        df = sum(1 for tf in counts if tf[i])
+        idf.append(math.log((len(docs) - df + 0.5) / (df + 0.5) + 1.0))
+    scored = []
+    for row, doc, tfs in zip(rows, docs, counts):
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * len(doc) / average)
+        scored.append((sum(w * tf * (BM25_K1 + 1) / (tf + norm) for w, tf in zip(idf, tfs) if tf), row))
+    return scored
+
+
+def search(session_id: str, query: str, limit: int = 10) -> List[Dict]:
+    """セッションのターン履歴を検索し、関連度の高い順に {id, turn_no, player_input, snippet, score} を返す。"""
+    long_terms, short_terms = _terms(query)
+    if not (long_terms or short_terms) or not available():
+        return []
+    limit = max(1, min(int(limit), MAX_LIMIT))
+    match = f"session_key : {_phrase(session_key(session_id))}"
+    if long_terms:
+        match += " AND {player_input narration} : (" + " AND ".join(_phrase(t) for t in long_terms) + ")"
+    with db.session_scope() as orm:
+        rows = orm.execute(_CANDIDATES, {"match": match, "session_id": session_id, "window": SEARCH_WINDOW}).all()
+    if short_terms:
+        rows = [
+            row
+            for row in rows
+            if all(t in (row.player_input or "").lower() or t in (row.narration or "").lower() for t in short_terms)
+        ]
+    terms = long_terms + short_terms
+    ranked = sorted(_rank(rows, terms), key=lambda item: (-item[0], -item[1].id))[:limit]
+    pattern = re.compile("|".join(re.escape(t) for t in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    results = []
+    for score, row in ranked:
+        narration = row.narration or ""
+        source = narration if pattern.search(narration) else row.player_input or ""
+        results.append(
+            {
+                "id": row.id,
+                "turn_no": row.turn_no,
+                "player_input": row.player_input,
+                "snippet": _snippet(source, pattern),
+                "score": round(score, 4),
+            }
+        )
+    return results
+
+
+def _values(row) -> Dict:
+    return {"player_input": row.player_input, "gm_output": row.gm_output, "session_id": row.session_id, "turn_no": row.turn_no}
+
+
+def rebuild(session_id: Optional[str] = None, batch_size: int = 500) -> Dict[str, int]:
+    """索引を作り直す（索引導入前の DB や、索引を消したとき用）。アーカイブ済みのターンも含める。"""
+    if not available():
+        raise RuntimeError("this SQLite build has no FTS5 trigram tokenizer")
+    with db.session_scope() as orm:
+        if session_id:
+            orm.execute(
+                text("DELETE FROM turn_search WHERE turn_search MATCH :match AND +session_id = :sid"),
+                {"match": f"session_key : {_phrase(session_key(session_id))}", "sid": session_id},
+            )
+            session_ids = [session_id]
+        else:
+            orm.execute(text("DELETE FROM turn_search"))
+            session_ids = list(orm.execute(select(Session.id)).scalars())
+    counts: Dict[str, int] = {}
+    for sid in session_ids:
+        count = 0
+        batch: List[Tuple[int, Dict]] = []
+        archived_upto = coldstore.archived_upto(sid, "turn_log")
+        for row in coldstore.iter_rows(sid, "turn_log") if archived_upto else ():
+            batch.append((row.id, _values(row)))
+            if len(batch) >= batch_size:
+                with db.session_scope() as orm:
+                    count += index_turns(orm, batch)
+                batch = []
+        with db.session_scope() as orm:
+            count += index_turns(orm, batch)
+        # ホット側はキーセットページングで短いトランザクションに分ける
+        last_id = archived_upto
+        while True:
+            with db.session_scope() as orm:
+                rows = list(
+                    orm.execute(
+                        select(TurnLog)
+                        .where(TurnLog.session_id == sid, TurnLog.id > last_id)
+                        .order_by(TurnLog.id.asc())
+                        .limit(batch_size)
+                    ).scalars()
+                )
+                count += index_turns(orm, [(row.id, _values(row)) for row in rows])
+            if len(rows) < batch_size:
+                break
+            last_id = rows[-1].id
+        counts[sid] = count
+    return counts
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    # python -m trpg_app.history --rebuild [--session ID] / python -m trpg_app.history --session ID --query "goblin"
+    parser = argparse.ArgumentParser(description="Rebuild or query the turn history search index.")
+    parser.add_argument("--rebuild", action="store_true", help="re-index turns (all sessions unless --session is given)")
+    parser.add_argument("--optimize", action="store_true", help="merge the index segments into one")
+    parser.add_argument("--session", help="session id")
+    parser.add_argument("--query", help="search the session's history")
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args(argv)
+    if not (args.rebuild or args.optimize or args.query):
+        parser.error("--rebuild, --optimize or --query is required")
+    if args.query and not args.session:
+        parser.error("--query needs --session")
+    db.init_db()
+    output: Dict = {}
+    if args.rebuild:
+        output["indexed"] = rebuild(args.session)
+    if args.optimize:
+        with db.session_scope() as orm:
+            orm.execute(text("INSERT INTO turn_search(turn_search) VALUES ('optimize')"))
+        output["optimized"] = True
+    if args.query:
+        output["results"] = search(args.session, args.query, args.limit)
+    print(json.dumps(output, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Idempotency keys and in-flight coalescing for expensive endpoints (``/api/gm/turn``).
+
+A request that carries an ``Idempotency-Key`` runs at most once per (session, key):
+concurrent duplicates wait for the first computation and receive its response, and the
+finished response is kept for ``TRPG_IDEMPOTENCY_TTL`` seconds so a retry replays it
+without running the turn again. Reusing a key with a different request body is an error.
+Requests without a key are still coalesced with an identical request that is in flight
+(double clicks from older clients), but their results are not kept. Only results that
+``keep(result)`` accepts are kept: ``/api/gm/turn`` keeps 2xx responses, so a retry after
+a validation error or a failed log write runs the turn again instead of replaying the
+error for the whole TTL (concurrent duplicates still share the error response).
+
+Entries live in this process only. The pre-fork server (``trpg_app.server``) routes a
+session to one worker, so a retry reaches the process that holds the entry.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+from . import metrics
+
+TTL_SECONDS = float(os.getenv("TRPG_IDEMPOTENCY_TTL", "600"))
+MAX_ENTRIES = int(os.getenv("TRPG_IDEMPOTENCY_ENTRIES", "10000"))
+
+COMPUTED = "computed"
+COALESCED = "coalesced"
+REPLAYED = "replayed"
+
+metrics.COUNTERS["trpg_idempotency_total"] = "Idempotent requests by outcome (computed, coalesced, replayed, conflict)."
+
+
+class KeyReuseError(ValueError):
+    # 同じキーで中身の違うリクエストが来た
+    pass
+
+
+def fingerprint(payload: Any) -> str:
+    # リクエスト内容の指紋（キーの使い回しの検出と、キーなしリクエストの重複判定に使う）
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    __slots__ = ("fingerprint", "done", "result", "error", "expires")
+
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.expires = float("inf")
+
+
+class Coalescer:
+    """キーごとに計算を 1 回に束ね、完了した結果を TTL のあいだ返し続ける。"""
+
+    def __init__(self, ttl: float = TTL_SECONDS, max_entries: int = MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._calls: "OrderedDict[Hashable, _Call]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def run(
+        self,
+        key: Hashable,
+        request_fingerprint: str,
+        compute: Callable[[], Any],
+        store: bool = True,
+        keep: Optional[Callable[[Any], bool]] = None,
+    ) -> Tuple[Any, str]:
+        """compute() の結果と、その出どころ（computed / coalesced / replayed）を返す。
+
+        失敗した計算は保存しない（待っていた重複リクエストには同じ例外を送出し、次の再送で計算し直す）。
+        keep を渡すと、keep(結果) が偽の結果（エラー応答など）も保存せずに次の再送で計算し直す。
+        """
+        now = time.monotonic()
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None and call.expires <= now:
+                del self._calls[key]
+                call = None
+            owner = call is None
+            if owner:
+                call = self._calls[key] = _Call(request_fingerprint)
+            elif call.fingerprint != request_fingerprint:
+                metrics.inc("trpg_idempotency_total", outcome="conflict")
+                raise KeyReuseError("idempotency key was already used for a different request")
+        if not owner:
+            outcome = REPLAYED if call.done.is_set() else COALESCED
+            call.done.wait()
+            metrics.inc("trpg_idempotency_total", outcome=outcome)
+            if call.error is not None:
+                raise call.error
+            return call.result, outcome
+        try:
+            call.result = compute()
+        except BaseException as exc:
+            call.error = exc
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+            raise
+        with self._lock:
+            if store and (keep is None or keep(call.result)):
+                call.expires = time.monotonic() + self.ttl
+                self._evict()
+            else:
+                self._calls.pop(key, None)
+        call.done.set()
+        metrics.inc("trpg_idempotency_total", outcome=COMPUTED)
+        return call.result, COMPUTED
+
+    def _evict(self) -> None:
+        # 上限を超えた分を古い順に捨てる。実行中の計算（expires が無限大）は相乗りのために残す（ロック内で呼ぶ）
+        excess = len(self._calls) - self.max_entries
+        if excess <= 0:
+            return
+        finished = []
+        for key, call in self._calls.items():
+            if call.expires != float("inf"):
+                finished.append(key)
+                if len(finished) == excess:
+                    break
+        for key in finished:
+            del self._calls[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._calls.clear()
@@ -0,0 +1,189 @@
+"""Data-driven intent matching for player input (English and Japanese).
+
+The intent table (``trpg_app/data/intents.json``, override with ``TRPG_INTENTS_FILE``)
+lists intents with a priority and synonyms per language, plus argument vocabularies
+(skills). All patterns are compiled into one Aho-Corasick automaton, so matching is a
+single pass over the normalised input. The cost grows with the input length and the
+number of hits, not with the size of the vocabulary.
+
+Input and patterns are NFKC-normalised and lowercased, so full-width letters and
+half-width katakana match too. ASCII patterns must start at a word boundary
+(``hit`` does not match ``white``). Endings are left open so ``searching`` and ``attacks``
+still match. Japanese patterns match anywhere.
+
+``match`` returns the highest-priority intent whose required arguments were found, with
+earlier matches winning ties. Character names given in ``characters`` are matched as whole
+words and returned as ``args["targets"]`` (ids in order of appearance).
+"""
+
+from __future__ import annotations
+
+import functools
+import json
+import os
+import unicodedata
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+DEFAULT_FILE = Path(__file__).with_name("data") / "intents.json"
+INTENTS_FILE = os.getenv("TRPG_INTENTS_FILE", "")
+LANGUAGES = ("en", "ja")
+
+
+def normalize(text: Optional[str]) -> str:
+    # 全角英数・半角カナを揃えて小文字にする
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isascii() and (ch.isalnum() or ch == "_")
+
+
+class Automaton:
+    """Aho-Corasick 法で、登録した全パターンの出現を 1 回の走査で列挙する。"""
+
+    def __init__(self, patterns: Iterable[Tuple[str, Any]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # ノード -> そこで終わるパターンの (長さ, 付随データ)。失敗リンク先の分も含める
+        self._out: List[List[Tuple[int, Any]]] = [[]]
+        self.size = 0
+        for pattern, payload in patterns:
+            if not pattern:
+                continue
+            node = 0
+            for ch in pattern:
+                child = self._goto[node].get(ch)
+                if child is None:
+                    child = self._goto[node][ch] = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = child
+            self._out[node].append((len(pattern), payload))
+            self.size += 1
+        # 幅優先で失敗リンクを張る（根の子は根に戻る）
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                if self._out[self._fail[child]]:
+                    self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def finditer(self, text: str) -> Iterator[Tuple[int, int, Any]]:
+        """(開始, 終了, 付随データ) を終了位置の順に返す。"""
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for end, ch in enumerate(text, 1):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for length, payload in out[node]:
+                yield end - length, end, payload
+
+
+@dataclass(slots=True)
+class IntentMatch:
+    intent: str
+    priority: int
+    start: int
+    end: int
+    args: Dict[str, Any] = field(default_factory=dict)
+
+
+def _patterns(spec: Dict) -> Iterator[str]:
+    for language in LANGUAGES:
+        yield from spec.get(language, [])
+
+
+class IntentMatcher:
+    """意図表をまとめて 1 つのオートマトンにしたもの。"""
+
+    def __init__(self, table: Dict):
+        self.intents: Dict[str, Dict] = table.get("intents", {})
+        entries: List[Tuple[str, Tuple[str, str, bool]]] = []
+        for name, spec in self.intents.items():
+            entries.extend(self._entries("intent", name, _patterns(spec)))
+        for argument, values in table.get("arguments", {}).items():
+            for value, spec in values.items():
+                entries.extend(self._entries(argument, value, _patterns(spec)))
+        self.automaton = Automaton(entries)
+
+    @staticmethod
+    def _entries(kind: str, value: str, patterns: Iterable[str]) -> Iterator[Tuple[str, Tuple[str, str, bool]]]:
+        # ASCII で始まるパターンは語頭でだけ一致させる
+        for pattern in patterns:
+            pattern = normalize(pattern)
+            if pattern:
+                yield pattern, (kind, value, _is_word_char(pattern[0]))
+
+    @property
+    def size(self) -> int:
+        return self.automaton.size
+
+    def match(self, text: Optional[str], characters: Sequence[Dict] = ()) -> Optional[IntentMatch]:
+        """入力の意図と引数（skill など、characters を渡せば targets）を返す。該当しなければ None。"""
+        normalized = normalize(text)
+        found: Dict[str, Tuple[int, int]] = {}
+        args: Dict[str, Any] = {}
+        for start, end, (kind, value, word_start) in self.automaton.finditer(normalized):
+            if word_start and start and _is_word_char(normalized[start - 1]):
+                continue
+            if kind == "intent":
+                if value not in found or start < found[value][0]:
+                    found[value] = (start, end)
+            else:
+                args.setdefault(kind, value)
+        if not found:
+            return None
+        if characters:
+            targets = _find_names(normalized, tuple((c["id"], c.get("name") or "") for c in characters))
+            if targets:
+                args["targets"] = targets
+        ranked = sorted(found.items(), key=lambda item: (-self.intents[item[0]].get("priority", 0), item[1][0]))
+        for name, (start, end) in ranked:
+            spec = self.intents[name]
+            if all(arg in args for arg in spec.get("requires", ())):
+                return IntentMatch(name, spec.get("priority", 0), start, end, args)
+        return None
+
+
+@functools.lru_cache(maxsize=256)
+def _names_automaton(names: Tuple[Tuple[str, str], ...]) -> Automaton:
+    # セッションのキャラクター名はセッションごとに少数なので、名前の組ごとに別のオートマトンをキャッシュする
+    return Automaton((normalize(name), char_id) for char_id, name in names if name)
+
+
+def _find_names(normalized: str, names: Tuple[Tuple[str, str], ...]) -> List[str]:
+    # 名前は語として前後とも区切られているものだけ（ASCII の場合）
+    ids: List[str] = []
+    for start, end, char_id in _names_automaton(names).finditer(normalized):
+        if start and _is_word_char(normalized[start - 1]) and _is_word_char(normalized[start]):
+            continue
+        if end < len(normalized) and _is_word_char(normalized[end]) and _is_word_char(normalized[end - 1]):
+            continue
+        if char_id not in ids:
+            ids.append(char_id)
+    return ids
+
+
+def load_table(path: Optional[str] = None) -> Dict:
+    with open(path or INTENTS_FILE or DEFAULT_FILE, encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+@functools.lru_cache(maxsize=1)
+def default_matcher() -> IntentMatcher:
+    # 最初に使うときに意図表を読んでコンパイルする（bootstrap で先に済ませる）
+    return IntentMatcher(load_table())
+
+
+def match(text: Optional[str], characters: Sequence[Dict] = ()) -> Optional[IntentMatch]:
+    return default_matcher().match(text, characters)
@@ -0,0 +1,212 @@
+"""Write-behind group commit for append-only log rows (dice / turn logs).
+
+``TRPG_LOG_WRITER=sync`` (default) keeps one transaction per row. With ``batch`` a
+background thread drains a bounded queue and commits everything that arrived within
+``TRPG_LOG_FLUSH_MS`` (or ``TRPG_LOG_BATCH`` rows) in a single transaction, so several
+dice rolls in one GM turn share one fsync. Producers block when the queue is full
+(backpressure), readers call ``flush()`` first to see their own writes, and the queue
+is drained at interpreter exit. ``TRPG_LOG_DURABLE=1`` makes ``submit`` wait until the
+row's batch has committed (group commit without the write-behind window). If a batch
+fails to commit, its rows are retried one transaction each so a single bad row only
+fails its own ``Pending``.
+"""
+
+from __future__ import annotations
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, List, Optional, Sequence
+
+from . import metrics
+
+MODE = os.getenv("TRPG_LOG_WRITER", "sync").lower()
+FLUSH_MS = float(os.getenv("TRPG_LOG_FLUSH_MS", "5"))
+BATCH_SIZE = int(os.getenv("TRPG_LOG_BATCH", "64"))
+QUEUE_SIZE = int(os.getenv("TRPG_LOG_QUEUE", "1024"))
+DURABLE = os.getenv("TRPG_LOG_DURABLE") in ("1", "true", "True")
+
+metrics.COUNTERS.update(
+    {
+        "trpg_log_writer_batches_total": "Log writer transactions committed.",
+        "trpg_log_writer_rows_total": "Log rows written through the log writer.",
+        "trpg_log_writer_backpressure_total": "Submits that blocked because the log queue was full.",
+        "trpg_log_writer_errors_total": "Log writer batches that failed to commit.",
+    }
+)
+
+logger = logging.getLogger(__name__)
+_STOP = object()
+
+
+class Pending:
+    """キューに積んだ書き込みの結果（書き込み関数が返した値）を待つためのハンドル。"""
+
+    __slots__ = ("_event", "_value", "_error")
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._value: Any = None
+        self._error: Optional[BaseException] = None
+
+    @classmethod
+    def resolved(cls, value: Any) -> "Pending":
+        pending = cls()
+        pending.set(value)
+        return pending
+
+    def set(self, value: Any = None, error: Optional[BaseException] = None) -> None:
+        self._value = value
+        self._error = error
+        self._event.set()
+
+    def done(self) -> bool:
+        return self._event.is_set()
+
+    def result(self, timeout: Optional[float] = None) -> Any:
+        # コミットまで待って値を返す（失敗していれば例外を送出）
+        if not self._event.wait(timeout):
+            raise TimeoutError("log write still pending")
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class LogWriter:
+    """レコードをまとめて write_batch(records) -> results に渡すバックグラウンドライター。"""
+
+    def __init__(
+        self,
+        write_batch: Callable[[Sequence[Any]], List[Any]],
+        flush_ms: float = FLUSH_MS,
+        batch_size: int = BATCH_SIZE,
+        queue_size: int = QUEUE_SIZE,
+        durable: bool = DURABLE,
+    ):
+        self.write_batch = write_batch
+        self.interval = flush_ms / 1000.0
+        self.batch_size = max(1, batch_size)
+        self.durable = durable
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max(1, queue_size))
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def submit(self, record: Any) -> Pending:
+        """1 レコードを積む。キューが満杯なら空くまでブロックする。"""
+        if self._closed:
+            # 終了処理後の書き込みはその場で同期的に行う
+            return Pending.resolved(self.write_batch([record])[0])
+        self._ensure_thread()
+        pending = Pending()
+        try:
+            self._queue.put_nowait((record, pending))
+        except queue.Full:
+            metrics.inc("trpg_log_writer_backpressure_total")
+            self._queue.put((record, pending))
+        if self.durable:
+            pending.result()
+        return pending
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """ここまでに積まれたレコードがすべてコミットされるまで待つ（読み取り前のバリア）。"""
+        if self._thread is None or self._queue.unfinished_tasks == 0:
+            return
+        barrier = Pending()
+        self._queue.put((None, barrier))
+        barrier.result(timeout)
+
+    def close(self, timeout: Optional[float] = 10.0) -> None:
+        # 残りを書き切ってスレッドを止める（atexit から呼ばれる）
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+        if thread is not None:
+            self._queue.put((_STOP, None))
+            thread.join(timeout)
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trpg-log-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            # 最初の 1 件から FLUSH_MS 待つ間に来た分（最大 batch_size 件）をまとめる。バリアと停止は即時
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size and batch[-1][0] is not None and batch[-1][0] is not _STOP:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            stop = any(record is _STOP for record, _ in batch)
+            self._commit(batch)
+            if stop:
+                self._drain()
+                return
+
+    def _drain(self) -> None:
+        # 停止要求より後に積まれた分も取りこぼさずに書く
+        while True:
+            try:
+                batch = [self._queue.get_nowait()]
+            except queue.Empty:
+                return
+            self._commit(batch)
+
+    def _commit(self, batch: List) -> None:
+        writes = [(record, pending) for record, pending in batch if record is not None and record is not _STOP]
+        try:
+            if writes:
+                try:
+                    results = self.write_batch([record for record, _ in writes])
+                except Exception:
+                    metrics.inc("trpg_log_writer_errors_total")
+                    logger.exception("log writer batch of %d rows failed; retrying rows one by one", len(writes))
+                    self._commit_each(writes)
+                else:
+                    metrics.inc("trpg_log_writer_batches_total")
+                    metrics.inc("trpg_log_writer_rows_total", len(writes))
+                    for (_, pending), value in zip(writes, results):
+                        pending.set(value)
+            for record, pending in batch:
+                if record is None:
+                    pending.set()
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _commit_each(self, writes: List) -> None:
+        # まとめてのコミットに失敗したら 1 行ずつ書き直し、壊れた行の失敗だけをその呼び出し元に返す
+        for record, pending in writes:
+            try:
+                value = self.write_batch([record])[0]
+            except Exception as exc:
+                metrics.inc("trpg_log_writer_errors_total")
+                logger.exception("log writer row failed")
+                pending.set(error=exc)
+            else:
+                metrics.inc("trpg_log_writer_batches_total")
+                metrics.inc("trpg_log_writer_rows_total")
+                pending.set(value)
+
+
+def from_env(write_batch: Callable[[Sequence[Any]], List[Any]]) -> Optional[LogWriter]:
+    # TRPG_LOG_WRITER=batch のときだけライターを作る（sync なら None = 呼び出し側で直接書く）
+    if MODE != "batch":
+        return None
+    writer = LogWriter(write_batch)
+    atexit.register(writer.close)
+    return writer
@@ -0,0 +1,397 @@
+"""Offline semantic memory: a per-session vector index of past turns for GM context.
+
+Enabled with ``TRPG_MEMORY=1`` (needs numpy). Every committed turn log is embedded and
+appended to its session's index in ``TRPG_MEMORY_DIR`` (default ``*_memory/`` next to the
+DB). ``services.recall_memories`` returns the turns closest to a query. The GM context builder
+(``gm_agent.build_messages``) adds them to the prompt, and the GM can call them up with
+``Toolset.recall_memories``.
+
+Embedders are pluggable (``register_embedder`` / ``TRPG_MEMORY_EMBEDDER``). The built-in
+``hashing`` embedder needs no model or network. ASCII words and CJK character bigrams are
+hashed (CRC32, signed) into ``TRPG_MEMORY_DIM`` buckets with sublinear term frequency, and the
+vectors are L2-normalised. The index keeps per-bucket document frequencies and weights the
+query by IDF, so ranking behaves like hashed TF-IDF cosine similarity.
+
+Files per session (append-only; ``index.json`` is replaced last, so an interrupted append
+leaves the previous count and its tail is cut off on the next write):
+
+- ``vectors.f32``: float32 rows (count x dim), read through ``numpy.memmap``
+- ``meta.i64``: int64 rows (turn log id, turn_no, text offset, text length)
+- ``texts.bin``: the JSON-encoded input and narration of each memory
+- ``index.json``: embedder name, dim, count, last turn log id and document frequencies
+
+Appends are not locked across processes. The pre-fork server routes a session to one
+worker, so only that worker writes the session's index.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import unicodedata
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from . import coldstore, db, metrics
+from .models import Session, TurnLog
+
+ENABLED = os.getenv("TRPG_MEMORY") in ("1", "true", "True")
+MEMORY_DIR = os.getenv("TRPG_MEMORY_DIR") or os.path.splitext(db.DB_PATH)[0] + "_memory"
+EMBEDDER = os.getenv("TRPG_MEMORY_EMBEDDER", "hashing")
+DIM = int(os.getenv("TRPG_MEMORY_DIM", "256"))
+TOP_K = int(os.getenv("TRPG_MEMORY_TOP_K", "3"))
+# これより類似度の低い記憶は返さない（関係の薄いターンでプロンプトを埋めない）
+MIN_SCORE = float(os.getenv("TRPG_MEMORY_MIN_SCORE", "0.15"))
+# 開いたままにするセッション索引の数（memmap を持ち続ける上限）
+MAX_OPEN = int(os.getenv("TRPG_MEMORY_SESSIONS", "256"))
+# 記憶 1 件に残す本文の上限（文字数）
+TEXT_CHARS = 500
+
+metrics.COUNTERS.update(
+    {
+        "trpg_memory_added_total": "Turns embedded into the semantic memory index.",
+        "trpg_memory_errors_total": "Memory index appends that failed (the turn log itself was committed).",
+    }
+)
+
+_ID_RE = re.compile(r"^[A-Za-z0-9_-]+$")
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_CJK_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿]+")
+_META_COLUMNS = 4
+
+
+def _numpy():
+    import numpy
+
+    return numpy
+
+
+def _tokens(text: str) -> List[str]:
+    # 英数字は語、かな漢字は文字 bigram（1 文字だけの並びはその文字）
+    normalized = unicodedata.normalize("NFKC", text or "").lower()
+    tokens = _WORD_RE.findall(normalized)
+    for run in _CJK_RE.findall(normalized):
+        tokens.extend(run[i : i + 2] for i in range(max(1, len(run) - 1)))
+    return tokens
+
+
+class HashingEmbedder:
+    """語と和文の bigram を符号付きハッシュで dim 次元に落とす埋め込み（学習・ネットワーク不要）。"""
+
+    def __init__(self, dim: int = DIM):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts: Iterable[str]):
+        np = _numpy()
+        texts = list(texts)
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts: Dict[int, float] = {}
+            for token in _tokens(text):
+                h = zlib.crc32(token.encode("utf-8"))
+                bucket = h % self.dim
+                counts[bucket] = counts.get(bucket, 0.0) + (1.0 if h & 0x80000000 else -1.0)
+            for bucket, count in counts.items():
+                if count:
+                    vectors[row, bucket] = math.copysign(1.0 + math.log(abs(count)), count)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+
+# 埋め込み方式の名前 -> factory(dim)。factory が返すものは name / dim / embed(texts) -> (n, dim) float32 を持つ
+EMBEDDERS: Dict[str, Callable[[int], Any]] = {"hashing": HashingEmbedder}
+
+
+def register_embedder(name: str, factory: Callable[[int], Any]) -> None:
+    EMBEDDERS[name] = factory
+
+
+def make_embedder(name: str = EMBEDDER, dim: int = DIM):
+    if name not in EMBEDDERS:
+        raise ValueError(f"unknown memory embedder: {name}")
+    return EMBEDDERS[name](dim)
+
+
+def _turn_text(values: Dict) -> Tuple[str, str]:
+    # ターンログの行の値（gm_output は db.dumps 済み）から入力とナレーションを取り出す
+    narration = (db.loads(values.get("gm_output")) or {}).get("narration") or ""
+    return (values.get("player_input") or "")[:TEXT_CHARS], narration[:TEXT_CHARS]
+
+
+class SessionIndex:
+    """1 セッション分の記憶（ディレクトリ 1 つ）。追記と上位 k 件の検索。"""
+
+    def __init__(self, path: str, embedder):
+        self.path = path
+        self.embedder = embedder
+        self._lock = threading.Lock()
+        # MemoryStore.using で使用中の数（使用中の索引は閉じない。MemoryStore のロック下で増減する）
+        self.users = 0
+        self._vectors = None
+        self._meta = None
+        np = _numpy()
+        header = self._read_header()
+        if header and (header.get("embedder") != embedder.name or header.get("dim") != embedder.dim):
+            # 埋め込み方式が変わった索引は使わない（次の追記で切り詰めて作り直す。過去分は rebuild で）
+            header = None
+        self.count = header["count"] if header else 0
+        self.last_id = header["last_id"] if header else 0
+        self.text_bytes = header["text_bytes"] if header else 0
+        self.df = np.asarray(header["df"], dtype=np.int64) if header else np.zeros(embedder.dim, dtype=np.int64)
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _read_header(self) -> Optional[Dict]:
+        try:
+            with open(self._file("index.json"), encoding="utf-8") as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return None
+
+    def _write_header(self) -> None:
+        header = {
+            "embedder": self.embedder.name,
+            "dim": self.embedder.dim,
+            "count": self.count,
+            "last_id": self.last_id,
+            "text_bytes": self.text_bytes,
+            "df": self.df.tolist(),
+        }
+        tmp = self._file("index.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(header, fh)
+        os.replace(tmp, self._file("index.json"))
+
+    def _append(self, name: str, committed: int, payload: bytes) -> None:
+        # 途中で止まった追記の残り（ヘッダーの件数より後ろ）を切り詰めてから足す
+        path = self._file(name)
+        with open(path, "ab") as fh:
+            if fh.tell() != committed:
+                fh.truncate(committed)
+                fh.seek(committed)
+            fh.write(payload)
+
+    def add(self, rows: List[Tuple[int, int, str, str]]) -> int:
+        """(ターンログ ID, turn_no, 入力, ナレーション) を追記する。索引済みの ID は飛ばす。"""
+        np = _numpy()
+        with self._lock:
+            rows = [row for row in rows if row[0] > self.last_id]
+            if not rows:
+                return 0
+            os.makedirs(self.path, exist_ok=True)
+            vectors = self.embedder.embed(f"{player_input}\n{narration}" for _, _, player_input, narration in rows)
+            texts = [db.codec.encode({"input": player_input, "narration": narration}) for _, _, player_input, narration in rows]
+            meta = np.zeros((len(rows), _META_COLUMNS), dtype=np.int64)
+            offset = self.text_bytes
+            for i, ((row_id, turn_no, _, _), text) in enumerate(zip(rows, texts)):
+                meta[i] = (row_id, turn_no or 0, offset, len(text))
+                offset += len(text)
+            width = self.embedder.dim * 4
+            self._append("vectors.f32", self.count * width, vectors.astype(np.float32, copy=False).tobytes())
+            self._append("meta.i64", self.count * _META_COLUMNS * 8, meta.tobytes())
+            self._append("texts.bin", self.text_bytes, b"".join(texts))
+            self.df += np.count_nonzero(vectors, axis=0)
+            self.count += len(rows)
+            self.last_id = rows[-1][0]
+            self.text_bytes = offset
+            self._write_header()
+            self._vectors = self._meta = None
+            return len(rows)
+
+    def _maps(self):
+        # 件数が変わったときだけ memmap を開き直す
+        np = _numpy()
+        if self._vectors is None or len(self._vectors) != self.count:
+            self._vectors = np.memmap(self._file("vectors.f32"), dtype=np.float32, mode="r", shape=(self.count, self.embedder.dim))
+            self._meta = np.memmap(self._file("meta.i64"), dtype=np.int64, mode="r", shape=(self.count, _META_COLUMNS))
+        return self._vectors, self._meta
+
+    def search(self, query: str, k: int = TOP_K) -> List[Dict]:
+        """query に近い記憶を最大 k 件、近い順に返す。"""
+        np = _numpy()
+        with self._lock:
+            if not self.count or k <= 0:
+                return []
+            vectors, meta = self._maps()
+            idf = np.log((self.count + 1) / (self.df + 1)).astype(np.float32) + 1.0
+        weighted = self.embedder.embed([query])[0] * idf
+        if not weighted.any():
+            return []
+        scores = vectors @ weighted
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        # 重み付きの検索ベクトルの長さで割り、0〜1 程度のコサイン類似度にする
+        norm = float(np.linalg.norm(weighted)) or 1.0
+        results = []
+        with open(self._file("texts.bin"), "rb") as fh:
+            for i in top:
+                if scores[i] / norm < MIN_SCORE:
+                    break
+                row_id, turn_no, offset, length = (int(v) for v in meta[i])
+                fh.seek(offset)
+                text = db.codec.decode(fh.read(length))
+                results.append(
+                    {
+                        "id": row_id,
+                        "turn_no": turn_no,
+                        "player_input": text.get("input", ""),
+                        "narration": text.get("narration", ""),
+                        "score": round(float(scores[i] / norm), 4),
+                    }
+                )
+        return results
+
+
+class MemoryStore:
+    """セッションごとの SessionIndex を開いて持つ（開いている数は max_open まで、使われていない古いものから閉じる）。
+
+    追記中の索引を閉じると、同じセッションに新しい SessionIndex が作られて古いヘッダーを読み、
+    2 つが同じファイルに追記してしまう。そのため使用中（using の中）の索引は上限を超えても残す。
+    """
+
+    def __init__(self, directory: str = MEMORY_DIR, embedder=None, max_open: int = MAX_OPEN):
+        _numpy()  # TRPG_MEMORY=1 で numpy がなければここで ImportError
+        self.directory = directory
+        self.embedder = embedder or make_embedder()
+        self.max_open = max_open
+        self._indexes: "OrderedDict[str, SessionIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def using(self, session_id: str) -> Iterator[SessionIndex]:
+        """セッションの索引を使う間だけ確保する（その間は上限を超えても閉じない）。"""
+        if not _ID_RE.match(session_id or ""):
+            raise ValueError(f"invalid session id {session_id!r}")
+        with self._lock:
+            index = self._indexes.pop(session_id, None)
+            if index is None:
+                index = SessionIndex(os.path.join(self.directory, session_id), self.embedder)
+            self._indexes[session_id] = index
+            index.users += 1
+            self._evict()
+        try:
+            yield index
+        finally:
+            with self._lock:
+                index.users -= 1
+                self._evict()
+
+    def _evict(self) -> None:
+        # 上限を超えた分を使われていない古いものから閉じる（ロック内で呼ぶ）
+        excess = len(self._indexes) - self.max_open
+        if excess <= 0:
+            return
+        idle = [session_id for session_id, index in self._indexes.items() if not index.users][:excess]
+        for session_id in idle:
+            del self._indexes[session_id]
+
+    def add_turns(self, rows: Iterable[Tuple[int, Dict]]) -> int:
+        """コミット済みのターンログ (ID, 行の値) をセッションごとにまとめて追記する。"""
+        by_session: Dict[str, List[Tuple[int, int, str, str]]] = {}
+        for row_id, values in rows:
+            if values.get("session_id"):
+                by_session.setdefault(values["session_id"], []).append((row_id, values.get("turn_no"), *_turn_text(values)))
+        added = 0
+        for session_id, items in by_session.items():
+            with self.using(session_id) as index:
+                added += index.add(items)
+        if added:
+            metrics.inc("trpg_memory_added_total", added)
+        return added
+
+    def search(self, session_id: str, query: str, k: int = TOP_K) -> List[Dict]:
+        with self.using(session_id) as index:
+            return index.search(query, k)
+
+    def drop(self, session_id: str) -> None:
+        # セッションの記憶を消す（作り直す前に使う）
+        with self._lock:
+            self._indexes.pop(session_id, None)
+        shutil.rmtree(os.path.join(self.directory, session_id), ignore_errors=True)
+
+
+def from_env() -> Optional[MemoryStore]:
+    # TRPG_MEMORY=1 のときだけ作る
+    return MemoryStore() if ENABLED else None
+
+
+def _values(row) -> Dict:
+    return {"player_input": row.player_input, "gm_output": row.gm_output, "session_id": row.session_id, "turn_no": row.turn_no}
+
+
+def rebuild(store: MemoryStore, session_id: Optional[str] = None, batch_size: int = 500) -> Dict[str, int]:
+    """ターンログ（アーカイブ済みも含む）から記憶を作り直す。記憶を有効にする前のセッションや埋め込み方式の変更後に使う。"""
+    if session_id:
+        session_ids = [session_id]
+    else:
+        with db.session_scope() as orm:
+            session_ids = list(orm.execute(select(Session.id)).scalars())
+    counts: Dict[str, int] = {}
+    for sid in session_ids:
+        store.drop(sid)
+        count = 0
+        batch: List[Tuple[int, Dict]] = []
+        archived_upto = coldstore.archived_upto(sid, "turn_log")
+        for row in coldstore.iter_rows(sid, "turn_log") if archived_upto else ():
+            batch.append((row.id, _values(row)))
+            if len(batch) >= batch_size:
+                count += store.add_turns(batch)
+                batch = []
+        count += store.add_turns(batch)
+        last_id = archived_upto
+        while True:
+            with db.session_scope() as orm:
+                rows = [
+                    (row.id, _values(row))
+                    for row in orm.execute(
+                        select(TurnLog)
+                        .where(TurnLog.session_id == sid, TurnLog.id > last_id)
+                        .order_by(TurnLog.id.asc())
+                        .limit(batch_size)
+                    ).scalars()
+                ]
+            count += store.add_turns(rows)
+            if len(rows) < batch_size:
+                break
+            last_id = rows[-1][0]
+        counts[sid] = count
+    return counts
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    # python -m trpg_app.memory --rebuild [--session ID] / python -m trpg_app.memory --session ID --query "..."
+    parser = argparse.ArgumentParser(description="Rebuild or query the semantic memory index.")
+    parser.add_argument("--rebuild", action="store_true", help="re-embed turns (all sessions unless --session is given)")
+    parser.add_argument("--session", help="session id")
+    parser.add_argument("--query", help="find the session's turns closest to this text")
+    parser.add_argument("-k", type=int, default=TOP_K)
+    args = parser.parse_args(argv)
+    if not (args.rebuild or args.query):
+        parser.error("--rebuild or --query is required")
+    if args.query and not args.session:
+        parser.error("--query needs --session")
+    db.init_db()
+    store = MemoryStore()
+    output: Dict = {}
+    if args.rebuild:
+        output["indexed"] = rebuild(store, args.session)
+    if args.query:
+        output["results"] = store.search(args.session, args.query, args.k)
+    print(json.dumps(output, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""Lightweight in-process metrics with Prometheus text exposition and Server-Timing support.
+
+Enabled with ``TRPG_METRICS=1``. When disabled, ``timed`` returns the wrapped function
+unchanged, ``timer`` returns a shared no-op context manager and no SQLAlchemy hooks are
+installed, so instrumented code pays (almost) nothing.
+"""
+
+from __future__ import annotations
+
+import bisect
+import functools
+import os
+import threading
+import time
+from contextlib import nullcontext
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+ENABLED = os.getenv("TRPG_METRICS") in ("1", "true", "True")
+
+# Prometheus の既定に近いレイテンシ用バケット（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 計測の種類 -> (メトリクス名, 説明)。種類名は Server-Timing の項目名にも使う
+HISTOGRAMS: Dict[str, Tuple[str, str]] = {
+    "http": ("trpg_http_request_duration_seconds", "HTTP request latency by route."),
+    "db": ("trpg_db_query_duration_seconds", "SQL statement execution time."),
+    "dice": ("trpg_dice_roll_duration_seconds", "Dice expression evaluation time."),
+    "tool": ("trpg_tool_call_duration_seconds", "GM Toolset call time by tool."),
+    "model": ("trpg_model_inference_duration_seconds", "GM model / narrator inference time by mode."),
+}
+COUNTERS: Dict[str, str] = {}
+GAUGES: Dict[str, str] = {}
+
+_NOOP = nullcontext()
+_lock = threading.Lock()
+_histograms: Dict[Tuple[str, Tuple], "_Histogram"] = {}
+_counters: Dict[Tuple[str, Tuple], float] = {}
+_gauges: Dict[Tuple[str, Tuple], float] = {}
+# リクエスト単位の Server-Timing 集計（種類 -> [合計秒, 回数]）
+_request_timings: ContextVar[Optional[Dict[str, List[float]]]] = ContextVar("trpg_request_timings", default=None)
+
+
+class _Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(DEFAULT_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(DEFAULT_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+def _key(labels: Dict[str, str]) -> Tuple:
+    return tuple(sorted(labels.items()))
+
+
+def observe(kind: str, seconds: float, **labels) -> None:
+    # ヒストグラムへ 1 件記録し、リクエスト中なら Server-Timing にも積む
+    if not ENABLED:
+        return
+    key = (kind, _key(labels))
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = _Histogram()
+        hist.observe(seconds)
+    timings = _request_timings.get()
+    if timings is not None and kind != "http":
+        entry = timings.setdefault(kind, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+
+
+def inc(name: str, value: float = 1.0, **labels) -> None:
+    # カウンタを加算（name は COUNTERS に登録済みのもの）
+    if not ENABLED:
+        return
+    key = (name, _key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0.0) + value
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    # ゲージを設定（name は GAUGES に登録済みのもの）
+    if not ENABLED:
+        return
+    with _lock:
+        _gauges[(name, _key(labels))] = float(value)
+
+
+class _Timer:
+    __slots__ = ("kind", "labels", "start")
+
+    def __init__(self, kind: str, labels: Dict[str, str]):
+        self.kind = kind
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.kind, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def timer(kind: str, **labels):
+    """with metrics.timer("model", mode="simple"): ... の形で区間を計測する。"""
+    return _Timer(kind, labels) if ENABLED else _NOOP
+
+
+def timed(kind: str, **labels) -> Callable:
+    """関数呼び出しを計測するデコレータ。無効時は元の関数をそのまま返す。"""
+
+    def decorator(func: Callable) -> Callable:
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(kind, time.perf_counter() - start, **labels)
+
+        return wrapper
+
+    return decorator
+
+
+def start_request() -> None:
+    # リクエスト開始時に Server-Timing 用の集計領域を用意
+    if ENABLED:
+        _request_timings.set({})
+
+
+def server_timing(total_seconds: Optional[float] = None) -> Optional[str]:
+    # 現在のリクエストで集計した区間を Server-Timing ヘッダ値に整形
+    timings = _request_timings.get()
+    if timings is None:
+        return None
+    parts = [f'{kind};dur={dur * 1000:.2f};desc="{count}x"' for kind, (dur, count) in timings.items()]
+    if total_seconds is not None:
+        parts.append(f"total;dur={total_seconds * 1000:.2f}")
+    _request_timings.set(None)
+    return ", ".join(parts) or None
+
+
+def install_db_hooks(engine) -> None:
+    # SQLAlchemy のイベントで SQL 1 文ごとの実行時間を計測
+    if not ENABLED:
+        return
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("trpg_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["trpg_query_start"].pop()
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement else "OTHER"
+        observe("db", time.perf_counter() - start, statement=verb)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(context):
+        # 失敗した文は after_cursor_execute が呼ばれないので、ここで開始時刻を捨てて対応をずらさない
+        conn = context.connection
+        # 文の準備中（実行コンテキストを作る前）の失敗では開始時刻を積んでいない
+        if conn is not None and context.execution_context is not None and conn.info.get("trpg_query_start"):
+            conn.info["trpg_query_start"].pop()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(pairs: Tuple, extra: str = "") -> str:
+    inner = ",".join(f'{k}="{_escape(v)}"' for k, v in pairs)
+    if extra:
+        inner = f"{inner},{extra}" if inner else extra
+    return "{" + inner + "}" if inner else ""
+
+
+def render() -> str:
+    """Prometheus テキスト形式（version 0.0.4）で全メトリクスを出力する。"""
+    with _lock:
+        hist_items = sorted((k, (list(h.counts), h.total, h.count)) for k, h in _histograms.items())
+        counter_items = sorted(_counters.items())
+        gauge_items = sorted(_gauges.items())
+    lines: List[str] = []
+    emitted = set()
+    for (kind, labels), (counts, total, count) in hist_items:
+        name, help_text = HISTOGRAMS.get(kind, (f"trpg_{kind}_duration_seconds", kind))
+        if name not in emitted:
+            emitted.add(name)
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(list(DEFAULT_BUCKETS) + ["+Inf"], counts):
+            cumulative += bucket_count
+            le = 'le="%s"' % bound
+            lines.append(f"{name}_bucket{_labels(labels, le)} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {total}")
+        lines.append(f"{name}_count{_labels(labels)} {count}")
+    for kind_items, registry, mtype in ((counter_items, COUNTERS, "counter"), (gauge_items, GAUGES, "gauge")):
+        for (name, labels), value in kind_items:
+            if name not in emitted:
+                emitted.add(name)
+                lines.append(f"# HELP {name} {registry.get(name, name)}")
+                lines.append(f"# TYPE {name} {mtype}")
+            lines.append(f"{name}{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def reset() -> None:
+    # 計測値をすべて破棄（ベンチマークの区切りなどで使う）
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _gauges.clear()
@@ -0,0 +1,194 @@
+"""Pluggable model backends for the deep-agent path of ``GMAgent``, selected by ``GM_MODEL``.
+
+A backend factory takes ``(toolset, model_name)`` and returns an object with
+``invoke(payload) -> dict`` (the response shape ``GMAgent.take_turn`` reads: ``content``,
+``choices``, ``log``, ``dice_results``, ``world_diff``). Names without a registered prefix
+fall through to DeepAgents + LangChain.
+
+``GM_MODEL=fake`` is a deterministic local model for load tests without network access: it
+plans tool calls from the player input, runs them against the real ``Toolset`` (rules, DB
+writes, JSON round-trips of tool results) and streams a scripted narration, sleeping like a
+remote model would:
+
+- ``GM_FAKE_LATENCY_MS`` (default 300): per model step (before each tool call and the answer)
+- ``GM_FAKE_TOKEN_MS`` (default 15): per streamed token
+- ``GM_FAKE_JITTER`` (default 0.2): relative jitter applied to both, drawn from the seeded RNG
+- ``GM_FAKE_ERROR_RATE`` (default 0): share of calls that fail like a provider outage
+
+The same session and input always produce the same tool calls, dice and text. Sleeps stop at
+the turn deadline (``resilience.deadline``) and raise ``DeadlineExceeded``, like a client
+timeout would.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import random
+import re
+import time
+import zlib
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from . import intents, resilience, tool_executor
+
+LATENCY_SECONDS = float(os.getenv("GM_FAKE_LATENCY_MS", "300")) / 1000
+TOKEN_SECONDS = float(os.getenv("GM_FAKE_TOKEN_MS", "15")) / 1000
+JITTER = float(os.getenv("GM_FAKE_JITTER", "0.2"))
+ERROR_RATE = float(os.getenv("GM_FAKE_ERROR_RATE", "0"))
+
+_TOKEN = re.compile(r"\S+\s*")
+_OPENINGS = (
+    "The torchlight flickers across the old stones.",
+    "A cold draft carries the smell of damp earth.",
+    "Somewhere deeper in the ruins, water drips in a slow rhythm.",
+)
+
+# GM_MODEL の接頭辞（":" より前） -> バックエンドを作る関数
+BACKENDS: Dict[str, Callable[[Any, str], Any]] = {}
+
+
+def register(prefix: str, factory: Callable[[Any, str], Any]) -> None:
+    BACKENDS[prefix] = factory
+
+
+def factory_for(model_name: str) -> Optional[Callable[[Any, str], Any]]:
+    # 登録済みの接頭辞なら対応する関数、なければ None（DeepAgents + LangChain を使う）
+    return BACKENDS.get(model_name.split(":", 1)[0])
+
+
+class FakeModel:
+    """ツール呼び出しと文章を台本どおりに返す、決定的なローカル偽モデル。"""
+
+    def __init__(
+        self,
+        toolset,
+        latency: float = LATENCY_SECONDS,
+        token_latency: float = TOKEN_SECONDS,
+        jitter: float = JITTER,
+        sleep: Callable[[float], None] = time.sleep,
+        error_rate: float = ERROR_RATE,
+    ):
+        self.toolset = toolset
+        self.latency = latency
+        self.token_latency = token_latency
+        self.jitter = jitter
+        self.sleep = sleep
+        self.error_rate = error_rate
+
+    def invoke(self, payload: Dict) -> Dict:
+        # stream() を最後まで流して最終応答だけを返す
+        response: Dict = {}
+        for event in self.stream(payload):
+            if event["type"] == "final":
+                response = event["response"]
+        return response
+
+    def stream(self, payload: Dict) -> Iterator[Dict]:
+        """tool_call / tool_result / token / final のイベントを順に返す。"""
+        # 障害の再現は台本の乱数とは別に引く（同じ入力の再送が成功しうるように）
+        if self.error_rate and random.random() < self.error_rate:
+            raise RuntimeError("fake provider error")
+        messages: List[Dict] = [dict(m) for m in payload.get("messages", [])]
+        user_text = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+        rng = random.Random(zlib.crc32(f"{self.toolset.session_id}:{user_text}".encode("utf-8")))
+        # ダイスも同じ入力なら同じ出目になるように
+        self.toolset.rng.seed(rng.random())
+        response: Dict = {"log": [], "dice_results": [], "world_diff": {}}
+
+        state = yield from self._tool(messages, rng, "query_game_state", {"selector": "characters"})
+        characters = state.get("characters") or []
+        intent = intents.match(user_text, characters)
+        action = intent.intent if intent else None
+        narration = [rng.choice(_OPENINGS)]
+        if not characters:
+            narration.append("No hero stands ready yet; the tale waits for one.")
+            choices = [{"id": "create", "text": "Create a character"}]
+        elif action == "attack" and len(characters) > 1:
+            hero = characters[0]
+            foe = next((c for c in characters[1:] if c["id"] in intent.args.get("targets", ())), characters[1])
+            outcome = yield from self._tool(
+                messages, rng, "attack_roll", {"attacker_id": hero["id"], "target_id": foe["id"], "weapon": {"damage": "1d6"}}
+            )
+            self._collect(response, outcome)
+            narration.append(
+                f"{hero['name']}'s blade finds its mark on {foe['name']}."
+                if outcome.get("success")
+                else f"{foe['name']} twists away from {hero['name']}'s swing."
+            )
+            choices = [{"id": "attack_again", "text": "Press the attack"}, {"id": "fall_back", "text": "Fall back"}]
+        elif action == "search":
+            # 実モデルと同じく 1 ステップで独立した呼び出しを複数出す（tool_executor が並行に実行する）
+            actor_id = characters[0]["id"]
+            perception, investigation, _ = yield from self._step(
+                messages,
+                rng,
+                [
+                    ("request_skill_check", {"actor_id": actor_id, "skill": "perception", "dc": 12}),
+                    ("request_skill_check", {"actor_id": actor_id, "skill": "investigation", "dc": 12}),
+                    ("query_game_state", {"selector": "world_facts"}),
+                ],
+            )
+            self._collect(response, perception)
+            self._collect(response, investigation)
+            if perception.get("success") or investigation.get("success"):
+                update = yield from self._tool(messages, rng, "update_world_fact", {"key": "found_clue", "value": True})
+                response["world_diff"].update(update.get("updated", {}))
+                narration.append("Beneath the rubble, a scratched sigil points toward a hidden door.")
+            else:
+                narration.append("Dust and broken pottery, nothing more.")
+            choices = [{"id": "search_again", "text": "Search again"}, {"id": "move_on", "text": "Move on"}]
+        else:
+            narration.append(f"{characters[0]['name']} waits; the silence answers with a distant echo.")
+            choices = [{"id": "explore", "text": "Explore the corridor"}, {"id": "rest", "text": "Take a short rest"}]
+
+        self._think(rng)
+        text = " ".join(narration)
+        for token in _TOKEN.findall(text):
+            self._wait(self.token_latency, rng)
+            yield {"type": "token", "text": token}
+        messages.append({"role": "assistant", "content": text})
+        response.update(content=text, choices=choices, messages=messages)
+        yield {"type": "final", "response": response}
+
+    def _tool(self, messages: List[Dict], rng: random.Random, name: str, args: Dict):
+        results = yield from self._step(messages, rng, [(name, args)])
+        return results[0]
+
+    def _step(self, messages: List[Dict], rng: random.Random, calls: List[Tuple[str, Dict]]):
+        # 1 ステップ分考えてからツールを呼び、結果を実モデルと同じく JSON 文字列でメッセージに積む
+        self._think(rng)
+        for name, args in calls:
+            yield {"type": "tool_call", "name": name, "args": args}
+        report = tool_executor.ToolExecutor(self.toolset).run(calls)
+        messages.append({"role": "assistant", "tool_calls": [{"name": name, "args": args} for name, args in calls]})
+        results = []
+        for (name, _), result in zip(calls, report.results):
+            messages.append({"role": "tool", "name": name, "content": json.dumps(result, ensure_ascii=False, default=str)})
+            yield {"type": "tool_result", "name": name, "result": result}
+            results.append(json.loads(messages[-1]["content"]))
+        yield {"type": "tool_step", "report": report.to_dict()}
+        return results
+
+    def _think(self, rng: random.Random) -> None:
+        self._wait(self.latency, rng)
+
+    def _wait(self, seconds: float, rng: random.Random) -> None:
+        # 遅延 0 でも乱数は同じだけ消費する（遅延設定で台本が変わらないように）
+        delay = max(0.0, seconds * (1 + rng.uniform(-self.jitter, self.jitter)))
+        left = resilience.remaining()
+        if left is not None and delay >= left:
+            # クライアントのタイムアウトと同じく締め切りで打ち切る
+            self.sleep(max(0.0, left))
+            raise resilience.DeadlineExceeded("model call exceeded the turn deadline")
+        if delay:
+            self.sleep(delay)
+
+    @staticmethod
+    def _collect(response: Dict, outcome: Dict) -> None:
+        if outcome.get("detail"):
+            response["log"].append(outcome["detail"])
+        response["dice_results"].extend(outcome.get("rolls", []))
+
+
+register("fake", lambda toolset, model_name: FakeModel(toolset))
@@ -3,10 +3,12 @@ from __future__ import annotations
 from datetime import datetime
 from typing import Any, Dict
 
-from sqlalchemy import Column, Integer, String, Text, ForeignKey
+from sqlalchemy import Column, Index, Integer, LargeBinary, String, Text, ForeignKey
 from sqlalchemy.orm import declarative_base, relationship
 
 Base = declarative_base()
+# コールドストレージ（アーカイブ DB）用のテーブルはホット DB とは別のメタデータで管理
+ArchiveBase = declarative_base()
 
 
 class Session(Base):
@@ -18,7 +20,16 @@ class Session(Base):
     created_at = Column(String, nullable=False, default=lambda: datetime.utcnow().isoformat() + "Z")
     settings = Column(Text)
     safety = Column(Text)
-    save_blob = Column(Text)
+    save_blob = Column(Text)  # JSON。圧縮有効時は大きい値だけ先頭 1 バイト付きの圧縮 BLOB（db.dumps 参照）
+    # services の書き込みごとに単調増加するバージョン（ETag や差分配信の基準）
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    # 最後に割り当てたターン番号（ログを書くトランザクションで進める）。列を足す前からあるセッションは
+    # NULL で、最初のターンを書くときにログから数え直す
+    turn_count = Column(Integer, default=0)
+    # アーカイブ DB へ退避済みのログの最大 ID（coldstore が退避と同じトランザクションで進める）。列を足す前からある
+    # セッションは NULL で、最初に読むときにアーカイブ DB から引いて埋める
+    archived_turn_upto = Column(Integer, default=0)
+    archived_dice_upto = Column(Integer, default=0)
 
     characters = relationship("Character", back_populates="session", cascade="all, delete-orphan")
     turn_logs = relationship("TurnLog", back_populates="session", cascade="all, delete-orphan")
@@ -47,12 +58,15 @@ class Character(Base):
 class TurnLog(Base):
     # 各ターンの結果ログを保持するテーブル
     __tablename__ = "turn_logs"
+    # アーカイブで最新の行を消しても ID を再利用しない（coldstore の id 範囲と全文検索の rowid が指す先を保つ）。
+    # segment_kind はアーカイブの LogSegment.kind（既存 DB を作り直すときに退避済みの最大 ID を引く）
+    __table_args__ = {"sqlite_autoincrement": True, "info": {"segment_kind": "turn_log"}}
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     session_id = Column(String, ForeignKey("sessions.id"), nullable=False)
     turn_no = Column(Integer)
     player_input = Column(Text)
-    gm_output = Column(Text)
+    gm_output = Column(Text)  # save_blob と同じく圧縮 BLOB の場合あり
     dice_results = Column(Text)
     world_diff = Column(Text)
     created_at = Column(String, nullable=False, default=lambda: datetime.utcnow().isoformat() + "Z")
@@ -60,9 +74,22 @@ class TurnLog(Base):
     session = relationship("Session", back_populates="turn_logs")
 
 
+# ターンログの全文検索索引（FTS5 の trigram。rowid = turn_logs.id）。中身は history.py が書き込み時に足す。
+# session_key はセッション ID から作る 3 文字（trigram 1 個）のキーで、検索をセッションに絞る MATCH に使う
+TURN_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS turn_search USING fts5("
+    "player_input, narration, session_key, session_id UNINDEXED, turn_no UNINDEXED, tokenize='trigram')"
+)
+# ORM で表せない追加の DDL（create_all の後に流し、スキーマの指紋にも含める）
+Base.metadata.info["ddl"] = (TURN_SEARCH_DDL,)
+
+
 class DiceLog(Base):
     # ダイスロールの履歴を保持するテーブル
     __tablename__ = "dice_logs"
+    # アーカイブで最新の行を消しても ID を再利用しない（coldstore の id 範囲と全文検索の rowid が指す先を保つ）。
+    # segment_kind はアーカイブの LogSegment.kind（既存 DB を作り直すときに退避済みの最大 ID を引く）
+    __table_args__ = {"sqlite_autoincrement": True, "info": {"segment_kind": "dice_log"}}
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     session_id = Column(String, ForeignKey("sessions.id"))
@@ -71,3 +98,24 @@ class DiceLog(Base):
     created_at = Column(String, nullable=False, default=lambda: datetime.utcnow().isoformat() + "Z")
 
     session = relationship("Session", back_populates="dice_logs")
+
+
+class LogSegment(ArchiveBase):
+    # 古いターン/ダイスログを圧縮してまとめたセグメント（アーカイブ DB 側）
+    __tablename__ = "log_segments"
+    __table_args__ = (
+        Index("ix_log_segments_session_kind_turn", "session_id", "kind", "turn_from", "turn_to"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    session_id = Column(String, nullable=False)
+    kind = Column(String, nullable=False)  # "turn_log" | "dice_log"
+    turn_from = Column(Integer)
+    turn_to = Column(Integer)
+    id_from = Column(Integer, nullable=False)
+    id_to = Column(Integer, nullable=False)
+    created_from = Column(String)
+    created_to = Column(String)
+    row_count = Column(Integer, nullable=False)
+    payload = Column(LargeBinary, nullable=False)  # zlib 圧縮した JSON 配列
+    created_at = Column(String, nullable=False, default=lambda: datetime.utcnow().isoformat() + "Z")
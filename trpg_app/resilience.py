@@ -0,0 +1,157 @@
+"""Per-turn deadlines and circuit breakers for calls to model providers.
+
+``deadline(seconds)`` sets an absolute deadline in a context variable. Nested scopes can
+only shorten it, and it follows work into tool threads that are started with
+``contextvars.copy_context()``. ``remaining()`` gives the time left, and Toolset calls made
+after the deadline return an error instead of touching state. That covers a model call
+that hangs, times out and later wakes up.
+
+``CircuitBreaker`` counts consecutive failures, either errors or calls slower than
+``slow_seconds``. After ``failures`` of them it opens, and callers use the fallback
+without calling the provider. After ``cooldown`` seconds a single probe is let through
+(half-open): if it succeeds the breaker closes, otherwise it opens again. The state is
+exported as the gauge ``trpg_circuit_breaker_state`` (0 closed, 1 half-open, 2 open).
+"""
+
+from __future__ import annotations
+
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional
+
+from . import metrics
+
+# 1 ターン全体の締め切り（モデル呼び出しとツール呼び出しの合計）
+TURN_DEADLINE_SECONDS = float(os.getenv("GM_TURN_DEADLINE_MS", "20000")) / 1000
+BREAKER_FAILURES = int(os.getenv("GM_BREAKER_FAILURES", "5"))
+BREAKER_SLOW_SECONDS = float(os.getenv("GM_BREAKER_SLOW_MS", "10000")) / 1000
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("GM_BREAKER_COOLDOWN_S", "30"))
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+metrics.COUNTERS.update(
+    {
+        "trpg_circuit_breaker_transitions_total": "Circuit breaker state changes by breaker and new state.",
+        "trpg_circuit_breaker_rejected_total": "Calls short-circuited to the fallback while a breaker was open.",
+        "trpg_deadline_exceeded_total": "Model or tool calls abandoned because the turn deadline passed.",
+    }
+)
+metrics.GAUGES["trpg_circuit_breaker_state"] = "Circuit breaker state (0 closed, 1 half-open, 2 open)."
+
+_deadline: ContextVar[Optional[float]] = ContextVar("trpg_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    # ターンの締め切りを過ぎた
+    pass
+
+
+@contextmanager
+def deadline(seconds: float):
+    """この区間の締め切りを seconds 秒後にする（外側の締め切りより後には延ばさない）。"""
+    at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(current, at))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    # 締め切りまでの残り秒数（締め切りが無ければ None、過ぎていれば 0 以下）
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def within_deadline(func: Callable) -> Callable:
+    """締め切りを過ぎてから呼ばれたツールは状態に触れずエラーを返すデコレータ。"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if expired():
+            metrics.inc("trpg_deadline_exceeded_total", call=func.__name__)
+            return {"error": "turn deadline exceeded"}
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+class CircuitBreaker:
+    """連続した失敗（エラー・遅すぎる呼び出し）で開き、クールダウン後に 1 件だけ試して閉じるかを決める。"""
+
+    def __init__(
+        self,
+        name: str,
+        failures: int = BREAKER_FAILURES,
+        slow_seconds: float = BREAKER_SLOW_SECONDS,
+        cooldown: float = BREAKER_COOLDOWN_SECONDS,
+    ):
+        self.name = name
+        self.failures = failures
+        self.slow_seconds = slow_seconds
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        metrics.set_gauge("trpg_circuit_breaker_state", 0, breaker=name)
+
+    def allow(self) -> bool:
+        # 呼んでよいか。開いている間は False、クールダウン明けは試行 1 件だけ True
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self._transition(HALF_OPEN)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+        metrics.inc("trpg_circuit_breaker_rejected_total", breaker=self.name)
+        return False
+
+    def record(self, seconds: float, ok: bool = True) -> None:
+        # 呼び出し結果を記録（ok でも slow_seconds を超えたら失敗として数える）
+        failed = not ok or seconds > self.slow_seconds
+        with self._lock:
+            self._probing = False
+            if not failed:
+                self.consecutive_failures = 0
+                if self.state != CLOSED:
+                    self._transition(CLOSED)
+                return
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failures:
+                self.opened_at = time.monotonic()
+                if self.state != OPEN:
+                    self._transition(OPEN)
+
+    def _transition(self, state: str) -> None:
+        self.state = state
+        metrics.inc("trpg_circuit_breaker_transitions_total", breaker=self.name, to=state)
+        metrics.set_gauge("trpg_circuit_breaker_state", _STATE_VALUES[state], breaker=self.name)
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(name: str) -> CircuitBreaker:
+    # 名前ごとにプロセスで 1 つ（モデル名ごとなど）
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
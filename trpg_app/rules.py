@@ -4,6 +4,7 @@ from dataclasses import dataclass
 from typing import Dict, Optional
 
 from . import dice
+from .domain import Character, DerivedStats, Resources, int_map
 
 SKILL_TO_ABILITY = {
     "perception": "WIS",
@@ -21,23 +22,23 @@ def ability_mod(score: int) -> int:
     return (score - 10) // 2
 
 
-def compute_derived_stats(base_stats: Dict[str, int], resources: Dict) -> Dict:
+def derive_stats(base_stats: Dict[str, int], resources: Resources) -> DerivedStats:
     # 派生ステータス（AC/HPなど）を計算
-    mods = {k: ability_mod(int(v)) for k, v in (base_stats or {}).items()}
-    dex_mod = mods.get("DEX", 0)
-    armor_bonus = int(resources.get("ac_bonus", 0)) if resources else 0
-    base_ac = 10 + dex_mod + armor_bonus
-    hp = resources.get("hp", 0) if resources else 0
-    max_hp = resources.get("max_hp", hp) if resources else hp
-    return {
-        "mods": mods,
-        "ac": base_ac,
-        "hp": hp,
-        "max_hp": max_hp,
-    }
-
-
-@dataclass
+    mods = {k: ability_mod(v) for k, v in base_stats.items()}
+    return DerivedStats(
+        mods=mods,
+        ac=10 + mods.get("DEX", 0) + resources.ac_bonus,
+        hp=resources.hp,
+        max_hp=resources.max_hp,
+    )
+
+
+def compute_derived_stats(base_stats: Dict[str, int], resources: Dict) -> Dict:
+    # 保存用（辞書）の派生ステータスを計算
+    return derive_stats(int_map(base_stats), Resources.from_dict(resources)).to_dict()
+
+
+@dataclass(slots=True)
 class RuleOutcome:
     success: bool
     total: int
@@ -47,13 +48,11 @@ class RuleOutcome:
     updates: Dict
 
 
-def request_skill_check(actor: Dict, skill: str, dc: int, rng=None) -> RuleOutcome:
+def request_skill_check(actor: Character, skill: str, dc: int, rng=None) -> RuleOutcome:
     # 技能判定を実行
-    base_stats = actor.get("base_stats", {})
-    skills = actor.get("skills", {}) or {}
     ability_key = SKILL_TO_ABILITY.get(skill.lower(), "DEX")
-    mod = ability_mod(int(base_stats.get(ability_key, 10)))
-    skill_bonus = int(skills.get(skill, skills.get(skill.lower(), 0)) or 0)
+    mod = ability_mod(actor.stat(ability_key))
+    skill_bonus = actor.skill_bonus(skill)
     roll_result = dice.roll("1d20", rng=rng)
     total = roll_result["total"] + mod + skill_bonus
     breakdown = (
@@ -72,22 +71,21 @@ def request_skill_check(actor: Dict, skill: str, dc: int, rng=None) -> RuleOutco
 
 
 def attack_roll(
-    attacker: Dict,
-    target: Dict,
+    attacker: Character,
+    target: Optional[Character],
     dc_ac: Optional[int] = None,
     weapon: Optional[Dict] = None,
     rng=None,
 ) -> RuleOutcome:
-    # 攻撃ロールとダメージ適用を実行
-    weapon = weapon or attacker.get("weapon") or {}
+    # 攻撃ロールとダメージ適用を実行（武器はツール引数由来なので数値化する）
+    weapon = weapon or attacker.weapon or {}
     attack_bonus = int(weapon.get("attack_bonus", 0))
-    base_stats = attacker.get("base_stats", {})
-    prof = int(attacker.get("resources", {}).get("proficiency", 2))
-    str_mod = ability_mod(int(base_stats.get("STR", 10)))
-    dex_mod = ability_mod(int(base_stats.get("DEX", 10)))
+    prof = attacker.resources.proficiency
+    str_mod = ability_mod(attacker.stat("STR"))
+    dex_mod = ability_mod(attacker.stat("DEX"))
     ability_bonus = dex_mod if weapon.get("finesse") else str_mod
     attack_bonus = attack_bonus + ability_bonus + prof
-    ac = dc_ac or target.get("derived_stats", {}).get("ac", 10)
+    ac = dc_ac or (target.derived_stats.ac if target else 10)
 
     attack_roll_result = dice.roll("1d20", rng=rng)
     attack_total = attack_roll_result["total"] + attack_bonus
@@ -99,7 +97,7 @@ def attack_roll(
     damage_total = damage_roll["total"] + damage_bonus
     dealt = damage_total if hit else 0
 
-    target_hp = int(target.get("resources", {}).get("hp", 0))
+    target_hp = target.resources.hp if target else 0
     remaining_hp = max(0, target_hp - dealt) if hit else target_hp
 
     detail = (
@@ -120,10 +118,9 @@ def attack_roll(
     )
 
 
-def saving_throw(actor: Dict, dc: int, save_type: str, rng=None) -> RuleOutcome:
+def saving_throw(actor: Character, dc: int, save_type: str, rng=None) -> RuleOutcome:
     # セービングスローを実行
-    base_stats = actor.get("base_stats", {})
-    mod = ability_mod(int(base_stats.get(save_type.upper(), 10)))
+    mod = ability_mod(actor.stat(save_type.upper()))
     roll_result = dice.roll("1d20", rng=rng)
     total = roll_result["total"] + mod
     success = total >= dc
@@ -141,15 +138,16 @@ def saving_throw(actor: Dict, dc: int, save_type: str, rng=None) -> RuleOutcome:
     )
 
 
-def evaluate_rule_template(template: Dict, actor: Dict, target: Optional[Dict] = None, rng=None) -> RuleOutcome:
+def evaluate_rule_template(
+    template: Dict, actor: Character, target: Optional[Character] = None, rng=None
+) -> RuleOutcome:
     """簡易 JSON ルールテンプレートを解釈し、対応する判定を実行する。"""
     rtype = (template.get("type") or "").lower()
     if rtype in ("skill", "skill_check"):
         return request_skill_check(actor, template.get("skill", "perception"), int(template.get("dc", 10)), rng=rng)
     if rtype == "attack":
         weapon = template.get("weapon") or {}
-        dc_ac = template.get("dc") or (target or {}).get("derived_stats", {}).get("ac")
-        return attack_roll(actor, target or {}, dc_ac=dc_ac, weapon=weapon, rng=rng)
+        return attack_roll(actor, target, dc_ac=template.get("dc"), weapon=weapon, rng=rng)
     if rtype in ("save", "saving_throw"):
         save_type = template.get("save_type", "DEX")
         return saving_throw(actor, int(template.get("dc", 10)), save_type, rng=rng)
@@ -0,0 +1,161 @@
+"""Session export/import (save files) streamed as gzip-compressed record archives."""
+
+from __future__ import annotations
+
+import gzip
+import io
+import json
+import zlib
+from datetime import datetime
+from typing import IO, Dict, Iterator, Optional, Tuple
+
+from . import db, services
+
+FORMAT_NAME = "trpg-save"
+FORMAT_VERSION = 1
+FORMATS = ("ndjson", "msgpack")
+# 圧縮器へ渡す前にまとめるバイト数（小さすぎると gzip の効率が落ちる）
+CHUNK_BYTES = 64 * 1024
+
+
+class SaveFileError(ValueError):
+    # セーブファイルの形式不正や非対応フォーマットで送出
+    pass
+
+
+def _msgpack():
+    # msgpack は任意依存。使うときだけ import する
+    try:
+        import msgpack
+    except ImportError as exc:
+        raise SaveFileError("msgpack format requires the 'msgpack' package") from exc
+    return msgpack
+
+
+def _encoder(fmt: str):
+    # 1 レコードをバイト列へ変換する関数を返す
+    if fmt == "ndjson":
+        return lambda record: db.dumps(record).encode("utf-8") + b"\n"
+    if fmt == "msgpack":
+        packer = _msgpack().Packer(use_bin_type=True)
+        return packer.pack
+    raise SaveFileError(f"unsupported format: {fmt}")
+
+
+def filename(session_id: str, fmt: str) -> str:
+    # ダウンロード時のファイル名
+    return f"session-{session_id}.trpg.{fmt}.gz"
+
+
+def export_session(session_id: str, fmt: str = "ndjson", batch_size: int = 500) -> Optional[Iterator[bytes]]:
+    """セッションを gzip 圧縮したレコード列としてチャンク単位で返す。存在しなければ None。"""
+    encode = _encoder(fmt)
+    records = services.iter_session_records(session_id, batch_size=batch_size)
+    first = next(records, None)
+    if first is None:
+        return None
+
+    def _stream() -> Iterator[bytes]:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 で gzip ヘッダ付き
+        counts: Dict[str, int] = {}
+        buf = bytearray(
+            encode(
+                {
+                    "type": "header",
+                    "format": FORMAT_NAME,
+                    "version": FORMAT_VERSION,
+                    "encoding": fmt,
+                    "exported_at": datetime.utcnow().isoformat() + "Z",
+                }
+            )
+        )
+        for kind, data in _chain(first, records):
+            counts[kind] = counts.get(kind, 0) + 1
+            buf += encode({"type": kind, "data": data})
+            if len(buf) >= CHUNK_BYTES:
+                chunk = compressor.compress(bytes(buf))
+                buf.clear()
+                if chunk:
+                    yield chunk
+        buf += encode({"type": "end", "counts": counts})
+        yield compressor.compress(bytes(buf)) + compressor.flush()
+
+    return _stream()
+
+
+def _chain(first: Tuple[str, Dict], rest: Iterator[Tuple[str, Dict]]) -> Iterator[Tuple[str, Dict]]:
+    # 先読みした 1 件を先頭に戻す
+    yield first
+    yield from rest
+
+
+class _RawReader(io.RawIOBase):
+    # read() しか持たないストリーム（Flask の request.stream など）を BufferedReader に載せるための薄いラッパ
+    def __init__(self, raw: IO[bytes]):
+        self.raw = raw
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        data = self.raw.read(len(buf))
+        buf[: len(data)] = data
+        return len(data)
+
+
+def _iter_records(fileobj: IO[bytes]) -> Iterator[Dict]:
+    # gzip 有無とエンコーディングを先頭バイトで判定してレコードを逐次返す
+    stream = io.BufferedReader(_RawReader(fileobj))
+    if stream.peek(2)[:2] == b"\x1f\x8b":
+        stream = gzip.GzipFile(fileobj=stream, mode="rb")
+    first = stream.peek(1)[:1]
+    if not first:
+        raise SaveFileError("empty save file")
+    if first == b"{":
+        for line in stream:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as exc:
+                    raise SaveFileError(f"invalid NDJSON record: {exc}") from exc
+    else:
+        yield from _msgpack().Unpacker(stream, raw=False)
+
+
+def _checked_records(raw: Iterator[Dict]) -> Iterator[Tuple[str, Dict]]:
+    # ヘッダ・フッタを検証しつつ services 向けの (種別, 辞書) に変換
+    header = next(raw, None)
+    if not isinstance(header, dict) or header.get("type") != "header" or header.get("format") != FORMAT_NAME:
+        raise SaveFileError("not a trpg save file")
+    if int(header.get("version", 0)) > FORMAT_VERSION:
+        raise SaveFileError(f"unsupported save file version: {header.get('version')}")
+    counts: Dict[str, int] = {}
+    for record in raw:
+        if not isinstance(record, dict) or not isinstance(record.get("type"), str):
+            raise SaveFileError("malformed record: expected an object with a type")
+        kind = record["type"]
+        if kind == "end":
+            expected = record.get("counts") or {}
+            if expected != counts:
+                raise SaveFileError(f"record count mismatch: expected {expected}, got {counts}")
+            return
+        data = record.get("data") or {}
+        if not isinstance(data, dict):
+            raise SaveFileError(f"malformed {kind} record: data must be an object")
+        if kind == "character" and not isinstance(data.get("id"), str):
+            raise SaveFileError("malformed character record: missing id")
+        counts[kind] = counts.get(kind, 0) + 1
+        yield kind, data
+    raise SaveFileError("save file is truncated (missing end record)")
+
+
+def import_session(fileobj: IO[bytes]) -> Dict:
+    """セーブファイルを読み込み、新しい ID を割り当てたセッションとして一括登録する。"""
+    try:
+        return services.import_session_records(_checked_records(_iter_records(fileobj)))
+    except (OSError, EOFError, zlib.error) as exc:
+        raise SaveFileError(f"corrupt save file: {exc}") from exc
+    except ValueError as exc:
+        if isinstance(exc, SaveFileError):
+            raise
+        raise SaveFileError(str(exc)) from exc
@@ -0,0 +1,276 @@
+"""Data-driven scenarios (scene graphs) for the offline narrator.
+
+A scenario file (JSON, or YAML when PyYAML is installed) lives in ``TRPG_SCENARIO_DIR``
+(default ``trpg_app/data/scenarios``) as ``<id>.json`` / ``<id>.yaml``. A session uses
+the scenario named in ``settings.scenario``, or ``TRPG_SCENARIO`` when it has none.
+
+Each scene has a text and a list of choices. A choice may have:
+
+- ``when``: world-fact conditions for offering it (``{"found_lever": true}``,
+  ``{"lever_pulled": {"not": true}}``, ``exists`` / ``gte`` / ``lte``)
+- ``check``: a rule template for ``rules.evaluate_rule_template``, run through
+  ``Toolset.evaluate_rule``. ``target: "other"`` points it at the second character.
+- ``narration`` / ``goto`` / ``set``: the outcome, which ``success`` / ``failure``
+  override field by field when there is a check
+
+Free text is mapped to choices with intents (``intents`` at the scenario or scene level,
+e.g. ``{"search": "search_again"}``). The current scene is kept in the ``scene`` world fact.
+
+Files are compiled once per process into a state machine indexed by (scene, choice id).
+Conditions become predicates and texts are validated, so a turn is one dict lookup, the
+rule roll and the world-fact writes. No model is called.
+"""
+
+from __future__ import annotations
+
+import functools
+import json
+import os
+import re
+import string
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from . import intents
+from .domain import TurnResult
+
+DEFAULT_DIR = Path(__file__).with_name("data") / "scenarios"
+SCENARIO_DIR = os.getenv("TRPG_SCENARIO_DIR", "")
+DEFAULT_SCENARIO = os.getenv("TRPG_SCENARIO", "")
+# 現在のシーンを持つ世界フラグ
+SCENE_FACT = "scene"
+
+_ID_RE = re.compile(r"^[A-Za-z0-9_-]+$")
+_TEXT_FIELDS = {"actor", "target"}
+_CHECK_TYPES = {"skill", "skill_check", "attack", "save", "saving_throw"}
+
+
+class ScenarioError(ValueError):
+    # シナリオファイルが見つからない・書式が正しくない
+    pass
+
+
+def _condition(key: str, expected: Any) -> Callable[[Dict], bool]:
+    # 世界フラグ 1 つ分の条件を述語に変換する
+    if not isinstance(expected, dict):
+        return lambda facts: facts.get(key) == expected
+    if len(expected) != 1:
+        raise ScenarioError(f"condition on {key!r} must have exactly one operator")
+    (op, value), = expected.items()
+    if op == "not":
+        return lambda facts: facts.get(key) != value
+    if op == "exists":
+        return lambda facts: (key in facts) == bool(value)
+    if op == "gte":
+        return lambda facts: isinstance(facts.get(key), (int, float)) and facts[key] >= value
+    if op == "lte":
+        return lambda facts: isinstance(facts.get(key), (int, float)) and facts[key] <= value
+    raise ScenarioError(f"unknown condition operator {op!r} on {key!r}")
+
+
+def _text(value: Optional[str], where: str) -> str:
+    # {actor} / {target} 以外の差し込みは読み込み時にエラーにする
+    value = value or ""
+    for _, name, _, _ in string.Formatter().parse(value):
+        if name is not None and name not in _TEXT_FIELDS:
+            raise ScenarioError(f"{where}: unknown placeholder {{{name}}}")
+    return value
+
+
+@dataclass(slots=True)
+class Outcome:
+    text: str = ""
+    goto: Optional[str] = None
+    facts: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass(slots=True)
+class Transition:
+    scene: str
+    choice_id: str
+    label: str
+    conditions: Tuple[Callable[[Dict], bool], ...]
+    check: Optional[Dict]
+    target: Optional[str]
+    success: Outcome
+    failure: Outcome
+
+    def available(self, facts: Dict) -> bool:
+        return all(condition(facts) for condition in self.conditions)
+
+
+@dataclass(slots=True)
+class Scene:
+    id: str
+    text: str
+    transitions: Tuple[Transition, ...]
+    intents: Dict[str, str]
+
+    def offered(self, facts: Dict) -> List[Dict]:
+        # いまの世界フラグで出せる選択肢
+        return [{"id": t.choice_id, "text": t.label} for t in self.transitions if t.available(facts)]
+
+
+class Scenario:
+    """シナリオ 1 本を (シーン, 選択肢 ID) で引ける状態機械にコンパイルしたもの。"""
+
+    def __init__(self, spec: Dict):
+        self.id = spec.get("id", "")
+        self.title = spec.get("title", "")
+        scenes = spec.get("scenes") or {}
+        if not scenes:
+            raise ScenarioError(f"scenario {self.id!r} has no scenes")
+        self.start = spec.get("start") or next(iter(scenes))
+        self.intents: Dict[str, str] = dict(spec.get("intents") or {})
+        self.scenes: Dict[str, Scene] = {}
+        self.transitions: Dict[Tuple[str, str], Transition] = {}
+        for scene_id, scene_spec in scenes.items():
+            transitions = tuple(self._compile_choice(scene_id, choice) for choice in scene_spec.get("choices") or [])
+            for transition in transitions:
+                key = (scene_id, transition.choice_id)
+                if key in self.transitions:
+                    raise ScenarioError(f"duplicate choice {transition.choice_id!r} in scene {scene_id!r}")
+                self.transitions[key] = transition
+            self.scenes[scene_id] = Scene(
+                scene_id, _text(scene_spec.get("text"), scene_id), transitions, dict(scene_spec.get("intents") or {})
+            )
+        for transition in self.transitions.values():
+            for outcome in (transition.success, transition.failure):
+                if outcome.goto is not None and outcome.goto not in self.scenes:
+                    raise ScenarioError(f"{transition.scene}/{transition.choice_id}: unknown scene {outcome.goto!r}")
+        if self.start not in self.scenes:
+            raise ScenarioError(f"unknown start scene {self.start!r}")
+
+    @staticmethod
+    def _compile_choice(scene_id: str, choice: Dict) -> Transition:
+        where = f"{scene_id}/{choice.get('id')}"
+        if not choice.get("id"):
+            raise ScenarioError(f"{scene_id}: choice without id")
+        check = choice.get("check")
+        if check is not None and (check.get("type") or "").lower() not in _CHECK_TYPES:
+            raise ScenarioError(f"{where}: unknown check type {check.get('type')!r}")
+        base = Outcome(_text(choice.get("narration"), where), choice.get("goto"), dict(choice.get("set") or {}))
+
+        def override(branch: Optional[Dict]) -> Outcome:
+            # success / failure は基本の結果を項目ごとに上書きする
+            branch = branch or {}
+            return Outcome(
+                _text(branch["narration"], where) if "narration" in branch else base.text,
+                branch.get("goto", base.goto),
+                {**base.facts, **(branch.get("set") or {})},
+            )
+
+        return Transition(
+            scene=scene_id,
+            choice_id=choice["id"],
+            label=choice.get("text") or choice["id"],
+            conditions=tuple(_condition(key, value) for key, value in (choice.get("when") or {}).items()),
+            check=dict(check) if check else None,
+            target=choice.get("target"),
+            success=override(choice.get("success")) if check else base,
+            failure=override(choice.get("failure")) if check else base,
+        )
+
+    def scene_for(self, facts: Dict) -> Scene:
+        return self.scenes.get(facts.get(SCENE_FACT)) or self.scenes[self.start]
+
+    def transition_for(self, scene: Scene, player_input: str, selected_choice_id: Optional[str]) -> Optional[Transition]:
+        """選択肢 ID、なければ入力の意図からこのシーンの遷移を引く。"""
+        if selected_choice_id:
+            return self.transitions.get((scene.id, selected_choice_id))
+        intent = intents.match(player_input)
+        if intent is None:
+            return None
+        choice_id = scene.intents.get(intent.intent) or self.intents.get(intent.intent)
+        return self.transitions.get((scene.id, choice_id)) if choice_id else None
+
+    def handles(self, session: Dict, player_input: str, selected_choice_id: Optional[str]) -> bool:
+        # このターンをシナリオで解決できるか（モデルへ振り分けるかの判断用）
+        facts = (session.get("save_blob") or {}).get("world_facts") or {}
+        transition = self.transition_for(self.scene_for(facts), player_input, selected_choice_id)
+        return transition is not None and transition.available(facts) and bool(session.get("characters"))
+
+    def resolve(self, toolset, session: Dict, player_input: str, selected_choice_id: Optional[str]) -> Optional[TurnResult]:
+        """1 ターンをシナリオで解決する。このシーンで扱えない入力なら None（呼び出し側の既定の処理に任せる）。"""
+        characters = session.get("characters") or []
+        if not characters:
+            return None
+        facts = dict((session.get("save_blob") or {}).get("world_facts") or {})
+        scene = self.scene_for(facts)
+        transition = self.transition_for(scene, player_input, selected_choice_id)
+        if transition is None or not transition.available(facts):
+            return None
+        actor = characters[0]
+        other = characters[1] if len(characters) > 1 else None
+        if transition.target == "other" and other is None:
+            return None
+        names = {"actor": actor.get("name") or "", "target": (other or {}).get("name") or ""}
+        log: List[str] = []
+        dice_results: List[Dict] = []
+        outcome = transition.success
+        if transition.check is not None:
+            target_id = other["id"] if transition.target == "other" else None
+            result = toolset.evaluate_rule(actor["id"], transition.check, target_id)
+            if result.get("error"):
+                return None
+            log.append(result.get("detail", ""))
+            dice_results.extend(result.get("rolls", []))
+            outcome = transition.success if result.get("success") else transition.failure
+        world_diff: Dict[str, Any] = {}
+        next_scene = self.scenes[outcome.goto] if outcome.goto else scene
+        updates = dict(outcome.facts)
+        if outcome.goto and facts.get(SCENE_FACT) != next_scene.id:
+            updates[SCENE_FACT] = next_scene.id
+        for key, value in updates.items():
+            toolset.update_world_fact(key, value)
+            world_diff[key] = facts[key] = value
+        narration = [outcome.text.format_map(names)] if outcome.text else []
+        if next_scene.id != scene.id:
+            narration.append(next_scene.text.format_map(names))
+        return TurnResult(
+            narration=" ".join(narration) or "The story advances.",
+            choices=next_scene.offered(facts),
+            log=log,
+            dice_results=dice_results,
+            world_diff=world_diff,
+            mode="scenario",
+        )
+
+
+def _read(path: Path) -> Dict:
+    if path.suffix == ".json":
+        with path.open(encoding="utf-8") as fh:
+            return json.load(fh)
+    try:
+        import yaml
+    except ImportError as exc:
+        raise ScenarioError("PyYAML is required for YAML scenarios") from exc
+    with path.open(encoding="utf-8") as fh:
+        return yaml.safe_load(fh) or {}
+
+
+@functools.lru_cache(maxsize=32)
+def load(scenario_id: str) -> Scenario:
+    """シナリオ ID からファイルを探してコンパイルする（プロセスで 1 回）。"""
+    if not _ID_RE.match(scenario_id or ""):
+        raise ScenarioError(f"invalid scenario id {scenario_id!r}")
+    directory = Path(SCENARIO_DIR) if SCENARIO_DIR else DEFAULT_DIR
+    for suffix in (".json", ".yaml", ".yml"):
+        path = directory / f"{scenario_id}{suffix}"
+        if path.is_file():
+            spec = _read(path)
+            spec.setdefault("id", scenario_id)
+            return Scenario(spec)
+    raise ScenarioError(f"scenario {scenario_id!r} not found")
+
+
+def for_session(session: Dict) -> Optional[Scenario]:
+    # セッション設定（なければ TRPG_SCENARIO）のシナリオ。指定なし・読めないものは None
+    scenario_id = (session.get("settings") or {}).get("scenario") or DEFAULT_SCENARIO
+    if not scenario_id:
+        return None
+    try:
+        return load(scenario_id)
+    except ScenarioError:
+        return None
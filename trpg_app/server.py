@@ -0,0 +1,501 @@
+"""Production serving: pre-forked workers behind a session-affinity router.
+
+    python -m trpg_app.server --workers 4 --port 5000
+
+The master imports the application once (``--app module:attr``, default ``app:app``), runs
+``bootstrap`` (schema check, dice warm-up, chat model) and then forks the workers, so the
+preloaded modules are shared copy-on-write. Each worker serves the WSGI app on its own Unix
+socket; the master accepts client connections and forwards every request to the worker
+picked by hashing its ``session_id`` (``/api/session/<id>`` in the path, ``?session_id=``,
+or a ``"session_id"`` field in the JSON body). A session therefore always lands on the same
+process: its cache entries stay hot, its turns never contend across processes, and the
+in-process event backend reaches its SSE subscribers. Character requests
+(``/api/character/<id>``) carry no session id, so the router looks up the owning session in
+the database once per character and routes them the same way; their change events then
+reach the session's subscribers. Requests without any session are spread round-robin.
+
+Signals to the master: ``HUP`` replaces the workers one at a time (the new worker takes the
+slot before the old one drains and exits); ``TERM`` / ``INT`` drain and stop. A worker that
+dies is restarted. With ``--no-preload`` each worker imports the app itself, so ``HUP`` also
+picks up code changes.
+"""
+
+from __future__ import annotations
+
+import argparse
+import http.client
+import importlib
+import itertools
+import logging
+import os
+import re
+import signal
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+logger = logging.getLogger(__name__)
+
+# 停止・入れ替え時に処理中のリクエスト（SSE を含む）を待つ最大秒数
+GRACEFUL_TIMEOUT = float(os.getenv("TRPG_GRACEFUL_TIMEOUT", "30"))
+# ワーカーがソケットを開くまで待つ秒数（--no-preload では import 分かかる）
+START_TIMEOUT = 30.0
+_HOP_BY_HOP = frozenset(
+    ("connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer", "transfer-encoding", "upgrade")
+)
+_SESSION_PATH = re.compile(r"^/api/session/([^/]+)")
+_SESSION_FIELD = re.compile(rb'"session_id"\s*:\s*"([^"\\]+)"')
+_CHARACTER_PATH = re.compile(r"^/api/character/([^/]+)")
+# ルーターが覚えておくキャラクター ID -> セッション ID の上限（キャラクターの所属は変わらない）
+_CHARACTER_CACHE_ENTRIES = 65536
+# ボディから session_id を探す範囲（セーブファイルのインポートなど大きなボディを全走査しない）
+_BODY_SCAN_BYTES = 8192
+
+
+def load_app(spec: str):
+    # "module:attr" 形式の指定から WSGI アプリを import する
+    module_name, _, attr = spec.partition(":")
+    return getattr(importlib.import_module(module_name), attr or "app")
+
+
+def session_key(target: str, body: Optional[bytes]) -> Optional[str]:
+    """リクエストのパス / クエリ / JSON ボディから振り分けに使う session_id を取り出す（無ければ None）。"""
+    path, _, query = target.partition("?")
+    match = _SESSION_PATH.match(path)
+    if match and match.group(1) != "import":
+        return match.group(1)
+    if query:
+        values = parse_qs(query).get("session_id")
+        if values:
+            return values[0]
+    if body:
+        match = _SESSION_FIELD.search(body, 0, _BODY_SCAN_BYTES)
+        if match:
+            return match.group(1).decode("utf-8", "replace")
+    return None
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    """Unix ソケット上の HTTP/1.1 接続（ルーターからワーカーへの転送用）。"""
+
+    def __init__(self, path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self.sock = sock
+
+
+def character_session(char_id: str) -> Optional[str]:
+    """キャラクターの所属セッション ID を DB から引く（無ければ None）。
+
+    親プロセスは fork するので、SQLAlchemy のプールは使わず読み取り専用の接続をその場で開いて閉じる。
+    """
+    from . import db
+
+    try:
+        conn = sqlite3.connect(f"file:{db.DB_PATH}?mode=ro", uri=True)
+    except sqlite3.Error:
+        return None
+    try:
+        row = conn.execute("SELECT session_id FROM characters WHERE id = ?", (char_id,)).fetchone()
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+class Router:
+    """ワーカー（Unix ソケット）の一覧と、session_id からワーカーを選ぶ規則。"""
+
+    def __init__(self, sockets: List[str]):
+        self.sockets = sockets
+        self._round_robin = itertools.count()
+        self._local = threading.local()
+        self._characters: Dict[str, str] = {}
+
+    def route_key(self, target: str, body: Optional[bytes]) -> Optional[str]:
+        # セッションを持たないキャラクターのリクエストは、所属セッションのワーカーへ送る
+        key = session_key(target, body)
+        if key is not None:
+            return key
+        match = _CHARACTER_PATH.match(target.partition("?")[0])
+        if match is None:
+            return None
+        char_id = match.group(1)
+        key = self._characters.get(char_id)
+        if key is None:
+            key = character_session(char_id)
+            if key is not None:
+                if len(self._characters) >= _CHARACTER_CACHE_ENTRIES:
+                    self._characters.clear()
+                self._characters[char_id] = key
+        return key
+
+    def pick(self, key: Optional[str]) -> Tuple[int, str]:
+        # crc32 はプロセスをまたいで安定（hash() はプロセスごとにソルトが変わる）
+        if key is None:
+            index = next(self._round_robin) % len(self.sockets)
+        else:
+            index = zlib.crc32(key.encode("utf-8")) % len(self.sockets)
+        return index, self.sockets[index]
+
+    def connection(self, path: str, fresh: bool = False) -> _UnixConnection:
+        # スレッドごとにワーカーへの keep-alive 接続を使い回す（入れ替え後は新しいソケットへ繋ぎ直す）
+        pool: Dict[str, _UnixConnection] = self._local.__dict__.setdefault("pool", {})
+        conn = pool.get(path)
+        if conn is not None and fresh:
+            conn.close()
+            conn = None
+        if conn is None:
+            conn = pool[path] = _UnixConnection(path, timeout=GRACEFUL_TIMEOUT + 60)
+        return conn
+
+    def discard(self, path: str) -> None:
+        conn = self._local.__dict__.get("pool", {}).pop(path, None)
+        if conn is not None:
+            conn.close()
+
+
+class _ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "trpg-router"
+
+    def log_request(self, code="-", size="-") -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self._proxy()
+
+    do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = do_OPTIONS = do_GET
+
+    def _read_body(self) -> Optional[bytes]:
+        # Content-Length か chunked のボディを読み切る（ワーカーへは Content-Length 付きで渡す）
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            parts = []
+            while True:
+                size = int(self.rfile.readline().split(b";", 1)[0], 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    return b"".join(parts)
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = self.headers.get("Content-Length")
+        return self.rfile.read(int(length)) if length else None
+
+    def _proxy(self) -> None:
+        router: Router = self.server.router
+        body = self._read_body()
+        index, path = router.pick(router.route_key(self.path, body))
+        headers = {k: v for k, v in self.headers.items() if k.lower() not in _HOP_BY_HOP}
+        headers["X-Forwarded-For"] = self.client_address[0]
+        if body is not None:
+            headers["Content-Length"] = str(len(body))
+        try:
+            response = self._forward(router, path, headers, body)
+        except OSError as exc:
+            router.discard(path)
+            logger.warning("worker %d unavailable: %s", index, exc)
+            self._reply_error(502, "worker unavailable")
+            return
+        try:
+            self._relay(response, index)
+        except OSError:
+            # クライアント切断（SSE を閉じたなど）。ワーカー側の接続も捨てる
+            self.close_connection = True
+        if self.close_connection or response.will_close or not response.isclosed():
+            router.discard(path)
+
+    def _forward(self, router: Router, path: str, headers: Dict[str, str], body: Optional[bytes]) -> http.client.HTTPResponse:
+        # 使い回した接続がワーカー側で閉じられていたら 1 度だけ繋ぎ直す
+        for attempt in range(2):
+            conn = router.connection(path, fresh=attempt > 0)
+            try:
+                conn.request(self.command, self.path, body=body, headers=headers)
+                return conn.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                if attempt:
+                    raise
+        raise AssertionError("unreachable")
+
+    def _relay(self, response: http.client.HTTPResponse, index: int) -> None:
+        # ワーカーの応答をそのまま返す。長さが無いもの（SSE・ストリーミング）は chunked で逐次転送する
+        self.send_response_only(response.status, response.reason)
+        for key, value in response.getheaders():
+            if key.lower() not in _HOP_BY_HOP:
+                self.send_header(key, value)
+        self.send_header("X-TRPG-Worker", str(index))
+        has_body = self.command != "HEAD" and response.status not in (204, 304) and response.status >= 200
+        length = response.getheader("Content-Length")
+        if not has_body or length is not None:
+            self.end_headers()
+            remaining = int(length or 0) if has_body else 0
+            while remaining > 0:
+                chunk = response.read(min(remaining, 65536))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+            response.read()
+            return
+        chunked = self.request_version == "HTTP/1.1"
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.close_connection = True
+        self.end_headers()
+        while True:
+            chunk = response.read1(65536)
+            if not chunk:
+                break
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+            self.wfile.flush()
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+    def _reply_error(self, status: int, message: str) -> None:
+        body = ('{"error": "%s"}' % message).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _RouterServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, router: Router):
+        super().__init__(address, _ProxyHandler)
+        self.router = router
+
+
+class _InFlight:
+    """処理中のリクエスト数を数える WSGI ミドルウェア（停止時にドレインを待つため）。"""
+
+    def __init__(self, app):
+        self.app = app
+        self.active = 0
+        self._cond = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        from werkzeug.wsgi import ClosingIterator
+
+        with self._cond:
+            self.active += 1
+        try:
+            body = self.app(environ, start_response)
+        except BaseException:
+            self._done()
+            raise
+        return ClosingIterator(body, self._done)
+
+    def _done(self) -> None:
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def wait_idle(self, timeout: float) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self.active <= 0, timeout)
+
+
+def _serve_worker(app_spec: str, app, path: str) -> None:
+    # 子プロセス本体: Unix ソケットで WSGI アプリを提供し、SIGTERM で受付を止めてドレインしてから終わる
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class _QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C は親が受けて順に止める
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    if app is None:
+        from . import bootstrap
+
+        app = load_app(app_spec)
+        bootstrap.bootstrap()
+    tracked = _InFlight(app)
+    server = make_server("unix://" + path, 0, tracked, threaded=True, request_handler=_QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    parent = os.getppid()
+    # 親が SIGKILL などで消えたら孤児として残らないよう自分も止まる
+    while not stopping.wait(1.0) and os.getppid() == parent:
+        pass
+    server.shutdown()
+    server.server_close()
+    if os.path.exists(path):
+        os.unlink(path)
+    if not tracked.wait_idle(GRACEFUL_TIMEOUT):
+        logger.warning("worker %d: %d requests still running after %.0fs", os.getpid(), tracked.active, GRACEFUL_TIMEOUT)
+    from . import services
+
+    services.flush_logs()
+
+
+class Master:
+    """ワーカーの fork・監視・入れ替えと、振り分けルーターの起動を受け持つ親プロセス。"""
+
+    def __init__(self, app_spec: str = "app:app", host: str = "127.0.0.1", port: int = 5000, workers: int = 2, preload: bool = True):
+        self.app_spec = app_spec
+        self.host = host
+        self.port = port
+        self.workers = max(1, workers)
+        self.preload = preload
+        self.app = None
+        self.rundir = tempfile.mkdtemp(prefix="trpg-workers-")
+        self.pids: List[Optional[int]] = [None] * self.workers
+        self.router = Router([""] * self.workers)
+        self.httpd: Optional[_RouterServer] = None
+        self._generation = itertools.count()
+        self._retiring: Dict[int, float] = {}
+        self._reload = False
+        self._stop = False
+
+    def run(self) -> None:
+        if self.preload:
+            from . import bootstrap, db
+
+            self.app = load_app(self.app_spec)
+            bootstrap.bootstrap()
+            # 親の SQLite 接続を子へ持ち込まない（スキーマ確認済みの状態は残るので子では DDL が走らない）
+            db.dispose_engines()
+        for index in range(self.workers):
+            self._spawn(index)
+        self.httpd = _RouterServer((self.host, self.port), self.router)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        host, port = self.httpd.server_address[:2]
+        logger.info("listening on http://%s:%d with %d workers", host, port, self.workers)
+        signal.signal(signal.SIGHUP, lambda *_: setattr(self, "_reload", True))
+        signal.signal(signal.SIGTERM, lambda *_: setattr(self, "_stop", True))
+        signal.signal(signal.SIGINT, lambda *_: setattr(self, "_stop", True))
+        try:
+            while not self._stop:
+                if self._reload:
+                    self._reload = False
+                    self.reload()
+                self._reap()
+                time.sleep(0.2)
+        finally:
+            self.shutdown()
+
+    def reload(self) -> None:
+        # 1 スロットずつ新しいワーカーを立ててから振り分け先を切り替え、古いワーカーをドレインさせる
+        logger.info("reloading %d workers", self.workers)
+        for index in range(self.workers):
+            old = self.pids[index]
+            self._spawn(index)
+            if old is not None:
+                self._retire(old)
+
+    def shutdown(self) -> None:
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        for pid in self.pids:
+            if pid is not None:
+                self._retire(pid)
+        self.pids = [None] * self.workers
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT + 5
+        while self._retiring and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in list(self._retiring):
+            self._kill(pid, signal.SIGKILL)
+        self._reap()
+
+    def _spawn(self, index: int) -> None:
+        path = os.path.join(self.rundir, f"worker-{index}-{next(self._generation)}.sock")
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                if self.httpd is not None:
+                    self.httpd.socket.close()  # 親のリスナーを子が握り続けないように
+                _serve_worker(self.app_spec, self.app, path)
+            except BaseException:
+                logger.exception("worker %d crashed", os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+        self._wait_ready(pid, path)
+        self.pids[index] = pid
+        self.router.sockets[index] = path
+        logger.info("worker %d ready (pid %d)", index, pid)
+
+    def _wait_ready(self, pid: int, path: str) -> None:
+        deadline = time.monotonic() + START_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                    probe.connect(path)
+                return
+            except OSError:
+                if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                    raise RuntimeError(f"worker {pid} exited during start-up")
+                time.sleep(0.02)
+        self._kill(pid, signal.SIGKILL)
+        raise RuntimeError(f"worker {pid} did not start within {START_TIMEOUT:.0f}s")
+
+    def _retire(self, pid: int) -> None:
+        self._retiring[pid] = time.monotonic()
+        self._kill(pid, signal.SIGTERM)
+
+    def _kill(self, pid: int, sig: int) -> None:
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _reap(self) -> None:
+        # 終了した子を回収し、予期せず落ちたワーカーは同じスロットで立て直す
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if self._retiring.pop(pid, None) is not None:
+                continue
+            if pid in self.pids and not self._stop:
+                index = self.pids.index(pid)
+                logger.warning("worker %d (pid %d) exited with status %d; restarting", index, pid, status)
+                self.pids[index] = None
+                try:
+                    self._spawn(index)
+                except RuntimeError:
+                    logger.exception("could not restart worker %d", index)
+                    time.sleep(1.0)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    # 本番用の起動口: python -m trpg_app.server --workers 4 --port 5000
+    parser = argparse.ArgumentParser(description="Serve the TRPG app with pre-forked workers and session-affinity routing.")
+    parser.add_argument("--app", default="app:app", help="WSGI application as module:attr (default app:app)")
+    parser.add_argument("--host", default=os.getenv("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "5000")), help="0 picks a free port")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("TRPG_WORKERS", str(os.cpu_count() or 1))))
+    parser.add_argument("--no-preload", dest="preload", action="store_false", help="import the app in each worker (HUP reloads code)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(process)d] %(levelname)s %(message)s")
+    Master(args.app, args.host, args.port, args.workers, args.preload).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,18 @@
 from __future__ import annotations
 
+import logging
 import uuid
-from typing import Dict, List, Optional
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
-from sqlalchemy import select
+from sqlalchemy import func, insert, select, update
 
-from . import db, rules
+from . import cache, coldstore, db, domain, events, history, logwriter, memory, metrics, rules, tracing
 from .models import Character, DiceLog, Session, TurnLog
 
-db.init_db()
+logger = logging.getLogger(__name__)
+
+metrics.COUNTERS["trpg_post_commit_errors_total"] = "Post-commit hooks (events, listeners, memory index) that raised after a committed write."
 
 
 def _uid() -> str:
@@ -16,6 +20,11 @@ def _uid() -> str:
     return uuid.uuid4().hex
 
 
+def _now() -> str:
+    # モデルの created_at と同じ形式の現在時刻
+    return datetime.utcnow().isoformat() + "Z"
+
+
 def _character_to_dict(character: Character) -> Dict:
     # Character モデルを API 用の辞書に変換
     base_stats = db.loads(character.base_stats) or {}
@@ -36,23 +45,129 @@ def _character_to_dict(character: Character) -> Dict:
     }
 
 
-def _session_to_dict(session: Session, include_children: bool = True) -> Dict:
-    # Session モデルを API 用の辞書に変換
-    payload = {
+def _character_from_row(character: Character) -> domain.Character:
+    # Character モデルをルール処理用のドメインオブジェクトに変換（数値化はここで 1 回だけ）
+    base_stats = domain.int_map(db.loads(character.base_stats))
+    resources = domain.Resources.from_dict(db.loads(character.resources))
+    derived_stats = db.loads(character.derived_stats)
+    return domain.Character(
+        id=character.id,
+        session_id=character.session_id,
+        name=character.name,
+        race=character.race,
+        clazz=character.clazz,
+        level=character.level,
+        base_stats=base_stats,
+        skills=domain.int_map(db.loads(character.skills)),
+        resources=resources,
+        derived_stats=(
+            domain.DerivedStats.from_dict(derived_stats) if derived_stats else rules.derive_stats(base_stats, resources)
+        ),
+        created_at=character.created_at,
+    )
+
+
+def _turn_log_to_dict(row: TurnLog) -> Dict:
+    # TurnLog モデルを API 用の辞書に変換
+    return {
+        "id": row.id,
+        "session_id": row.session_id,
+        "turn_no": row.turn_no,
+        "player_input": row.player_input,
+        "gm_output": db.loads(row.gm_output) or {},
+        "dice_results": db.loads(row.dice_results) or [],
+        "world_diff": db.loads(row.world_diff) or {},
+        "created_at": row.created_at,
+    }
+
+
+def _dice_log_to_dict(row: DiceLog) -> Dict:
+    # DiceLog モデルを API 用の辞書に変換
+    return {
+        "id": row.id,
+        "session_id": row.session_id,
+        "expression": row.expression,
+        "result": db.loads(row.result) or {},
+        "created_at": row.created_at,
+    }
+
+
+def _session_to_dict(session: Session) -> Dict:
+    # Session モデルを API 用の辞書に変換（子テーブルは含めない）
+    return {
         "id": session.id,
         "name": session.name,
         "created_at": session.created_at,
         "settings": db.loads(session.settings) or {},
         "safety": db.loads(session.safety) or {},
         "save_blob": db.loads(session.save_blob) or {"messages": [], "world_facts": {}},
+        "version": session.version,
     }
-    if include_children:
-        payload["characters"] = [_character_to_dict(c) for c in session.characters]
-        payload["turn_logs"] = list_turn_logs(session.id)
-        payload["dice_logs"] = list_dice_logs(session.id)
-    return payload
 
 
+def _bump_version(orm, session_id: Optional[str], by: int = 1) -> Optional[int]:
+    # セッションのバージョンを by 進めて新しい値を返す（services の書き込みは必ずこれを通す）
+    if not session_id:
+        return None
+    return orm.execute(
+        update(Session)
+        .where(Session.id == session_id)
+        .values(version=Session.version + by)
+        .returning(Session.version)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+
+
+_cache = cache.from_env()
+_shared = cache.shared_from_env()
+# このプロセスがコミットを見届けた各セッションの最新バージョン（TRPG_SESSION_CACHE=process 用）
+_known_versions: Dict[str, int] = {}
+# キャラクター ID -> セッション ID（キャラクターのキャッシュもセッションのバージョンで照合する）
+_character_sessions: Dict[str, str] = {}
+# コミット後にセッションのバージョンが進むたびに (session_id, version) で呼ぶ関数（プロセス内の派生データの破棄用）
+version_listeners: List[Callable[[str, int], None]] = []
+
+
+def _current_version(session_id: str) -> Optional[int]:
+    # キャッシュの照合に使う現在のバージョン
+    if cache.MODE == "process":
+        return _known_versions.get(session_id)
+    return get_session_version(session_id)
+
+
+def _after_commit(hook: str, func: Callable, *args) -> None:
+    # コミット済みの書き込みの後始末を呼ぶ。失敗は記録するだけで呼び出し元へは伝えない（書き込み自体は成功している）
+    try:
+        func(*args)
+    except Exception:
+        metrics.inc("trpg_post_commit_errors_total", hook=hook)
+        logger.exception("post-commit hook %s failed", hook)
+
+
+def _publish(session_id: Optional[str], event: Dict) -> None:
+    # コミット後に呼ぶ。既知のバージョンを進めて（= 古いキャッシュを無効化して）から変更イベントを配信
+    version = event.get("version")
+    if _cache is not None and session_id and version is not None and version > _known_versions.get(session_id, 0):
+        _known_versions[session_id] = version
+    _after_commit("events", events.publish, session_id, event)
+    if session_id and version is not None:
+        for listener in version_listeners:
+            _after_commit("version_listener", listener, session_id, version)
+
+
+def _cache_size(value) -> int:
+    # キャッシュ容量計算用のおおよそのバイト数（エンコード後の JSON の長さ）
+    return len(db.codec.encode(value.to_dict() if isinstance(value, domain.Character) else value))
+
+
+def get_session_version(session_id: str) -> Optional[int]:
+    # 主キー 1 回の参照でバージョンだけを返す（条件付き GET 用）。存在しなければ None
+    flush_logs()
+    with db.session_scope() as orm:
+        return orm.execute(select(Session.version).where(Session.id == session_id)).scalar()
+
+
+@tracing.traced()
 def create_session(name: Optional[str] = None, settings: Optional[Dict] = None, safety: Optional[Dict] = None) -> Dict:
     # セッションを新規作成
     session_id = _uid()
@@ -68,61 +183,108 @@ def create_session(name: Optional[str] = None, settings: Optional[Dict] = None,
     return get_session(session_id)
 
 
-def get_session(session_id: str) -> Optional[Dict]:
-    # セッション ID からデータを取得
+@tracing.traced()
+def get_session(session_id: str, version: Optional[int] = None) -> Optional[Dict]:
+    """セッション ID からデータを取得する。version には呼び出し側が読んだ現在のバージョンを渡せる。
+
+    キャッシュ有効時は同じバージョンの間はメモリ上の辞書を共有して返すので、書き換えないこと。
+    """
+    flush_logs()
+    if _cache is None and _shared is None:
+        return _load_session(session_id)
+    if version is None:
+        version = _current_version(session_id)
+        if version is None and cache.MODE != "process":
+            return None
+    key = ("session", session_id)
+    payload = _cache.get(key, version) if _cache is not None else None
+    if payload is not None:
+        return payload
+    # プロセス内 → 共有層 → SQL の順に探し、見つかった層より手前に詰め直す
+    payload = _shared.get(key, version) if _shared is not None else None
+    if payload is None:
+        payload = _load_session(session_id)
+        if payload is None:
+            return None
+        if _shared is not None:
+            _shared.put(key, payload["version"], payload)
+    if _cache is not None:
+        _known_versions.setdefault(session_id, payload["version"])
+        _cache.put(key, payload["version"], payload, _cache_size(payload))
+    return payload
+
+
+def _load_session(session_id: str) -> Optional[Dict]:
     with db.session_scope() as orm:
         model = orm.get(Session, session_id)
         if not model:
             return None
-        # 遅延評価のため明示的に children をロード
-        _ = model.characters, model.turn_logs, model.dice_logs
-        return _session_to_dict(model)
+        payload = _session_to_dict(model)
+        payload["characters"] = [_character_to_dict(c) for c in model.characters]
+    # ログは別トランザクションで読む（読み取りトランザクション中にログライターの書き込みを待たない）
+    payload["turn_logs"] = list_turn_logs(session_id)
+    payload["dice_logs"] = list_dice_logs(session_id)
+    return payload
 
 
+@tracing.traced()
 def list_turn_logs(session_id: str) -> List[Dict]:
-    # ターンログ一覧を取得
+    # ターンログ一覧を取得（アーカイブ済みの古いログも透過的に含める）
+    flush_logs()
+    # 退避の境界は sessions 行から読む（退避していないセッションではアーカイブ DB を開かない）
     with db.session_scope() as orm:
+        archived_upto = coldstore.hot_boundary(orm, session_id, "turn_log")
         result = orm.execute(
-            select(TurnLog).where(TurnLog.session_id == session_id).order_by(TurnLog.id.asc())
+            select(TurnLog)
+            .where(TurnLog.session_id == session_id, TurnLog.id > archived_upto)
+            .order_by(TurnLog.id.asc())
         )
-        rows = []
-        for row in result.scalars():
-            rows.append(
-                {
-                    "id": row.id,
-                    "session_id": row.session_id,
-                    "turn_no": row.turn_no,
-                    "player_input": row.player_input,
-                    "gm_output": db.loads(row.gm_output) or {},
-                    "dice_results": db.loads(row.dice_results) or [],
-                    "world_diff": db.loads(row.world_diff) or {},
-                    "created_at": row.created_at,
-                }
-            )
-        return rows
-
-
-def list_dice_logs(session_id: Optional[str] = None) -> List[Dict]:
-    # ダイスログ一覧を取得（最新50件）
+        hot = [_turn_log_to_dict(row) for row in result.scalars()]
+    if not archived_upto:
+        return hot
+    # 読んだ後に進んだ退避の分はホット側で読み済みなので、境界までに絞る
+    rows = [_turn_log_to_dict(row) for row in coldstore.iter_rows(session_id, "turn_log") if row.id <= archived_upto]
+    rows.extend(hot)
+    return rows
+
+
+@tracing.traced()
+def search_history(session_id: str, query: str, limit: int = 10) -> List[Dict]:
+    # ターン履歴の全文検索（アーカイブ済みのターンも対象）。キュー中のログも先に書かせる
+    flush_logs()
+    return history.search(session_id, query, limit)
+
+
+def recall_memories(session_id: str, query: str, k: int = memory.TOP_K) -> List[Dict]:
+    # 意味的に近い過去のターン（TRPG_MEMORY=1 のときだけ。無効なら空）
+    if _memory is None or not (query or "").strip():
+        return []
+    flush_logs()
+    return _memory.search(session_id, query, k)
+
+
+@tracing.traced()
+def list_dice_logs(session_id: Optional[str] = None, limit: int = 50) -> List[Dict]:
+    # ダイスログ一覧を取得（最新50件）。ホット側で足りなければアーカイブから補う
+    flush_logs()
     with db.session_scope() as orm:
-        stmt = select(DiceLog).order_by(DiceLog.id.desc()).limit(50)
+        archived_upto = coldstore.hot_boundary(orm, session_id, "dice_log") if session_id else 0
+        stmt = select(DiceLog).where(DiceLog.id > archived_upto).order_by(DiceLog.id.desc()).limit(limit)
         if session_id:
             stmt = stmt.where(DiceLog.session_id == session_id)
         result = orm.execute(stmt)
-        rows = []
-        for row in result.scalars():
-            rows.append(
-                {
-                    "id": row.id,
-                    "session_id": row.session_id,
-                    "expression": row.expression,
-                    "result": db.loads(row.result) or {},
-                    "created_at": row.created_at,
-                }
-            )
-        return rows
-
-
+        rows = [_dice_log_to_dict(row) for row in result.scalars()]
+    if archived_upto and len(rows) < limit:
+        for row in coldstore.iter_rows(session_id, "dice_log", newest_first=True):
+            if row.id > archived_upto:
+                continue
+            rows.append(_dice_log_to_dict(row))
+            if len(rows) >= limit:
+                break
+    return rows
+
+
+@tracing.traced()
 def list_characters(session_id: str) -> List[Dict]:
     # セッションに紐づくキャラクター一覧を取得
     with db.session_scope() as orm:
@@ -130,6 +292,7 @@ def list_characters(session_id: str) -> List[Dict]:
         return [_character_to_dict(c) for c in result.scalars()]
 
 
+@tracing.traced()
 def create_character(
     session_id: str,
     name: str,
@@ -159,9 +322,13 @@ def create_character(
             derived_stats=db.dumps(derived_stats),
         )
         orm.add(model)
-    return get_character(char_id)
+        version = _bump_version(orm, session_id)
+    character = get_character(char_id)
+    _publish(session_id, {"type": "character", "version": version, "character": character_summary(character)})
+    return character
 
 
+@tracing.traced()
 def update_character(char_id: str, payload: Dict) -> Optional[Dict]:
     # キャラクター情報を更新
     with db.session_scope() as orm:
@@ -180,9 +347,14 @@ def update_character(char_id: str, payload: Dict) -> Optional[Dict]:
         model.skills = db.dumps(payload.get("skills", current.get("skills")) or {})
         model.resources = db.dumps(resources)
         model.derived_stats = db.dumps(derived_stats)
-    return get_character(char_id)
+        session_id = model.session_id
+        version = _bump_version(orm, session_id)
+    character = get_character(char_id)
+    _publish(session_id, {"type": "character", "version": version, "character": character_summary(character)})
+    return character
 
 
+@tracing.traced()
 def get_character(char_id: str) -> Optional[Dict]:
     # キャラクター ID からデータを取得
     with db.session_scope() as orm:
@@ -192,77 +364,559 @@ def get_character(char_id: str) -> Optional[Dict]:
         return _character_to_dict(model)
 
 
-def log_dice(session_id: Optional[str], expression: str, result: Dict) -> int:
-    # ダイスロール結果をログ保存
+@tracing.traced()
+def load_character(char_id: str) -> Optional[domain.Character]:
+    # ルール処理用にキャラクターを型付きで取得（キャッシュ有効時は共有オブジェクトなので書き換えない）
+    session_id = _character_sessions.get(char_id) if _cache is not None else None
+    if session_id is not None:
+        cached = _cache.get(("character", char_id), _current_version(session_id))
+        if cached is not None:
+            return cached
     with db.session_scope() as orm:
-        model = DiceLog(
-            session_id=session_id,
-            expression=expression,
-            result=db.dumps(result),
-        )
-        orm.add(model)
-        orm.flush()
-        return model.id
+        # バージョンは行と同じクエリで読み、内容より新しい版として登録しないようにする
+        row = orm.execute(
+            select(Character, Session.version).join(Session, Character.session_id == Session.id).where(Character.id == char_id)
+        ).first()
+        if not row:
+            return None
+        character, version = _character_from_row(row[0]), row[1]
+    if _cache is not None:
+        _character_sessions[char_id] = character.session_id
+        _known_versions.setdefault(character.session_id, version)
+        _cache.put(("character", char_id), version, character, _cache_size(character))
+    return character
+
+
+def _write_log_batch(records: List[Tuple[str, Dict]]) -> List[int]:
+    """(種別, 行の値) のログ行をまとめて 1 トランザクションで書き、挿入した ID を順に返す。
+
+    セッションのバージョンは行数分まとめて進め、各行に 1 つずつ割り当てて変更イベントを配信する。
+    ターン番号もここで（書き込みロックを取った後に）セッションごとに続きから割り当て、行の値に書き込む。
+    """
+    targets = {"dice_log": DiceLog, "turn_log": TurnLog}
+    ids: List[Optional[int]] = [None] * len(records)
+    counts: Dict[str, int] = {}
+    turns: Dict[str, List[Dict]] = {}
+    for kind, values in records:
+        if values.get("session_id"):
+            counts[values["session_id"]] = counts.get(values["session_id"], 0) + 1
+            if kind == "turn_log":
+                turns.setdefault(values["session_id"], []).append(values)
+    with db.session_scope() as orm:
+        # 先にバージョンを進めて書き込みロックを取る（同時のターンが同じターン番号を読まないように）。
+        # 行ごとのバージョン = 一括更新後の値から逆算（書き込み順に 1 ずつ）
+        next_version = {}
+        for sid, n in counts.items():
+            bumped = _bump_version(orm, sid, by=n)
+            # 存在しないセッション宛ての行はバージョンを持たない（行自体は従来どおり書く）
+            if bumped is not None:
+                next_version[sid] = bumped - n + 1
+        for sid, rows in turns.items():
+            first = _reserve_turn_numbers(orm, sid, len(rows))
+            for turn_no, values in enumerate(rows, start=first):
+                values["turn_no"] = turn_no
+        for kind, model_cls in targets.items():
+            positions = [i for i, (k, _) in enumerate(records) if k == kind]
+            if not positions:
+                continue
+            inserted = orm.execute(
+                insert(model_cls).returning(model_cls.id, sort_by_parameter_order=True),
+                [records[i][1] for i in positions],
+            ).scalars()
+            for i, row_id in zip(positions, inserted):
+                ids[i] = row_id
+            if kind == "turn_log":
+                # 検索索引も同じトランザクションで足す
+                history.index_turns(orm, [(ids[i], records[i][1]) for i in positions])
+    # ここから先はコミット済み。後始末が失敗しても ID は返す（例外が出るとライターが同じ行をもう一度書いてしまう）
+    if _memory is not None:
+        # 意味記憶はコミット後に追記する（DB の外のファイルなので、失敗してもログの書き込みは取り消さない）
+        turns = [(ids[i], values) for i, (kind, values) in enumerate(records) if kind == "turn_log"]
+        _after_commit("memory", _add_memory_turns, turns)
+    for (kind, values), row_id in zip(records, ids):
+        session_id = values.get("session_id")
+        version = None
+        if session_id in next_version:
+            version = next_version[session_id]
+            next_version[session_id] += 1
+        _after_commit("log_event", _publish_log, kind, values, row_id, version)
+    return ids
+
+
+def _add_memory_turns(turns: List[Tuple[int, Dict]]) -> None:
+    try:
+        _memory.add_turns(turns)
+    except OSError:
+        metrics.inc("trpg_memory_errors_total")
+
+
+def _publish_log(kind: str, values: Dict, row_id: int, version: Optional[int]) -> None:
+    _publish(values.get("session_id"), _log_event(kind, values, row_id, version))
+
+
+def _reserve_turn_numbers(orm, session_id: str, n: int) -> int:
+    # セッションのターン番号を n 個確保して最初の番号を返す（書き込みロックを取った後に呼ぶ）
+    current = orm.execute(select(Session.turn_count).where(Session.id == session_id)).scalar()
+    if current is None:
+        # 番号を数えていないセッション（古い DB・取り込み）はアーカイブを含めたログの最大値から続ける
+        hot = orm.execute(select(func.max(TurnLog.turn_no)).where(TurnLog.session_id == session_id)).scalar()
+        current = max(hot or 0, coldstore.last_archived_turn(session_id))
+    orm.execute(
+        update(Session)
+        .where(Session.id == session_id)
+        .values(turn_count=current + n)
+        .execution_options(synchronize_session=False)
+    )
+    return current + 1
+
+
+def _log_event(kind: str, values: Dict, row_id: int, version: Optional[int]) -> Dict:
+    # ログ行 1 件分の変更イベント
+    if kind == "dice_log":
+        entry = {
+            "id": row_id,
+            "session_id": values["session_id"],
+            "expression": values["expression"],
+            "result": db.loads(values["result"]),
+            "created_at": values["created_at"],
+        }
+        return {"type": "dice", "version": version, "entry": entry}
+    gm_output = db.loads(values["gm_output"]) or {}
+    return {
+        "type": "turn",
+        "version": version,
+        "turn_no": values["turn_no"],
+        "player_input": values["player_input"],
+        "narration": gm_output.get("narration"),
+        "choices": gm_output.get("choices") or [],
+    }
+
+
+_log_writer = logwriter.from_env(_write_log_batch)
+_memory = memory.from_env()
+
+
+def _submit_log(kind: str, values: Dict) -> logwriter.Pending:
+    # 既定は 1 行 1 トランザクションで即時に書く。TRPG_LOG_WRITER=batch ならライターに積む
+    if _log_writer is None:
+        # 失敗はライター経由と同じく Pending に載せ、result() で呼び出し側に届ける
+        try:
+            return logwriter.Pending.resolved(_write_log_batch([(kind, values)])[0])
+        except Exception as exc:
+            pending = logwriter.Pending()
+            pending.set(error=exc)
+            return pending
+    return _log_writer.submit((kind, values))
+
+
+def flush_logs() -> None:
+    # キュー中のログ行をコミットさせる（読み取り前に呼び、自分の書き込みが見えるようにする）
+    if _log_writer is not None:
+        _log_writer.flush()
+
+
+@tracing.traced()
+def submit_dice_log(session_id: Optional[str], expression: str, result: Dict) -> logwriter.Pending:
+    # ダイスロール結果のログ保存を依頼（ID は Pending.result() で得る）
+    return _submit_log(
+        "dice_log",
+        {"session_id": session_id, "expression": expression, "result": db.dumps(result), "created_at": _now()},
+    )
+
+
+def log_dice(session_id: Optional[str], expression: str, result: Dict) -> int:
+    # ダイスロール結果をログ保存し、コミットを待って ID を返す
+    return submit_dice_log(session_id, expression, result).result()
+
+
+@tracing.traced()
+def submit_turn_log(
+    session_id: str,
+    player_input: str,
+    gm_output: Dict,
+    dice_results: List[Dict],
+    world_diff: Dict,
+) -> logwriter.Pending:
+    # 1 ターン分の結果のログ保存を依頼（ターン番号は書き込むトランザクションで割り当てる）
+    return _submit_log(
+        "turn_log",
+        {
+            "session_id": session_id,
+            "turn_no": None,
+            "player_input": player_input,
+            "gm_output": db.dumps(gm_output, compress=True),
+            "dice_results": db.dumps(dice_results),
+            "world_diff": db.dumps(world_diff),
+            "created_at": _now(),
+        },
+    )
 
 
 def log_turn(
     session_id: str,
-    turn_no: int,
     player_input: str,
     gm_output: Dict,
     dice_results: List[Dict],
     world_diff: Dict,
 ) -> int:
-    # 1 ターン分の結果をログ保存
+    # 1 ターン分の結果をログ保存し、コミットを待って ID を返す
+    return submit_turn_log(session_id, player_input, gm_output, dice_results, world_diff).result()
+
+
+def iter_session_records(session_id: str, batch_size: int = 500) -> Iterator[Tuple[str, Dict]]:
+    """セッション配下の全レコードを (種別, 辞書) で順に返す。エクスポート用。
+
+    バッチごとに短いトランザクションを張り直す（キーセットページング）ため、
+    巨大なセッションでもメモリ使用量が一定で、他セッションの書き込みを長時間塞がない。
+    """
+    flush_logs()
     with db.session_scope() as orm:
-        model = TurnLog(
-            session_id=session_id,
-            turn_no=turn_no,
-            player_input=player_input,
-            gm_output=db.dumps(gm_output),
-            dice_results=db.dumps(dice_results),
-            world_diff=db.dumps(world_diff),
-        )
-        orm.add(model)
+        model = orm.get(Session, session_id)
+        head = _session_to_dict(model) if model else None
+    if head is None:
+        return
+    yield "session", head
+
+    def _batches(model_cls, key_col, converter, last_key=None):
+        while True:
+            with db.session_scope() as orm:
+                stmt = (
+                    select(model_cls)
+                    .where(model_cls.session_id == session_id)
+                    .order_by(key_col.asc())
+                    .limit(batch_size)
+                )
+                if last_key is not None:
+                    stmt = stmt.where(key_col > last_key)
+                rows = [converter(row) for row in orm.execute(stmt).scalars()]
+            if not rows:
+                return
+            yield from rows
+            last_key = rows[-1]["id"]
+            if len(rows) < batch_size:
+                return
+
+    for row in _batches(Character, Character.id, _character_to_dict):
+        yield "character", row
+    # ログはアーカイブ済みのセグメント → ホット DB の順に流す
+    for kind, model_cls, converter in (
+        ("turn_log", TurnLog, _turn_log_to_dict),
+        ("dice_log", DiceLog, _dice_log_to_dict),
+    ):
+        archived_upto = coldstore.archived_upto(session_id, kind)
+        if archived_upto:
+            for row in coldstore.iter_rows(session_id, kind):
+                yield kind, converter(row)
+        for row in _batches(model_cls, model_cls.id, converter, last_key=archived_upto or None):
+            yield kind, row
+
+
+def _remap_ids(value, ids: Dict[str, str]):
+    # JSON 値の中の旧キャラクター ID（値と dict のキー）を新しい ID に置き換える
+    if isinstance(value, str):
+        return ids.get(value, value)
+    if isinstance(value, dict):
+        return {ids.get(k, k) if isinstance(k, str) else k: _remap_ids(v, ids) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_remap_ids(v, ids) for v in value]
+    return value
+
+
+@tracing.traced()
+def import_session_records(records: Iterable[Tuple[str, Dict]], batch_size: int = 500) -> Dict:
+    """iter_session_records 形式のレコード列を新しい ID で 1 トランザクションに取り込む。
+
+    キャラクターは元のセッションと衝突しないよう常に新しい ID を振り、ターンログ（gm_output / dice_results /
+    world_diff）、ダイスログの result、save_blob の中で旧 ID を指している値とキーも新しい ID に書き換える。
+    書き換えのため、キャラクターのレコードはログより前に置く（エクスポートはその順で出す）。
+    """
+    session_id = _uid()
+    char_ids: Dict[str, str] = {}
+    counts = {"character": 0, "turn_log": 0, "dice_log": 0}
+    pending: Dict[str, List[Dict]] = {"turn_log": [], "dice_log": []}
+    targets = {"turn_log": TurnLog, "dice_log": DiceLog}
+    last_turn = 0
+
+    with db.session_scope() as orm:
+
+        def _flush(kind: str) -> None:
+            if pending[kind]:
+                if kind == "turn_log":
+                    inserted = orm.execute(
+                        insert(TurnLog).returning(TurnLog.id, sort_by_parameter_order=True), pending[kind]
+                    ).scalars()
+                    history.index_turns(orm, zip(inserted, pending[kind]))
+                else:
+                    orm.execute(insert(targets[kind]), pending[kind])
+                counts[kind] += len(pending[kind])
+                pending[kind] = []
+
+        seen_session = False
+        for kind, data in records:
+            if kind == "session":
+                if seen_session:
+                    raise ValueError("multiple session records in import")
+                seen_session = True
+                session_row = Session(
+                    id=session_id,
+                    name=data.get("name") or "session",
+                    created_at=data.get("created_at") or _now(),
+                    settings=db.dumps(data.get("settings") or {}),
+                    safety=db.dumps(data.get("safety") or {}),
+                    save_blob=db.dumps(data.get("save_blob") or {"messages": [], "world_facts": {}}, compress=True),
+                )
+                orm.add(session_row)
+                orm.flush()
+                continue
+            if not seen_session:
+                raise ValueError(f"{kind} record appears before session record")
+            if kind == "character":
+                if counts["turn_log"] or counts["dice_log"] or pending["turn_log"] or pending["dice_log"]:
+                    raise ValueError("character record appears after log records")
+                new_id = _uid()
+                char_ids[data["id"]] = new_id
+                base_stats = data.get("base_stats") or {}
+                resources = data.get("resources") or {}
+                orm.add(
+                    Character(
+                        id=new_id,
+                        session_id=session_id,
+                        name=data.get("name") or "",
+                        race=data.get("race"),
+                        clazz=data.get("clazz"),
+                        level=data.get("level"),
+                        base_stats=db.dumps(base_stats),
+                        skills=db.dumps(data.get("skills") or {}),
+                        resources=db.dumps(resources),
+                        derived_stats=db.dumps(
+                            data.get("derived_stats") or rules.compute_derived_stats(base_stats, resources)
+                        ),
+                        created_at=data.get("created_at") or _now(),
+                    )
+                )
+                counts["character"] += 1
+            elif kind == "turn_log":
+                last_turn = max(last_turn, data.get("turn_no") or 0)
+                pending["turn_log"].append(
+                    {
+                        "session_id": session_id,
+                        "turn_no": data.get("turn_no"),
+                        "player_input": data.get("player_input"),
+                        "gm_output": db.dumps(_remap_ids(data.get("gm_output") or {}, char_ids), compress=True),
+                        "dice_results": db.dumps(_remap_ids(data.get("dice_results") or [], char_ids)),
+                        "world_diff": db.dumps(_remap_ids(data.get("world_diff") or {}, char_ids)),
+                        "created_at": data.get("created_at") or _now(),
+                    }
+                )
+            elif kind == "dice_log":
+                pending["dice_log"].append(
+                    {
+                        "session_id": session_id,
+                        "expression": data.get("expression"),
+                        "result": db.dumps(_remap_ids(data.get("result") or {}, char_ids)),
+                        "created_at": data.get("created_at") or _now(),
+                    }
+                )
+            else:
+                raise ValueError(f"unknown record type: {kind}")
+            if kind in pending and len(pending[kind]) >= batch_size:
+                orm.flush()
+                _flush(kind)
+        if not seen_session:
+            raise ValueError("import contains no session record")
+        # 次のターンは取り込んだターンの続きから数える
+        session_row.turn_count = last_turn
+        # セッションのレコードはキャラクターより前に来るので、save_blob の ID は最後に書き換える
+        if char_ids:
+            session_row.save_blob = db.dumps(_remap_ids(db.loads(session_row.save_blob), char_ids), compress=True)
         orm.flush()
-        return model.id
+        _flush("turn_log")
+        _flush("dice_log")
+    return {"session_id": session_id, "character_ids": char_ids, "counts": counts}
+
+
+def _store_world_facts(session_id: str, version: Optional[int], world_facts: Dict) -> None:
+    # コミット後に世界フラグを共有層へ書き通す
+    if _shared is not None:
+        _shared.put(("world_facts", session_id), version, world_facts)
+
+
+@tracing.traced()
+def get_world_facts(session_id: str) -> Optional[Dict]:
+    # 世界フラグだけを取得（共有層にあればセッション全体を組み立てない）
+    if _shared is None:
+        session = get_session(session_id)
+        return (session["save_blob"].get("world_facts") or {}) if session else None
+    version = _current_version(session_id)
+    world_facts = _shared.get(("world_facts", session_id), version)
+    if world_facts is not None:
+        return world_facts
+    session = get_session(session_id, version=version)
+    if not session:
+        return None
+    world_facts = session["save_blob"].get("world_facts") or {}
+    _store_world_facts(session_id, session["version"], world_facts)
+    return world_facts
 
 
+@tracing.traced()
 def update_session_save(session_id: str, save_blob: Dict) -> None:
     # セッションのセーブデータを更新
     with db.session_scope() as orm:
         model = orm.get(Session, session_id)
-        if model:
-            model.save_blob = db.dumps(save_blob)
+        if not model:
+            return
+        model.save_blob = db.dumps(save_blob, compress=True)
+        version = _bump_version(orm, session_id)
+    world_facts = save_blob.get("world_facts") or {}
+    _store_world_facts(session_id, version, world_facts)
+    _publish(session_id, {"type": "world_facts", "version": version, "world_facts": world_facts})
+
+
+@tracing.traced()
+def set_world_fact(session_id: str, key: str, value) -> Optional[Dict]:
+    # 世界フラグを 1 つ更新して更新後の全フラグを返す（読み書きを 1 トランザクションで行う）
+    with db.session_scope() as orm:
+        model = orm.get(Session, session_id)
+        if not model:
+            return None
+        save_blob = db.loads(model.save_blob) or {"messages": [], "world_facts": {}}
+        world_facts = dict(save_blob.get("world_facts") or {})
+        world_facts[key] = value
+        save_blob["world_facts"] = world_facts
+        model.save_blob = db.dumps(save_blob, compress=True)
+        version = _bump_version(orm, session_id)
+    _store_world_facts(session_id, version, world_facts)
+    _publish(session_id, {"type": "world_facts", "version": version, "world_facts": world_facts})
+    return world_facts
+
+
+@tracing.traced()
+def append_session_messages(session_id: str, messages: List[Dict], keep: int = 50) -> Optional[int]:
+    # セーブ用メッセージ履歴に追記（読み書きを 1 トランザクションで行い、同ターンの世界フラグ更新を潰さない）
+    with db.session_scope() as orm:
+        model = orm.get(Session, session_id)
+        if not model:
+            return None
+        save_blob = db.loads(model.save_blob) or {"messages": [], "world_facts": {}}
+        save_blob["messages"] = (list(save_blob.get("messages") or []) + list(messages))[-keep:]
+        model.save_blob = db.dumps(save_blob, compress=True)
+        version = _bump_version(orm, session_id)
+    _store_world_facts(session_id, version, save_blob.get("world_facts") or {})
+    _publish(session_id, {"type": "messages", "version": version})
+    return version
+
+
+def character_summary(c: Dict) -> Dict:
+    # 状態パネル用のキャラクター要約（summarize_state や変更イベントで共通）
+    return {
+        "id": c["id"],
+        "name": c.get("name"),
+        "hp": c.get("resources", {}).get("hp"),
+        "max_hp": c.get("derived_stats", {}).get("max_hp"),
+        "ac": c.get("derived_stats", {}).get("ac"),
+        "conditions": c.get("resources", {}).get("conditions", []),
+    }
 
 
 def summarize_state(session: Dict) -> Dict:
     """Collapse session into a lightweight state payload for the front-end."""
-    chars = []
-    for c in session.get("characters", []):
-        chars.append(
-            {
-                "id": c["id"],
-                "name": c.get("name"),
-                "hp": c.get("resources", {}).get("hp"),
-                "max_hp": c.get("derived_stats", {}).get("max_hp"),
-                "ac": c.get("derived_stats", {}).get("ac"),
-                "conditions": c.get("resources", {}).get("conditions", []),
-            }
-        )
+    chars = [character_summary(c) for c in session.get("characters", [])]
     return {
         "session_id": session["id"],
         "name": session.get("name"),
         "characters": chars,
         "world_facts": session.get("save_blob", {}).get("world_facts", {}),
+        "version": session.get("version"),
     }
 
 
+@tracing.traced()
 def apply_hp_update(char_id: str, new_hp: int) -> Optional[Dict]:
-    # HP の更新を適用
-    char = get_character(char_id)
-    if not char:
-        return None
-    resources = dict(char.get("resources", {}))
+    # HP の更新を適用（読み取りから書き込みまでを 1 トランザクションで行い、同時の更新を潰さない）
+    with db.session_scope() as orm:
+        session_id = orm.execute(select(Character.session_id).where(Character.id == char_id)).scalar()
+        if session_id is None:
+            return None
+        # SQLite は最初の書き込みでトランザクションを始めるので、先にバージョンを進めて書き込みロックを取ってから読む
+        version = _bump_version(orm, session_id)
+        character = _set_hp(orm.get(Character, char_id), new_hp)
+    _publish(session_id, {"type": "character", "version": version, "character": character_summary(character)})
+    return character
+
+
+def _state_unchanged(orm, save_blob: Dict, expected_state: Dict) -> bool:
+    # 下書きが読んだキャラクター・世界フラグが、書き込みロックを取った後の現在の値と同じか
+    for char_id, expected in expected_state.get("characters", {}).items():
+        model = orm.get(Character, char_id)
+        if (_character_to_dict(model) if model is not None else None) != expected:
+            return False
+    expected_facts = expected_state.get("world_facts")
+    return expected_facts is None or (save_blob.get("world_facts") or {}) == expected_facts
+
+
+def _set_hp(model: Character, new_hp: int) -> Dict:
+    # トランザクション内で HP を書き換え、派生ステータスも計算し直す
+    current = _character_to_dict(model)
+    resources = dict(current["resources"])
     resources["hp"] = max(0, new_hp)
-    return update_character(char_id, {"resources": resources})
+    model.resources = db.dumps(resources)
+    model.derived_stats = db.dumps(rules.compute_derived_stats(current["base_stats"], resources))
+    return _character_to_dict(model)
+
+
+@tracing.traced()
+def apply_writes(
+    session_id: str,
+    expected_version: Optional[int],
+    writes: List[Tuple[str, Tuple]],
+    expected_state: Optional[Dict] = None,
+) -> Optional[Dict]:
+    """下書きの Toolset に溜めた書き込み（dice / hp / world_fact）を 1 トランザクションで適用する。
+
+    expected_state（{"characters": {id: 読んだ時点の辞書}, "world_facts": 読んだ時点の辞書 or None}）を渡せば、
+    下書きが読んだものだけを現在の値と照合し、変わっていれば何も書かずに None を返す（無関係な書き込みは衝突しない）。
+    渡さなければセッションのバージョンが expected_version から進んでいるときに None を返す。
+    適用した場合は {"characters": {id: 要約}, "world_facts": {key: value}, "dice": [(ID, 行)]} を返す。
+    """
+    applied: Dict = {"characters": {}, "world_facts": {}, "dice": []}
+    if not writes:
+        return applied
+    flush_logs()
+    events_out: List[Dict] = []
+    with db.session_scope() as orm:
+        # 先にバージョンを進めて書き込みロックを取り、進める前の値で照合する
+        version = _bump_version(orm, session_id, by=len(writes))
+        if version is None or (expected_state is None and version - len(writes) != expected_version):
+            orm.rollback()
+            return None
+        session_model = orm.get(Session, session_id)
+        save_blob = db.loads(session_model.save_blob) or {"messages": [], "world_facts": {}}
+        if expected_state is not None and not _state_unchanged(orm, save_blob, expected_state):
+            orm.rollback()
+            return None
+        world_facts = dict(save_blob.get("world_facts") or {})
+        for row_version, (kind, args) in enumerate(writes, start=version - len(writes) + 1):
+            if kind == "dice":
+                expression, result = args
+                values = {"session_id": session_id, "expression": expression, "result": db.dumps(result), "created_at": _now()}
+                row_id = orm.execute(insert(DiceLog).returning(DiceLog.id), values).scalar()
+                applied["dice"].append((row_id, {"session_id": session_id, "expression": expression, "result": result}))
+                events_out.append(_log_event("dice_log", values, row_id, row_version))
+            elif kind == "hp":
+                char_id, new_hp = args
+                summary = character_summary(_set_hp(orm.get(Character, char_id), new_hp))
+                applied["characters"][char_id] = summary
+                events_out.append({"type": "character", "version": row_version, "character": summary})
+            else:
+                key, value = args
+                world_facts[key] = value
+                applied["world_facts"][key] = value
+                events_out.append({"type": "world_facts", "version": row_version, "world_facts": dict(world_facts)})
+        if applied["world_facts"]:
+            save_blob["world_facts"] = world_facts
+            session_model.save_blob = db.dumps(save_blob, compress=True)
+    _store_world_facts(session_id, version, world_facts)
+    for event in events_out:
+        _publish(session_id, event)
+    return applied
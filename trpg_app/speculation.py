@@ -0,0 +1,173 @@
+"""Speculative pre-generation of GM turns for the choices the player was just offered.
+
+Enabled with ``GM_SPECULATE=1``. After a GM turn is answered, the first
+``GM_SPECULATE_TOP_K`` choices are played in the background against a snapshot of the
+session. ``SpeculativeToolset`` reads from the snapshot and keeps HP changes, world facts
+and dice rolls in a private overlay (copy-on-write), so nothing reaches the database or
+the event stream. Results are kept per session under (version, choice id).
+
+If the player picks one of those choices while the session is still at that version, the
+recorded writes are committed through the real ``Toolset`` and the precomputed narration is
+returned (``Speculator.claim``). The commit is a compare-and-set on the session version
+(``services.apply_writes``): if another turn committed in between, nothing is written and
+the pick is played as a normal turn. A pick that arrives while its speculation is still running
+waits for it instead of starting over. Any commit that moves the session version
+(``services.version_listeners``) drops that session's speculations and cancels queued
+ones. Results produced by a fallback (breaker open, timeout) are not kept.
+
+Entries live in this process only. The pre-fork server routes a session to one worker, so
+the pick reaches the process that speculated.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from . import gm_agent, metrics, services, tracing
+from .domain import TurnResult
+from .tools import SpeculativeToolset, Toolset
+
+ENABLED = os.getenv("GM_SPECULATE") in ("1", "true", "True")
+TOP_K = int(os.getenv("GM_SPECULATE_TOP_K", "2"))
+WORKERS = int(os.getenv("GM_SPECULATE_WORKERS", "2"))
+MAX_SESSIONS = int(os.getenv("GM_SPECULATE_SESSIONS", "1024"))
+
+metrics.COUNTERS.update(
+    {
+        "trpg_speculation_total": "Speculative GM turns by outcome (scheduled, hit, miss, stale, dropped, failed).",
+        "trpg_speculation_saved_seconds_total": "GM turn time avoided by serving a pick from its speculation.",
+    }
+)
+
+
+def _speculate(snapshot: Dict, choice_id: str) -> Optional[Tuple[TurnResult, SpeculativeToolset, float]]:
+    # 選択肢 1 つ分のターンをスナップショット上で進める（フォールバックで答えた結果は捨てる）
+    toolset = SpeculativeToolset(snapshot)
+    start = time.perf_counter()
+    with tracing.span("gm.speculate", session_id=snapshot["id"], choice_id=choice_id):
+        result = gm_agent.GMAgent(snapshot, toolset=toolset).take_turn("", choice_id)
+    if result.route.get("reason") in gm_agent.FALLBACK_REASONS:
+        return None
+    return result, toolset, time.perf_counter() - start
+
+
+class Speculator:
+    """セッションごとに、あるバージョンで提示した選択肢の先読み結果を持つ。"""
+
+    def __init__(self, top_k: int = TOP_K, workers: int = WORKERS, max_sessions: int = MAX_SESSIONS):
+        self.top_k = top_k
+        self.workers = workers
+        self.max_sessions = max_sessions
+        # session_id -> (バージョン, {choice_id: Future})
+        self._sessions: "OrderedDict[str, Tuple[int, Dict[str, Future]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool: Optional[ThreadPoolExecutor] = None
+        services.version_listeners.append(self._on_version)
+
+    def _executor(self) -> ThreadPoolExecutor:
+        # 最初に使うときに作る（pre-fork の親では作らない）
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="trpg-speculate")
+            return self._pool
+
+    def schedule(self, session_id: str, choices: List[Dict]) -> None:
+        """いまのセッション状態で、先頭 top_k 件の選択肢のターンを裏で先に進めておく。"""
+        choice_ids = [c["id"] for c in choices[: self.top_k] if c.get("id")]
+        if not choice_ids:
+            return
+        snapshot = services.get_session(session_id)
+        if not snapshot:
+            return
+        pool = self._executor()
+        futures = {choice_id: pool.submit(_speculate, snapshot, choice_id) for choice_id in choice_ids}
+        with self._lock:
+            previous = self._sessions.pop(session_id, None)
+            self._sessions[session_id] = (snapshot["version"], futures)
+            while len(self._sessions) > self.max_sessions:
+                _, (_, evicted) = self._sessions.popitem(last=False)
+                self._cancel(evicted)
+        if previous is not None:
+            self._cancel(previous[1])
+        metrics.inc("trpg_speculation_total", len(futures), outcome="scheduled")
+
+    def claim(self, session: Dict, player_input: str, selected_choice_id: Optional[str], toolset: Toolset) -> Optional[TurnResult]:
+        """選ばれた選択肢の先読みがいまのバージョンで使えれば、書き込みを toolset で適用して結果を返す。"""
+        if not selected_choice_id or player_input:
+            return None
+        session_id = session["id"]
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                future = None
+            elif entry[0] != session["version"]:
+                self._sessions.pop(session_id)
+                self._cancel(entry[1])
+                metrics.inc("trpg_speculation_total", outcome="stale")
+                return None
+            else:
+                future = entry[1].pop(selected_choice_id, None)
+        # まだ始まっていないものは取り消して普通に処理する（走っているものは待つほうが早い）
+        if future is None or future.cancel():
+            metrics.inc("trpg_speculation_total", outcome="miss")
+            return None
+        waited = time.perf_counter()
+        try:
+            outcome = future.result()
+        except Exception:
+            outcome = None
+        if outcome is None:
+            metrics.inc("trpg_speculation_total", outcome="failed")
+            return None
+        result, speculative, seconds = outcome
+        # 待っている間に状態が進んでいたら使わない。書き込みはバージョンを照合する 1 トランザクションで適用し、
+        # 照合から適用までの間に別のターンが割り込んでいれば何も書かずに普通のターンへ回す
+        if services.get_session_version(session_id) != session["version"] or not toolset.commit_writes(
+            speculative.writes, session["version"]
+        ):
+            metrics.inc("trpg_speculation_total", outcome="stale")
+            return None
+        metrics.inc("trpg_speculation_total", outcome="hit")
+        metrics.inc("trpg_speculation_saved_seconds_total", max(0.0, seconds - (time.perf_counter() - waited)))
+        return result
+
+    def _on_version(self, session_id: str, version: int) -> None:
+        # セッションが先読みしたバージョンより進んだら、その先読みは全部捨てる
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None or entry[0] >= version:
+                return
+            del self._sessions[session_id]
+        self._cancel(entry[1])
+
+    @staticmethod
+    def _cancel(futures: Dict[str, Future]) -> None:
+        for future in futures.values():
+            future.cancel()
+        if futures:
+            metrics.inc("trpg_speculation_total", len(futures), outcome="dropped")
+
+    def clear(self) -> None:
+        with self._lock:
+            sessions, self._sessions = self._sessions, OrderedDict()
+        for _, futures in sessions.values():
+            self._cancel(futures)
+
+    def close(self) -> None:
+        # 先読みを捨ててバージョン通知の登録を外す（ベンチマークなどで作り直すとき用）
+        self.clear()
+        if self._on_version in services.version_listeners:
+            services.version_listeners.remove(self._on_version)
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+
+def from_env() -> Optional[Speculator]:
+    # GM_SPECULATE=1 のときだけ作る
+    return Speculator() if ENABLED else None
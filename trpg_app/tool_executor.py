@@ -0,0 +1,228 @@
+"""Concurrent execution of the tool calls the GM emits in one step.
+
+Each call's footprint (state it reads / writes) is derived from the tool name and its
+arguments. A call waits only for earlier calls it conflicts with: a write to the same
+character (HP from ``attack_roll`` / ``evaluate_rule``), the world facts, or a state read
+after such a write. Everything else, such as ``query_game_state`` next to skill checks for
+different characters, runs at the same time on a shared thread pool. Results come back in
+call order, so the outcome matches running the calls one after another.
+
+Each call gets its own RNG seeded in call order, which keeps dice reproducible whatever the
+thread scheduling. Per-call timings and the wall time saved are reported in ``StepReport``.
+
+Frameworks that invoke tools one by one (DeepAgents / LangGraph run a step's calls on their
+own threads) cannot hand over a whole step. For them, ``serialized`` wraps each tool with
+``FootprintLocks``: a call waits while a running call conflicts with it under the same rule,
+so two HP writes to one target never interleave their read-modify-write.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import functools
+import inspect
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from . import metrics, tracing
+
+# 既定は CPU 数（上限 4）。1 コアでは SQLite の書き込みロックと GIL で並行の利点がなく、逐次で実行する
+MAX_WORKERS = int(os.getenv("TRPG_TOOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+metrics.COUNTERS["trpg_tool_parallel_saved_seconds_total"] = "Wall time saved by running independent tool calls concurrently."
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _shared_pool() -> ThreadPoolExecutor:
+    # プロセスで 1 つ、最初に使うときに作る（pre-fork の親では作らない）
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="trpg-tool")
+    return _pool
+
+
+def footprint(name: str, args: Dict) -> Tuple[Set[str], Set[str]]:
+    """ツール呼び出しが (読む, 書く) 状態のキー。character:<id> / character:*（全員）/ world_facts / *（不明なツール）。"""
+    if name == "query_game_state":
+        if args.get("selector") == "world_facts":
+            return {"world_facts"}, set()
+        return {"character:*", "world_facts"}, set()
+    if name == "request_skill_check":
+        # ダイスログは追記のみなので競合として扱わない
+        return {f"character:{args.get('actor_id')}"}, set()
+    if name in ("attack_roll", "evaluate_rule"):
+        actor = args.get("attacker_id") or args.get("actor_id")
+        target = args.get("target_id")
+        reads = {f"character:{actor}"} | ({f"character:{target}"} if target else set())
+        return reads, {f"character:{target}"} if target else set()
+    if name in ("search_history", "recall_memories"):
+        # コミット済みのターンログ（とその索引）だけを読む（このステップのどの書き込みとも競合しない）
+        return {"history"}, set()
+    if name == "update_world_fact":
+        return set(), {"world_facts"}
+    return set(), {"*"}
+
+
+def _overlaps(left: Set[str], right: Set[str]) -> bool:
+    for a in left:
+        for b in right:
+            if a == b or a == "*" or b == "*":
+                return True
+            if (a == "character:*" and b.startswith("character:")) or (b == "character:*" and a.startswith("character:")):
+                return True
+    return False
+
+
+def _conflicts(left: Tuple[Set[str], Set[str]], right: Tuple[Set[str], Set[str]]) -> bool:
+    # どちらかの書き込みが、もう一方の読み書きと重なる
+    (reads_l, writes_l), (reads_r, writes_r) = left, right
+    return _overlaps(writes_l, reads_r | writes_r) or _overlaps(writes_r, reads_l)
+
+
+def dependencies(calls: Sequence[Tuple[str, Dict]]) -> List[List[int]]:
+    # 各呼び出しが待つべき、それより前の呼び出しの番号
+    prints = [footprint(name, args) for name, args in calls]
+    return [[i for i, earlier in enumerate(prints[:j]) if _conflicts(earlier, current)] for j, current in enumerate(prints)]
+
+
+class FootprintLocks:
+    """実行中の呼び出しと競合する呼び出しを待たせるロック（ツールを 1 件ずつ呼ぶフレームワーク用）。"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._running: List[Tuple[Set[str], Set[str]]] = []
+
+    @contextmanager
+    def hold(self, name: str, args: Dict):
+        claim = footprint(name, args)
+        with self._cond:
+            self._cond.wait_for(lambda: not any(_conflicts(running, claim) for running in self._running))
+            self._running.append(claim)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running.remove(claim)
+                self._cond.notify_all()
+
+
+def serialized(tool: Callable, locks: FootprintLocks) -> Callable:
+    """Toolset のツールを、足跡が競合する同時呼び出しと直列に実行するよう包む（シグネチャと説明文はそのまま）。"""
+    signature = inspect.signature(tool)
+
+    @functools.wraps(tool)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind_partial(*args, **kwargs)
+        with locks.hold(tool.__name__, dict(bound.arguments)):
+            return tool(*args, **kwargs)
+
+    return wrapper
+
+
+@dataclass(slots=True)
+class ToolCallResult:
+    name: str
+    args: Dict
+    result: Any = None
+    error: Optional[str] = None
+    started: float = 0.0  # ステップ開始からの秒数
+    seconds: float = 0.0
+    waited_for: List[int] = field(default_factory=list)
+
+    def to_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "args": self.args,
+            "error": self.error,
+            "started_ms": round(self.started * 1000, 3),
+            "duration_ms": round(self.seconds * 1000, 3),
+            "waited_for": self.waited_for,
+        }
+
+
+@dataclass(slots=True)
+class StepReport:
+    calls: List[ToolCallResult]
+    wall_seconds: float
+
+    @property
+    def results(self) -> List[Any]:
+        return [call.result for call in self.calls]
+
+    @property
+    def serial_seconds(self) -> float:
+        return sum(call.seconds for call in self.calls)
+
+    @property
+    def saved_seconds(self) -> float:
+        return max(0.0, self.serial_seconds - self.wall_seconds)
+
+    def to_dict(self) -> Dict:
+        return {
+            "calls": [call.to_dict() for call in self.calls],
+            "wall_ms": round(self.wall_seconds * 1000, 3),
+            "serial_ms": round(self.serial_seconds * 1000, 3),
+            "saved_ms": round(self.saved_seconds * 1000, 3),
+        }
+
+
+class ToolExecutor:
+    """Toolset への 1 ステップ分のツール呼び出しを、競合しないものは並行に実行する。"""
+
+    def __init__(self, toolset, max_workers: int = MAX_WORKERS):
+        self.toolset = toolset
+        self.max_workers = max_workers
+
+    def run(self, calls: Sequence[Tuple[str, Dict]]) -> StepReport:
+        """(ツール名, 引数) の列を実行し、呼び出し順の結果と時間の内訳を返す。"""
+        records = [ToolCallResult(name, dict(args)) for name, args in calls]
+        # 乱数の種は呼び出し順に引く（並行でも逐次でも同じ出目になる）
+        seeds = [self.toolset.rng.random() for _ in records]
+        start = time.perf_counter()
+        with tracing.span("tools.step", calls=len(records)) as span:
+            if len(records) <= 1 or self.max_workers <= 1:
+                for record, seed in zip(records, seeds):
+                    self._call(record, seed, start)
+            else:
+                self._run_concurrently(records, seeds, start)
+            report = StepReport(records, time.perf_counter() - start)
+            if span is not None:
+                span.set_attribute("saved_ms", round(report.saved_seconds * 1000, 3))
+        metrics.inc("trpg_tool_parallel_saved_seconds_total", report.saved_seconds)
+        return report
+
+    def _run_concurrently(self, records: List[ToolCallResult], seeds: List[float], start: float) -> None:
+        pool = _shared_pool()
+        futures: List[Future] = []
+        for record, seed, deps in zip(records, seeds, dependencies([(r.name, r.args) for r in records])):
+            record.waited_for = deps
+            # 依存先は必ず前に投入済みなので、先に取り出されて実行中か完了している（待ち合わせで詰まらない）
+            waits = [futures[i] for i in deps]
+            context = contextvars.copy_context()  # トレースのスパンと Server-Timing の集計を引き継ぐ
+            futures.append(pool.submit(context.run, self._after, waits, record, seed, start))
+        for future in futures:
+            future.result()
+
+    def _after(self, waits: List[Future], record: ToolCallResult, seed: float, start: float) -> None:
+        for future in waits:
+            future.result()
+        self._call(record, seed, start)
+
+    def _call(self, record: ToolCallResult, seed: float, start: float) -> None:
+        record.started = time.perf_counter() - start
+        try:
+            with self.toolset.isolated_rng(seed):
+                record.result = getattr(self.toolset, record.name)(**record.args)
+        except Exception as exc:
+            record.error = f"{type(exc).__name__}: {exc}"
+            record.result = {"error": str(exc)}
+        record.seconds = time.perf_counter() - start - record.started
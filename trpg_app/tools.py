@@ -1,9 +1,11 @@
 from __future__ import annotations
 
 import random
-from typing import Dict, Optional
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Set, Tuple
 
-from . import rules
+from . import domain, logwriter, metrics, resilience, rules, tracing
 from . import services
 
 
@@ -12,15 +14,101 @@ class Toolset:
 
     def __init__(self, session_id: str):
         self.session_id = session_id
-        self.rng = random.Random()
+        self._rng = random.Random()
+        self._local = threading.local()
+        # このターンでツールが加えた変更（GM ターン応答の差分の材料）。writes はバージョンを進めた書き込み回数
+        self.changes: Dict = {"characters": {}, "world_facts": {}, "dice": [], "writes": 0}
+        # ツールを並行実行（tool_executor）するときの changes の保護
+        self._changes_lock = threading.Lock()
 
+    @property
+    def rng(self) -> random.Random:
+        # 並行実行中の呼び出しは呼び出しごとの乱数を使う（実行順に依らず出目が決まるように）
+        return getattr(self._local, "rng", None) or self._rng
+
+    @contextmanager
+    def isolated_rng(self, seed: float):
+        self._local.rng = random.Random(seed)
+        try:
+            yield
+        finally:
+            del self._local.rng
+
+    # 状態の読み書きはここを通す（SpeculativeToolset がスナップショット上の読み書きに差し替える）
+    def _load_character(self, char_id: str):
+        return services.load_character(char_id)
+
+    def _session(self) -> Optional[Dict]:
+        return services.get_session(self.session_id)
+
+    def _world_facts(self) -> Optional[Dict]:
+        return services.get_world_facts(self.session_id)
+
+    def _log_dice(self, expression: str, result: Dict) -> None:
+        # ダイスログの保存を依頼し（コミットは待たない）、差分用に記録
+        pending = services.submit_dice_log(self.session_id, expression, result)
+        with self._changes_lock:
+            self.changes["dice"].append((pending, {"session_id": self.session_id, "expression": expression, "result": result}))
+            self.changes["writes"] += 1
+
+    def _apply_hp_update(self, char_id: str, new_hp: int) -> Optional[Dict]:
+        # HP 更新を適用し、差分用に記録
+        updated = services.apply_hp_update(char_id, new_hp)
+        if updated:
+            with self._changes_lock:
+                self.changes["characters"][char_id] = services.character_summary(updated)
+                self.changes["writes"] += 1
+        return updated
+
+    def _set_world_fact(self, key: str, value) -> Optional[Dict]:
+        # 世界フラグを更新し、差分用に記録
+        world_facts = services.set_world_fact(self.session_id, key, value)
+        if world_facts is not None:
+            with self._changes_lock:
+                self.changes["world_facts"][key] = value
+                self.changes["writes"] += 1
+        return world_facts
+
+    def commit_writes(
+        self,
+        writes: List[Tuple[str, Tuple]],
+        expected_version: Optional[int] = None,
+        expected_state: Optional[Dict] = None,
+    ) -> bool:
+        """下書き（SpeculativeToolset）の書き込みを 1 トランザクションで適用する。
+
+        expected_state（SpeculativeToolset.expected_state()）を渡せば下書きが読んだキャラクター・世界フラグが
+        変わっていないときだけ、そうでなければセッションが expected_version のままのときだけ適用する。
+        """
+        applied = services.apply_writes(self.session_id, expected_version, writes, expected_state)
+        if applied is None:
+            return False
+        with self._changes_lock:
+            self.changes["characters"].update(applied["characters"])
+            self.changes["world_facts"].update(applied["world_facts"])
+            self.changes["dice"].extend((logwriter.Pending.resolved(row_id), entry) for row_id, entry in applied["dice"])
+            self.changes["writes"] += len(writes)
+        return True
+
+    def state_delta(self) -> Dict:
+        """このターンの変更点（変わったキャラ・世界フラグ、追加されたダイス）を返す。"""
+        return {
+            "characters": list(self.changes["characters"].values()),
+            "world_facts": dict(self.changes["world_facts"]),
+            # ダイスログと同じく新しい順。ID はコミット済みの結果から埋める
+            "dice": [{"id": pending.result(), **entry} for pending, entry in reversed(self.changes["dice"])],
+        }
+
+    @metrics.timed("tool", tool="request_skill_check")
+    @tracing.traced()
+    @resilience.within_deadline
     def request_skill_check(self, actor_id: str, skill: str, dc: int) -> Dict:
         # 技能判定ツール（AI GM 用）
-        actor = services.get_character(actor_id)
+        actor = self._load_character(actor_id)
         if not actor:
             return {"error": f"character {actor_id} not found"}
         outcome = rules.request_skill_check(actor, skill, dc, rng=self.rng)
-        services.log_dice(self.session_id, f"skill:{skill}", {"rolls": outcome.rolls, "total": outcome.total})
+        self._log_dice(f"skill:{skill}", {"rolls": outcome.rolls, "total": outcome.total})
         return {
             "type": "skill_check",
             "actor_id": actor_id,
@@ -32,18 +120,21 @@ class Toolset:
             "rolls": outcome.rolls,
         }
 
+    @metrics.timed("tool", tool="attack_roll")
+    @tracing.traced()
+    @resilience.within_deadline
     def attack_roll(self, attacker_id: str, target_id: str, weapon: Optional[Dict] = None) -> Dict:
         # 攻撃判定ツール（AI GM 用）
-        attacker = services.get_character(attacker_id)
-        target = services.get_character(target_id)
+        attacker = self._load_character(attacker_id)
+        target = self._load_character(target_id)
         if not attacker or not target:
             return {"error": "attacker or target missing"}
         outcome = rules.attack_roll(attacker, target, weapon=weapon, rng=self.rng)
-        services.log_dice(self.session_id, f"attack:{weapon}", {"rolls": outcome.rolls, "total": outcome.total})
+        self._log_dice(f"attack:{weapon}", {"rolls": outcome.rolls, "total": outcome.total})
         if "target_hp" in outcome.updates:
-            updated = services.apply_hp_update(target_id, outcome.updates["target_hp"])
+            updated = self._apply_hp_update(target_id, outcome.updates["target_hp"])
         else:
-            updated = target
+            updated = target.to_dict()
         return {
             "type": "attack",
             "attacker_id": attacker_id,
@@ -54,9 +145,15 @@ class Toolset:
             "target": updated,
         }
 
+    @metrics.timed("tool", tool="query_game_state")
+    @tracing.traced()
+    @resilience.within_deadline
     def query_game_state(self, selector: Optional[str] = None) -> Dict:
         # 状態参照ツール
-        session = services.get_session(self.session_id)
+        if selector == "world_facts":
+            world_facts = self._world_facts()
+            return {"error": "session not found"} if world_facts is None else {"world_facts": world_facts}
+        session = self._session()
         if not session:
             return {"error": "session not found"}
         state = services.summarize_state(session)
@@ -64,32 +161,50 @@ class Toolset:
             return {"characters": state["characters"]}
         return state
 
+    @metrics.timed("tool", tool="search_history")
+    @tracing.traced()
+    @resilience.within_deadline
+    def search_history(self, query: str, limit: int = 5) -> Dict:
+        # 過去のターンを全文検索するツール（GM が以前の出来事を思い出す用）
+        results = services.search_history(self.session_id, query, limit)
+        return {"query": query, "results": results}
+
+    @metrics.timed("tool", tool="recall_memories")
+    @tracing.traced()
+    @resilience.within_deadline
+    def recall_memories(self, query: str, k: int = 3) -> Dict:
+        # 意味的に近い過去のターンを思い出すツール（言い換えた出来事も拾う。TRPG_MEMORY=1 のときだけ結果がある）
+        results = services.recall_memories(self.session_id, query, k)
+        return {"query": query, "results": results}
+
+    @metrics.timed("tool", tool="update_world_fact")
+    @tracing.traced()
+    @resilience.within_deadline
     def update_world_fact(self, key: str, value) -> Dict:
         # 世界フラグ更新ツール
-        session = services.get_session(self.session_id)
-        if not session:
+        world_facts = self._set_world_fact(key, value)
+        if world_facts is None:
             return {"error": "session not found"}
-        save_blob = dict(session.get("save_blob") or {})
-        world_facts = dict(save_blob.get("world_facts") or {})
-        world_facts[key] = value
-        save_blob["world_facts"] = world_facts
-        services.update_session_save(self.session_id, save_blob)
         return {"world_facts": world_facts, "updated": {key: value}}
 
+    @metrics.timed("tool", tool="evaluate_rule")
+    @tracing.traced()
+    @resilience.within_deadline
     def evaluate_rule(self, actor_id: str, template: Dict, target_id: Optional[str] = None) -> Dict:
         # ルールテンプレートを評価する汎用ツール
-        actor = services.get_character(actor_id)
-        target = services.get_character(target_id) if target_id else None
+        actor = self._load_character(actor_id)
+        target = self._load_character(target_id) if target_id else None
         if not actor:
             return {"error": "actor not found"}
         outcome = rules.evaluate_rule_template(template, actor, target, rng=self.rng)
-        services.log_dice(
-            self.session_id,
+        self._log_dice(
             f"rule:{template.get('type')}",
             {"rolls": outcome.rolls, "total": outcome.total, "detail": outcome.detail},
         )
         if "target_hp" in outcome.updates and target_id:
-            target = services.apply_hp_update(target_id, outcome.updates["target_hp"])
+            updated = self._apply_hp_update(target_id, outcome.updates["target_hp"])
+        else:
+            updated = target.to_dict() if target else None
         return {
             "type": template.get("type"),
             "actor_id": actor_id,
@@ -98,5 +213,102 @@ class Toolset:
             "detail": outcome.detail,
             "rolls": outcome.rolls,
             "updates": outcome.updates,
-            "target": target,
+            "target": updated,
         }
+
+
+class SpeculativeToolset(Toolset):
+    """セッションのスナップショットを読み、書き込みは手元の上書きと記録に留める Toolset。"""
+
+    def __init__(self, snapshot: Dict):
+        super().__init__(snapshot["id"])
+        self.snapshot = snapshot
+        # 書き換えたキャラクター・世界フラグだけを新しい辞書で持つ（スナップショットは共有なので書き換えない）
+        self._characters: Dict[str, Dict] = {}
+        self._facts: Optional[Dict] = None
+        self.writes: List[Tuple[str, Tuple]] = []
+        # 読んだ（= 結果がその値に依存する）キャラクター ID と、世界フラグを読んだかどうか（コミット時の衝突判定用）
+        self._read_characters: Set[str] = set()
+        self._read_facts = False
+
+    def _snapshot_character(self, char_id: str) -> Optional[Dict]:
+        return next((c for c in self.snapshot.get("characters", []) if c["id"] == char_id), None)
+
+    def _character_dict(self, char_id: str) -> Optional[Dict]:
+        with self._changes_lock:
+            self._read_characters.add(char_id)
+        if char_id in self._characters:
+            return self._characters[char_id]
+        return self._snapshot_character(char_id)
+
+    def _load_character(self, char_id: str):
+        data = self._character_dict(char_id)
+        return domain.Character.from_dict(data) if data else None
+
+    def _session(self) -> Optional[Dict]:
+        characters = [self._characters.get(c["id"], c) for c in self.snapshot.get("characters", [])]
+        with self._changes_lock:
+            self._read_characters.update(c["id"] for c in characters)
+        save_blob = {**(self.snapshot.get("save_blob") or {}), "world_facts": self._world_facts()}
+        return {**self.snapshot, "characters": characters, "save_blob": save_blob}
+
+    def _world_facts(self) -> Optional[Dict]:
+        self._read_facts = True
+        return self._overlay_facts()
+
+    def _overlay_facts(self) -> Dict:
+        if self._facts is not None:
+            return self._facts
+        return self._snapshot_facts()
+
+    def _snapshot_facts(self) -> Dict:
+        return (self.snapshot.get("save_blob") or {}).get("world_facts") or {}
+
+    def expected_state(self) -> Dict:
+        """読んだキャラクター・世界フラグのスナップショット時点の値（commit_writes の衝突判定に渡す）。
+
+        書くだけの世界フラグやダイスは照合しないので、無関係な書き込みが挟まっても下書きは適用できる。
+        """
+        with self._changes_lock:
+            char_ids = sorted(self._read_characters)
+        return {
+            "characters": {char_id: self._snapshot_character(char_id) for char_id in char_ids},
+            "world_facts": self._snapshot_facts() if self._read_facts else None,
+        }
+
+    def _log_dice(self, expression: str, result: Dict) -> None:
+        with self._changes_lock:
+            self.writes.append(("dice", (expression, result)))
+
+    def _apply_hp_update(self, char_id: str, new_hp: int) -> Optional[Dict]:
+        current = self._character_dict(char_id)
+        if current is None:
+            return None
+        resources = {**(current.get("resources") or {}), "hp": max(0, new_hp)}
+        updated = {
+            **current,
+            "resources": resources,
+            "derived_stats": rules.compute_derived_stats(current.get("base_stats") or {}, resources),
+        }
+        with self._changes_lock:
+            self._characters[char_id] = updated
+            self.writes.append(("hp", (char_id, new_hp)))
+        return updated
+
+    def _set_world_fact(self, key: str, value) -> Optional[Dict]:
+        with self._changes_lock:
+            self._facts = {**self._overlay_facts(), key: value}
+            self.writes.append(("world_fact", (key, value)))
+        return self._facts
+
+    def commit_writes(
+        self,
+        writes: List[Tuple[str, Tuple]],
+        expected_version: Optional[int] = None,
+        expected_state: Optional[Dict] = None,
+    ) -> bool:
+        # 先読み中のモデル呼び出しの下書きは、この上書きに重ねるだけ（DB には書かない）
+        apply = {"dice": self._log_dice, "hp": self._apply_hp_update, "world_fact": self._set_world_fact}
+        for kind, args in writes:
+            apply[kind](*args)
+        return True
@@ -0,0 +1,134 @@
+"""Minimal span tracing (OpenTelemetry-compatible ids and OTLP/JSON field names) with local exporters.
+
+Enabled with ``TRPG_TRACE_EXPORTER=console`` (one JSON span per line on stderr) or
+``TRPG_TRACE_EXPORTER=file`` (appended to ``TRPG_TRACE_FILE``, default ``traces.jsonl``).
+Spans of one trace are buffered and written together when the root span ends.
+When disabled, ``traced`` returns the wrapped function unchanged and ``span`` returns
+a shared no-op context manager.
+"""
+
+from __future__ import annotations
+
+import functools
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+from contextlib import nullcontext
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional
+
+EXPORTER = os.getenv("TRPG_TRACE_EXPORTER", "").lower()
+TRACE_FILE = os.getenv("TRPG_TRACE_FILE", "traces.jsonl")
+ENABLED = EXPORTER in ("console", "file")
+
+_NOOP = nullcontext()
+_export_lock = threading.Lock()
+_current: ContextVar[Optional["Span"]] = ContextVar("trpg_current_span", default=None)
+
+
+class Span:
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "attributes",
+        "start_ns",
+        "end_ns",
+        "status",
+        "root",
+        "finished",
+        "_token",
+    )
+
+    def __init__(self, name: str, parent: Optional["Span"], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.status = "OK"
+        self.root = parent.root if parent else self
+        # ルートスパンだけが同一トレースの終了済みスパンを溜めておく
+        self.finished: List[Dict] = [] if parent is None else None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        if exc is not None:
+            self.status = "ERROR"
+            self.attributes["exception.type"] = exc_type.__name__
+            self.attributes["exception.message"] = str(exc)
+        _current.reset(self._token)
+        self.root.finished.append(self.to_dict())
+        if self.root is self:
+            _export(self.finished)
+        return False
+
+    def to_dict(self) -> Dict:
+        # OTLP/JSON に近いフィールド名で出力（collector 側で変換しやすくする）
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "durationMs": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "status": {"code": "STATUS_CODE_ERROR" if self.status == "ERROR" else "STATUS_CODE_OK"},
+        }
+
+
+def _export(spans: List[Dict]) -> None:
+    # 1 トレース分のスパンをまとめて書き出す
+    lines = "".join(json.dumps(span, ensure_ascii=False, default=str) + "\n" for span in spans)
+    with _export_lock:
+        if EXPORTER == "console":
+            sys.stderr.write(lines)
+            sys.stderr.flush()
+        else:
+            with open(TRACE_FILE, "a", encoding="utf-8") as fh:
+                fh.write(lines)
+
+
+def span(name: str, **attributes):
+    """with tracing.span("gm.turn", session_id=...) as sp: ... の形で区間を記録する。"""
+    if not ENABLED:
+        return _NOOP
+    return Span(name, _current.get(), attributes)
+
+
+def traced(name: Optional[str] = None) -> Callable:
+    """関数呼び出しをスパンとして記録するデコレータ。無効時は元の関数をそのまま返す。"""
+
+    def decorator(func: Callable) -> Callable:
+        if not ENABLED:
+            return func
+        span_name = name or f"{func.__module__.rsplit('.', 1)[-1]}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(span_name, _current.get(), {}):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def current_trace_id() -> Optional[str]:
+    # 実行中のトレース ID（無効時やスパン外では None）
+    current = _current.get()
+    return current.trace_id if current else None